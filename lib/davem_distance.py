@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+"""
+Distances between adaptators and starts of reads.
+
+A backend gives a ratio between 0.0 and 1.0, 1.0 for identical
+sequences. get_distance_backend resolves the backend once, selectors
+then compile a function by adaptator with Distance_backend.compile.
+
+COPYRIGHT
+       Copyright © 2014 AGAP.  Licence  GPLv3+ :  GNU
+       GPL version 3 ou supérieures <http://gnu.org/licenses/gpl.html>
+"""
+
+from functools import partial
+from itertools import izip
+
+
+class Distance_backend( object ) :
+    """
+    Abstract backend, subclasses implement ratio.
+    """
+    name = None
+
+    def ratio( self, pattern, sequence ) :
+        """
+        Return the similarity ratio between pattern and sequence.
+        """
+        raise NotImplementedError
+
+    def compile( self, pattern ) :
+        """
+        Return a function which takes a sequence and returns its ratio
+        with pattern.
+        """
+        return partial( self.ratio, pattern )
+
+
+class Hamming_backend( Distance_backend ) :
+    """
+    Proportion of identical bases at the same position, bases missing
+    in the shortest sequence are mismatches.
+    """
+    name = "hamming"
+
+    def ratio( self, pattern, sequence ) :
+        length = max( len( pattern ), len( sequence ) )
+        if not length :
+            return 1.0
+        same = 0
+        for a, b in izip( pattern, sequence ) :
+            if a == b :
+                same += 1
+        return same / float( length )
+
+
+class Bit_parallel_levenshtein_backend( Distance_backend ) :
+    """
+    Same ratio as python-Levenshtein: ( lensum - d ) / lensum where
+    lensum is the sum of lengths and d the edit distance with a
+    substitution cost of 2, that is 2 * lcs / lensum.
+
+    The longest common subsequence (lcs) is computed with the
+    bit-parallel algorithm of Hyyrö (2004), the bits of the pattern are
+    in one python int so a base of the sequence costs a few integer
+    operations whatever the length of the pattern.
+    """
+    name = "levenshtein (builtin)"
+
+    def get_masks( self, pattern ) :
+        """
+        Return a hash base -> int where bit i is set if pattern[ i ] is
+        the base.
+        """
+        masks = {}
+        for i, base in enumerate( pattern ) :
+            masks[ base ] = masks.get( base, 0 ) | ( 1 << i )
+        return masks
+
+    def compile( self, pattern ) :
+        masks = self.get_masks( pattern )
+        full = ( 1 << len( pattern ) ) - 1
+        length = len( pattern )
+
+        def ratio( sequence ) :
+            lensum = length + len( sequence )
+            if not lensum :
+                return 1.0
+            v = full
+            for base in sequence :
+                u = v & masks.get( base, 0 )
+                v = ( ( v + u ) | ( v - u ) ) & full
+            lcs = length - bin( v ).count( "1" )
+            return 2.0 * lcs / lensum
+
+        return ratio
+
+    def ratio( self, pattern, sequence ) :
+        return self.compile( pattern )( sequence )
+
+
+class Python_levenshtein_backend( Distance_backend ) :
+    """
+    ratio function of the python-Levenshtein module.
+    """
+    name = "levenshtein (python-Levenshtein)"
+
+    def __init__( self ) :
+        from Levenshtein import ratio
+        self.ratio = ratio
+
+
+DISTANCES = ( "levenshtein", "hamming" )
+
+def get_distance_backend( distance="levenshtein" ) :
+    """
+    Return the backend for distance, one of DISTANCES.
+
+    For levenshtein, python-Levenshtein is used when it can be imported,
+    otherwise the builtin bit-parallel implementation.
+    """
+    if distance == "hamming" :
+        return Hamming_backend()
+
+    if distance == "levenshtein" :
+        try :
+            return Python_levenshtein_backend()
+        except ImportError :
+            return Bit_parallel_levenshtein_backend()
+
+    raise ValueError( "distance must be one of %s not %r" % ( ", ".join( DISTANCES ), distance ) )
+
+
+MATRIX_DISTANCES = ( "mismatches", "hamming", "levenshtein" )
+
+class Distance_matrix( object ) :
+    """
+    Distances between all pairs of a list of barcodes, distance is one
+    of MATRIX_DISTANCES:
+
+    mismatches  - substitutions between the shortest barcode and the
+                  start of the other one, as counted by the selectors
+                  with a number of mismatches.
+    hamming     - positions without the same base, bases missing in the
+                  shortest barcode included: length * ( 1 - ratio ) for
+                  the ratio of Hamming_backend.
+    levenshtein - insertions and deletions, a substitution costs 2:
+                  lensum * ( 1 - ratio ) for the Levenshtein ratio.
+
+    The matrix is computed at once with numpy when it can be imported,
+    for blocks of rows so that memory stays low, one pair after the
+    other otherwise.
+    """
+    # rows of a block, times the number of barcodes.
+    block_size = 1 << 21
+
+    def __init__( self, barcodes, distance ) :
+        if distance not in MATRIX_DISTANCES :
+            raise ValueError( "distance must be one of %s not %r" % ( ", ".join( MATRIX_DISTANCES ), distance ) )
+        self.barcodes = list( barcodes )
+        self.distance = distance
+        try :
+            import numpy
+        except ImportError :
+            numpy = None
+        self.numpy = numpy
+        if numpy is None or max( [ 0 ] + map( len, self.barcodes ) ) > 62 :
+            self.numpy = None
+            self.values = self._get_python_values()
+        else :
+            self.values = self._get_numpy_values()
+
+    def _get_python_values( self ) :
+        if self.distance == "levenshtein" :
+            ratio = Bit_parallel_levenshtein_backend().compile
+        values = []
+        for barcode in self.barcodes :
+            if self.distance == "levenshtein" :
+                get_ratio = ratio( barcode )
+            row = []
+            for other in self.barcodes :
+                if self.distance == "levenshtein" :
+                    lensum = len( barcode ) + len( other )
+                    row.append( int( round( lensum * ( 1 - get_ratio( other ) ) ) ) )
+                    continue
+                same = 0
+                for a, b in izip( barcode, other ) :
+                    if a == b :
+                        same += 1
+                if self.distance == "mismatches" :
+                    row.append( min( len( barcode ), len( other ) ) - same )
+                else :
+                    row.append( max( len( barcode ), len( other ) ) - same )
+            values.append( row )
+        return values
+
+    def _get_numpy_values( self ) :
+        numpy = self.numpy
+        nb_barcodes = len( self.barcodes )
+        width = max( [ 1 ] + map( len, self.barcodes ) )
+        lengths = numpy.array( map( len, self.barcodes ), dtype=numpy.int16 )
+        # bases of the barcodes of the rows, padded with 0, and of the
+        # columns, padded with 255: padding bases are never identical.
+        rows = numpy.zeros( ( nb_barcodes, width ), dtype=numpy.uint8 )
+        for i, barcode in enumerate( self.barcodes ) :
+            rows[ i, : len( barcode ) ] = numpy.fromstring( barcode, dtype=numpy.uint8 )
+        columns = numpy.where( rows == 0, 255, rows ).astype( numpy.uint8 )
+
+        values = numpy.zeros( ( nb_barcodes, nb_barcodes ), dtype=numpy.int16 )
+        step = max( 1, self.block_size // max( 1, nb_barcodes ) )
+        for start in xrange( 0, nb_barcodes, step ) :
+            end = min( start + step, nb_barcodes )
+            row_lengths = lengths[ start : end, None ]
+            if self.distance == "levenshtein" :
+                values[ start : end ] = row_lengths + lengths[ None, : ] \
+                                        - 2 * self._get_numpy_lcs( rows[ start : end ], row_lengths, columns, lengths )
+                continue
+            same = numpy.zeros( ( end - start, nb_barcodes ), dtype=numpy.int16 )
+            for pos in xrange( width ) :
+                same += rows[ start : end, pos, None ] == columns[ None, :, pos ]
+            if self.distance == "mismatches" :
+                values[ start : end ] = numpy.minimum( row_lengths, lengths[ None, : ] ) - same
+            else :
+                values[ start : end ] = numpy.maximum( row_lengths, lengths[ None, : ] ) - same
+        return values
+
+    def _get_numpy_lcs( self, rows, row_lengths, columns, lengths ) :
+        """
+        Return the lengths of the longest common subsequences between
+        rows and columns with the bit-parallel algorithm of
+        Bit_parallel_levenshtein_backend, for all pairs at once.
+        """
+        numpy = self.numpy
+        # masks[ i, base ] has bit p set if rows[ i, p ] is base.
+        masks = numpy.zeros( ( len( rows ), 256 ), dtype=numpy.uint64 )
+        for pos in xrange( rows.shape[ 1 ] ) :
+            masks[ numpy.arange( len( rows ) ), rows[ :, pos ] ] |= numpy.uint64( 1 << pos )
+        masks[ :, 0 ] = 0
+        full = ( numpy.uint64( 1 ) << row_lengths.astype( numpy.uint64 ) ) - numpy.uint64( 1 )
+        v = numpy.repeat( full, len( columns ), axis=1 )
+        for pos in xrange( columns.shape[ 1 ] ) :
+            u = v & masks[ :, columns[ :, pos ] ]
+            v = numpy.where( ( pos < lengths )[ None, : ], ( ( v + u ) | ( v - u ) ) & full, v )
+        # bits of v left set are bases of the rows out of the subsequence.
+        popcount = numpy.array( [ bin( byte ).count( "1" ) for byte in xrange( 256 ) ], dtype=numpy.int16 )
+        bits = popcount[ v.view( numpy.uint8 ) ].reshape( v.shape + ( 8, ) ).sum( axis=2 )
+        return row_lengths - bits
+
+    def __getitem__( self, pair ) :
+        i, j = pair
+        return int( self.values[ i ][ j ] )
+
+    def get_min( self ) :
+        """
+        Return the smallest distance between two barcodes, None if there
+        are less than two barcodes.
+        """
+        if len( self.barcodes ) < 2 :
+            return None
+        if self.numpy is not None :
+            return int( self.values[ self._get_upper() ].min() )
+        return min( [ min( row[ i + 1 : ] ) for i, row in enumerate( self.values[ : -1 ] ) ] )
+
+    def get_pairs( self, max_distance ) :
+        """
+        Return the ( barcode_1, barcode_2, distance ) of the pairs of
+        barcodes at most max_distance apart, the closest first.
+        """
+        if self.numpy is not None :
+            close = ( self.values <= max_distance ) & self._get_upper()
+            pairs = zip( *[ indexes.tolist() for indexes in close.nonzero() ] )
+        else :
+            pairs = [ ( i, j ) for i, row in enumerate( self.values )
+                      for j in xrange( i + 1, len( row ) ) if row[ j ] <= max_distance ]
+        pairs = [ ( self[ i, j ], self.barcodes[ i ], self.barcodes[ j ] ) for i, j in pairs ]
+        pairs.sort()
+        return [ ( barcode_1, barcode_2, distance ) for distance, barcode_1, barcode_2 in pairs ]
+
+    def get_max_ratio( self ) :
+        """
+        Return the highest ratio between two barcodes (see the backends),
+        None for mismatches or if there are less than two barcodes.
+        """
+        if self.distance == "mismatches" or len( self.barcodes ) < 2 :
+            return None
+        if self.numpy is not None :
+            numpy = self.numpy
+            lengths = numpy.array( map( len, self.barcodes ), dtype=float )
+            if self.distance == "hamming" :
+                lengths = numpy.maximum( lengths[ :, None ], lengths[ None, : ] )
+            else :
+                lengths = lengths[ :, None ] + lengths[ None, : ]
+            ratios = ( lengths - self.values ) / numpy.maximum( lengths, 1 )
+            return float( ratios[ self._get_upper() ].max() )
+        best = None
+        for i, barcode in enumerate( self.barcodes ) :
+            for j in xrange( i + 1, len( self.barcodes ) ) :
+                other = self.barcodes[ j ]
+                if self.distance == "hamming" :
+                    length = max( len( barcode ), len( other ) )
+                else :
+                    length = len( barcode ) + len( other )
+                ratio = 1.0
+                if length :
+                    ratio = ( length - self[ i, j ] ) / float( length )
+                if best is None or ratio > best :
+                    best = ratio
+        return best
+
+    def _get_upper( self ) :
+        """
+        Return a boolean numpy matrix, True above the diagonal.
+        """
+        size = len( self.barcodes )
+        return self.numpy.triu( self.numpy.ones( ( size, size ), dtype=bool ), 1 )
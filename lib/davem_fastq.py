@@ -15,31 +15,125 @@ COPYRIGHT
        loi.
 """
 
+import os
 import sys
 import zipfile
+import gzip
+import subprocess
+import threading
+import Queue
+import heapq
+import tempfile
+import struct
+import mmap
+import bisect
+import stat
+import errno
+import select
+import fcntl
+from collections import deque
+from distutils.spawn import find_executable
+from itertools import islice
 
 __version__ = "0.0.2"
 
 class Fastq_read( object ) :
+    """
+    Lecture fastq.
+
+    Les quatre lignes sont gardees dans une liste et cut_start/cut_end ne
+    font que deplacer des positions : seq et qual ne sont coupees que
+    lorsqu'on les lit ou que la lecture est ecrite. Le nom n'est decoupe
+    qu'au premier appel de get_member, split_name ou get_name_meta_data.
+    """
+    __slots__ = ( "_lines", "_index", "_cut_start", "_cut_end", "_name_parts" )
+
     def __init__(self, str_reads ):
         """
         str_read - @name\nsequence\nplus\nquality\n
                     final \n is optional.
         """
-        ( self.name,
-          self.seq,
-          self.plus_line,
-          self.qual ) = str_reads.splitlines()
+        lines = str_reads.splitlines()
+        if len( lines ) != 4 :
+            raise ValueError( "a fastq read must have 4 lines not %d" % len( lines ) )
+        self._lines = lines
+        self._index = 0
+        self._cut_start = 0
+        self._cut_end = 0
+        self._name_parts = None
+
+    def _cut( self, line ) :
+        if self._cut_end :
+            return line[ self._cut_start : len( line ) - self._cut_end ]
+        return line[ self._cut_start : ]
+
+    def _apply_cut( self ) :
+        """
+        coupe reellement seq et qual, avant de les remplacer.
+        """
+        if self._cut_start or self._cut_end :
+            i = self._index
+            self._lines[ i + 1 ] = self._cut( self._lines[ i + 1 ] )
+            self._lines[ i + 3 ] = self._cut( self._lines[ i + 3 ] )
+            self._cut_start = 0
+            self._cut_end = 0
+
+    def _get_name( self ) :
+        return self._lines[ self._index ]
+
+    def _set_name( self, name ) :
+        self._lines[ self._index ] = name
+        self._name_parts = None
+
+    name = property( _get_name, _set_name )
+
+    def _get_seq( self ) :
+        if self._cut_start or self._cut_end :
+            return self._cut( self._lines[ self._index + 1 ] )
+        return self._lines[ self._index + 1 ]
+
+    def _set_seq( self, seq ) :
+        self._apply_cut()
+        self._lines[ self._index + 1 ] = seq
+
+    seq = property( _get_seq, _set_seq )
+
+    def _get_plus_line( self ) :
+        return self._lines[ self._index + 2 ]
+
+    def _set_plus_line( self, plus_line ) :
+        self._lines[ self._index + 2 ] = plus_line
+
+    plus_line = property( _get_plus_line, _set_plus_line )
+
+    def _get_qual( self ) :
+        if self._cut_start or self._cut_end :
+            return self._cut( self._lines[ self._index + 3 ] )
+        return self._lines[ self._index + 3 ]
+
+    def _set_qual( self, qual ) :
+        self._apply_cut()
+        self._lines[ self._index + 3 ] = qual
+
+    qual = property( _get_qual, _set_qual )
+
+    def __len__( self ) :
+        return len( self._lines[ self._index + 1 ] ) - self._cut_start - self._cut_end
 
     def cut_start( self, size ) :
         """
-        supprime le debut de la  lecture
+        supprime le debut de la  lecture, une lecture qui n'est que son
+        adaptateur devient vide.
         """
-        if size >= len( self.seq ) :
+        if size > len( self._lines[ self._index + 1 ] ) - self._cut_start - self._cut_end :
             raise Exception( "can't cut %d bases. The read is too short" % (size) )
         if size > 0 :
-            self.seq  =  self.seq[ size : ]
-            self.qual = self.qual[ size : ]
+            self._cut_start += size
+
+    def _get_name_parts( self ) :
+        if self._name_parts is None :
+            self._name_parts = self.name.split( None, 1 )
+        return self._name_parts
 
     def get_member( self, format ) :
         """
@@ -47,7 +141,7 @@ class Fastq_read( object ) :
         format - "Illumina" or "Casava1.8"
         """
         if  format == "Casava1.8" :
-            member = self.name.split( None, 1 )[1][0]
+            member = self._get_name_parts()[1][0]
             if member == "1" :
                 return 1
             elif  member == "2" :
@@ -63,15 +157,29 @@ class Fastq_read( object ) :
         else :
             raise ValueError( "format must be 'Illumina' or 'Casava1.8'" ) 
 
+    def get_pair_name( self, format ) :
+        """
+        return the name shared by both members of a pair: the name
+        without '@' and meta data as split_name, without /1 or /2 for the
+        Illumina format.
+        format - "Illumina" or "Casava1.8"
+        """
+        name = self.name.split( None, 1 )[ 0 ]
+        if format == "Illumina" :
+            if name[ -2 : ] in ( "/1", "/2" ) :
+                return name[ 1 : -2 ]
+        elif format != "Casava1.8" :
+            raise ValueError( "format must be 'Illumina' or 'Casava1.8'" )
+        return name[ 1 : ]
+
     def cut_end( self, size ) :
         """
         supprime la fin de la  lecture
         """
-        if size >= len( self.seq ) :
+        if size >= len( self._lines[ self._index + 1 ] ) - self._cut_start - self._cut_end :
             raise Exception( "can't cut %d bases. The read is too short" % (size) )
         if size > 0 :
-            self.seq  =  self.seq[ : - size ]
-            self.qual = self.qual[ : - size ]
+            self._cut_end += size
 
     def convert_qual( format ) :
         raise NotImplementedError( "for next time" )
@@ -80,7 +188,7 @@ class Fastq_read( object ) :
         """
         return meta data in name read.
         """
-        name_and_data = self.name.split( None, 1 )
+        name_and_data = self._get_name_parts()
         if len( name_and_data ) > 1 :
             return name_and_data[1]
         return ""
@@ -92,27 +200,328 @@ class Fastq_read( object ) :
         
         return - [cleaned_name, meta_data ]
         """
+        name_and_data = self._get_name_parts()
+        if name_and_data and len( name_and_data[0] ) > 1 :
+            return [ name_and_data[0][1:] ] + name_and_data[1:]
         return self.name[1:].split( None, 1 )
 
     def __str__( self ) :
-        return "\n".join( ( self.name, self.seq, self.plus_line, self.qual ) )
+        lines = self._lines
+        i = self._index
+        if self._cut_end :
+            return "\n".join( ( lines[ i ], self._cut( lines[ i + 1 ] ),
+                                lines[ i + 2 ], self._cut( lines[ i + 3 ] ) ) )
+        if self._cut_start :
+            cut = self._cut_start
+            return "\n".join( ( lines[ i ], lines[ i + 1 ][ cut : ],
+                                lines[ i + 2 ], lines[ i + 3 ][ cut : ] ) )
+        return "\n".join( lines[ i : i + 4 ] )
 
     def __repr__( self ) :
         return "<fastq read '%s' at 0x%x>" % ( self.name, id( self ) )
 
 
+class Fastq_record( Fastq_read ) :
+    """
+    Lecture vue dans un bloc lu par Fastq_reader.
+
+    Le bloc est decoupe en lignes par un seul split et la lecture partage
+    la liste des lignes du bloc : aucune chaine n'est creee pour la lecture
+    tant qu'elle n'est pas coupee ou ecrite.
+    """
+    __slots__ = ()
+
+    def __init__( self, lines, index ) :
+        """
+        lines - lignes du bloc sans les \n
+        index - position du nom de la lecture dans lines
+        """
+        self._lines = lines
+        self._index = index
+        self._cut_start = 0
+        self._cut_end = 0
+        self._name_parts = None
+
+
+class Fastq_reader( object ) :
+    """
+    Lit les lectures d'un flux par blocs de block_size octets et retourne
+    des Fastq_record qui partagent les lignes du bloc. Des blocs de 64 Ko
+    restent dans le cache du processeur, ils sont decoupes plus vite que
+    des blocs de quelques Mo.
+
+    offset - position du flux au debut de la lecture, tell() en tient compte
+    size - nombre maximal d'octets lus, None pour lire jusqu'a la fin
+    """
+    def __init__( self, stream, block_size=64 * 1024, offset=0, size=None ) :
+        self._stream = stream
+        self.block_size = block_size
+        self._size = size
+        # lignes du bloc courant, position de la ligne _counted du bloc
+        # et indice de la lecture qui suit la derniere lecture retournee.
+        self._lines = []
+        self._counted = 0
+        self._next = 0
+        self._pos = offset
+        self._end = offset
+
+    def tell( self ) :
+        """
+        retourne la position de la lecture qui suit la derniere lecture
+        retournee.
+        """
+        lines = self._lines
+        pos = self._pos
+        for i in xrange( self._counted, self._next ) :
+            pos += len( lines[ i ] ) + 1
+        self._pos = pos
+        self._counted = self._next
+        # la derniere lecture peut ne pas finir par un \n
+        return min( pos, self._end )
+
+    def _start_block( self, lines, pos ) :
+        self._lines = lines
+        self._counted = 0
+        self._next = 0
+        self._pos = pos
+
+    def __iter__( self ) :
+        read = self._stream.read
+        record = Fastq_record
+        rest = ""
+        remaining = self._size
+        pos = self._pos
+        while True :
+            size = self.block_size
+            if remaining is not None :
+                size = min( size, remaining )
+                if size <= 0 :
+                    break
+            data = read( size )
+            if not data :
+                break
+            if remaining is not None :
+                remaining -= len( data )
+            self._end += len( data )
+            data = rest + data
+            lines = data.split( "\n" )
+            # seules les lectures dont les quatre lignes finissent par un
+            # \n sont completes.
+            end = ( len( lines ) - 1 ) // 4 * 4
+            rest = "\n".join( lines[ end : ] )
+            self._start_block( lines, pos )
+            pos += len( data ) - len( rest )
+            for index in xrange( 0, end, 4 ) :
+                self._next = index + 4
+                yield record( lines, index )
+
+        # derniere lecture sans \n final
+        lines = rest.split( "\n" )
+        if len( lines ) == 4 :
+            self._start_block( lines, pos )
+            self._next = 4
+            yield Fastq_record( lines, 0 )
+
+
+def is_gzip_file( path ) :
+    """
+    return True if path begin with the gzip magic number.
+    bgzip files are gzip files too.
+    """
+    f = open( path, "rb" )
+    magic = f.read( 2 )
+    f.close()
+    return magic == "\x1f\x8b"
+
+
+def is_empty_file( path ) :
+    """
+    return True if path does not exist or has no content.
+    A gzip file is empty if its uncompressed content is empty.
+    """
+    if not os.path.exists( path ) or os.path.getsize( path ) == 0 :
+        return True
+    if path.endswith( ".gz" ) :
+        content = gzip.open( path, "rb" )
+        empty = content.read( 1 ) == ""
+        content.close()
+        return empty
+    return False
+
+
+def is_fifo( path ) :
+    """
+    return True if path is a named pipe.
+    """
+    try :
+        return stat.S_ISFIFO( os.stat( path ).st_mode )
+    except OSError :
+        return False
+
+
+class Compressed_output( object ) :
+    """
+    Write gzip data through an external program so the compression runs
+    in another process. pigz and bgzip compress blocks in parallel with
+    threads, gzip is used when they are missing.
+
+    tell() return the number of uncompressed bytes written.
+    """
+    programs = ( ( "pigz", [ "-c", "-p", "%(threads)d" ] ),
+                 ( "bgzip", [ "-c", "-@", "%(threads)d" ] ),
+                 ( "gzip", [ "-c" ] ) )
+
+    def __init__( self, path, mode, threads=1 ) :
+        for name, args in self.programs :
+            program = find_executable( name )
+            if program is not None :
+                break
+        else :
+            raise IOError( "no gzip program found to compress '%s'" % path )
+
+        self.name = path
+        self._output = open( path, mode.replace( "b", "" ) + "b" )
+        self._process = subprocess.Popen( [ program ] + [ arg % { "threads" : threads } for arg in args ],
+                                          stdin=subprocess.PIPE, stdout=self._output,
+                                          close_fds=True )
+        self._pos = 0
+
+    @property
+    def closed( self ) :
+        return self._process.stdin.closed
+
+    def write( self, data ) :
+        self._process.stdin.write( data )
+        self._pos += len( data )
+
+    def tell( self ) :
+        return self._pos
+
+    def flush( self ) :
+        self._process.stdin.flush()
+
+    def close( self ) :
+        if self.closed :
+            return
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        self._output.close()
+        if returncode != 0 :
+            raise IOError( "compression of '%s' failed with code %d" % ( self.name, returncode ) )
+
+
+class Compressed_input( object ) :
+    """
+    Read gzip data decompressed by an external program (pigz or gzip) in
+    another process.
+    """
+    programs = ( "pigz", "gzip" )
+
+    def __init__( self, path ) :
+        for name in self.programs :
+            program = find_executable( name )
+            if program is not None :
+                break
+        else :
+            raise IOError( "no gzip program found to decompress '%s'" % path )
+
+        self.name = path
+        self._process = subprocess.Popen( [ program, "-dc", path ],
+                                          stdout=subprocess.PIPE, bufsize=-1,
+                                          close_fds=True )
+        self._file = self._process.stdout
+
+    def __iter__( self ) :
+        return self._file
+
+    def next( self ) :
+        return self._file.next()
+
+    def read( self, size=-1 ) :
+        return self._file.read( size )
+
+    def readline( self ) :
+        return self._file.readline()
+
+    @property
+    def closed( self ) :
+        return self._file.closed
+
+    def close( self ) :
+        if self.closed :
+            return
+        if self._process.poll() is None :
+            # the file was not read until the end, the program is stopped
+            # before the pipe is closed so that it does not fail with a
+            # broken pipe.
+            self._process.terminate()
+            self._file.close()
+            self._process.wait()
+            return
+        self._file.close()
+        if self._process.returncode != 0 :
+            raise IOError( "decompression of '%s' failed with code %d" % ( self.name, self._process.returncode ) )
+
+
 class Fastq_file(file) :
     """
     Pour manipuler les fichiers fastq.
+
+    Les fichiers zip et gzip (ou bgzip) sont lus de facon transparente.
+    En ecriture, un chemin finissant par '.gz' est compresse avec threads
+    processus legers (pigz ou bgzip).
+
+    Le chemin '-' est l'entree standard en lecture et la sortie standard
+    en ecriture. L'entree standard et les tubes nommes ne sont lus que
+    s'ils ne sont pas compresses.
     """
-    def __init__(self, path, mode):
-        if 'r' in mode and zipfile.is_zipfile(path):
+    def __init__(self, path, mode, threads=1):
+        self.path = path
+        self._index = None
+        if path == "-" :
+            if 'r' in mode :
+                self._file = sys.stdin
+            else :
+                self._file = sys.stdout
+        elif 'r' in mode and not os.path.isfile( path ) :
+            # on ne peut pas relire le debut d'un tube pour le tester.
+            self._file = open(path, mode)
+        elif 'r' in mode and zipfile.is_zipfile(path):
             zip_file = zipfile.ZipFile(path, "r")
             self._file = zip_file.open(zip_file.filelist[0], "r")
+        elif 'r' in mode and is_gzip_file(path):
+            if find_executable( "pigz" ) or find_executable( "gzip" ) :
+                self._file = Compressed_input( path )
+            else :
+                self._file = gzip.open( path, "rb" )
+        elif path.endswith( ".gz" ) :
+            self._file = Compressed_output( path, mode, threads )
         else:
             self._file = open(path, mode)
         
-        self.seq_already_write = False
+        # on suit en memoire si le fichier contient deja une lecture pour
+        # savoir s'il faut ajouter un \n avant la suivante.
+        self.seq_already_write = 'a' in mode and path != "-" and not is_empty_file( path )
+
+    @property
+    def name( self ) :
+        return self._file.name
+
+    @property
+    def closed( self ) :
+        return self._file.closed
+
+    def close( self ) :
+        self._file.close()
+
+    def tell( self ) :
+        return self._file.tell()
+
+    def seek( self, offset, whence=0 ) :
+        self._file.seek( offset, whence )
+
+    def flush( self ) :
+        self._file.flush()
 
     def __iter__( self ) :
         return self
@@ -134,38 +543,851 @@ class Fastq_file(file) :
         r += self._file.next()
         return r
 
+    def next_batch( self, size ) :
+        """
+        extraire au plus size sequences du fichier dans une seule chaine.
+        la chaine est vide a la fin du fichier.
+        """
+        return "".join( islice( self._file, 4 * size ) )
+
+    def records( self, block_size=64 * 1024, offset=0, size=None ) :
+        """
+        retourne un iterateur de Fastq_record lus par blocs de block_size
+        octets. offset est la position courante du fichier, pour tell().
+        Au plus size octets sont lus, None pour lire jusqu'a la fin.
+        """
+        return Fastq_reader( self._file, block_size, offset, size )
+
+    def skip( self, size ) :
+        """
+        avance de size octets depuis la position courante. Les fichiers
+        compresses, les tubes et l'entree standard sont lus pour cela.
+        """
+        if isinstance( self._file, file ) and self.path != "-" and os.path.isfile( self.path ) :
+            self._file.seek( size, 1 )
+            return
+        while size > 0 :
+            data = self._file.read( min( size, 4 * 1024 * 1024 ) )
+            if not data :
+                raise IOError( "'%s' is shorter than expected" % self.path )
+            size -= len( data )
+
+    def get_index( self, step=1024 ) :
+        """
+        retourne le Fastq_index du fichier. Il est lu depuis path.fqi s'il
+        est a jour, sinon il est construit avec une lecture sur step et
+        ecrit dans path.fqi quand c'est possible.
+        """
+        if self._index is None :
+            index = Fastq_index.load( self.path )
+            if index is None :
+                index = Fastq_index.build( self.path, step )
+                try :
+                    index.write( self.path + Fastq_index.suffix )
+                except ( IOError, OSError ) :
+                    pass
+            self._index = index
+        return self._index
+
+    def count_reads( self ) :
+        """
+        retourne le nombre de lectures du fichier (depuis l'index).
+        """
+        return self.get_index().nb_reads
+
+    def get_read_offset( self, k ) :
+        """
+        retourne la position de la lecture k (la premiere est 0) dans le
+        fichier, dans le contenu decompresse pour un fichier gzip. k peut
+        valoir le nombre de lectures pour la fin des lectures.
+        """
+        offset, skip = self.get_index().locate( k )
+        if skip :
+            fastq = Fastq_file( self.path, "r" )
+            fastq.skip( offset )
+            reader = fastq.records( offset=offset )
+            for read in islice( reader, skip ) :
+                pass
+            offset = reader.tell()
+            fastq.close()
+        return offset
+
+    def _check_seekable( self ) :
+        if not isinstance( self._file, file ) :
+            raise IOError( "can not seek in compressed file '%s'" % self.path )
+
+    def seek_read( self, k ) :
+        """
+        place le fichier au debut de la lecture k (la premiere est 0), les
+        lectures suivantes sont lues par next, readline, next_batch ou
+        records.
+        """
+        self._check_seekable()
+        offset, skip = self.get_index().locate( k )
+        self._file.seek( offset )
+        for i in xrange( 4 * skip ) :
+            self._file.readline()
+
+    def split_ranges( self, n ) :
+        """
+        decoupe le fichier en au plus n parties qui commencent et finissent
+        sur une lecture, pour les lire en parallele avec read_range.
+
+        return - liste de ( debut, fin, premiere lecture, nombre de lectures )
+        """
+        return self.get_index().split_ranges( n )
+
+    def read_range( self, start, end, block_size=64 * 1024 ) :
+        """
+        retourne un iterateur de Fastq_record sur les octets de start a end
+        du fichier, start et end etant des debuts de lectures.
+        """
+        self._check_seekable()
+        self._file.seek( start )
+        return Fastq_reader( self._file, block_size, start, end - start )
+
+    def write_record( self, read ) :
+        """
+        ecrit un Fastq_read, un Fastq_record ou une chaine comme
+        write( str( read ) ).
+        """
+        if self.seq_already_write :
+            self._file.write( "\n%s" % read )
+        else :
+            self._file.write( str( read ) )
+            self.seq_already_write = True
+
     def write( self, seq ) :
         r"""
         seq doit etre au format @ref\nACTG\n+\nffff
         sans aucun autre \n
         """
-        if self.tell() == 0 :
-           self._file.write( seq )
-        else :
+        if self.seq_already_write :
            self._file.write( "\n" + seq )
+        else :
+           self._file.write( seq )
+           self.seq_already_write = seq != ""
             
-    def sort( self, path ) :
+    def sort( self, path, max_memory=512 * 1024 * 1024, processes=1, tmp_dir=None, key=None ) :
         """
-        Crée une copie triée du fichier fastq.
+        Crée une copie triée du fichier fastq, sur le nom des lectures ou
+        sur key( read ), voir sort_reads.
         """
-        index = []
-         
-        seq = self.next()
-        while seq :
-             name_seq = seq.split( '\n', 1 )[ 0 ]
-             index.append( [ name_seq, self.tell() - len( seq ) ] )
-             seq = self.next()
+        sort_reads( self.records(), path, max_memory, processes, tmp_dir, key )
+
+
+def _get_name( name_and_read ) :
+    return name_and_read[ 0 ]
+
+
+def _get_read_name( read ) :
+    return read.name
+
+
+def sort_reads( reads, path, max_memory=512 * 1024 * 1024, processes=1, tmp_dir=None, key=None ) :
+    """
+    Ecrit les lectures de reads (des Fastq_read) triees dans le fichier
+    fastq path, sur key( read ) ou sur leur nom si key est None.
+
+    Le tri se fait en memoire bornee : des paquets d'environ max_memory
+    octets sont tries puis ecrits dans des fichiers temporaires (dans
+    tmp_dir) qui sont fusionnes. Avec processes > 1, les paquets sont
+    tries en parallele et chacun utilise max_memory / processes.
+    Les lectures de meme cle restent dans l'ordre de reads.
+    """
+    if key is None :
+        key = _get_read_name
+    run_size = max( 1, max_memory // processes )
+    runs = []
+    sorting = []
+    pool = None
+    if processes > 1 :
+        from multiprocessing import Pool
+        pool = Pool( processes )
+
+    try :
+        run = []
+        size = 0
+        for read in reads :
+            str_read = str( read )
+            run.append( ( key( read ), str_read ) )
+            # ~100 octets pour le tuple et les chaines python
+            size += len( str_read ) + 100
+            if size >= run_size :
+                _spill_run( run, runs, sorting, pool, processes, tmp_dir )
+                run = []
+                size = 0
 
-        index.sort()
-        
         sorted_file = Fastq_file( path, "w" )
-        for name, pos in index :
-            self.seek( pos )
-            sorted_file.write( self.readline().rstrip( '\n' ) )
+        if not runs :
+            run.sort( key=_get_name )
+            for name, str_read in run :
+                sorted_file.write( str_read )
+        else :
+            if run :
+                _spill_run( run, runs, sorting, pool, processes, tmp_dir )
+            for result in sorting :
+                result.get()
+            for name, run_no, i, str_read in heapq.merge( *[ _iter_run( run_path, run_no, key )
+                                                            for run_no, run_path in enumerate( runs ) ] ) :
+                sorted_file.write( str_read )
         sorted_file.close()
-        
 
-        
+    finally :
+        if pool is not None :
+            pool.terminate()
+            pool.join()
+        for run_path in runs :
+            if os.path.exists( run_path ) :
+                os.remove( run_path )
+
+
+def _spill_run( run, runs, sorting, pool, processes, tmp_dir ) :
+    """
+    trie run dans un fichier temporaire ajoute a runs. Avec un pool,
+    le tri est lance en parallele et son AsyncResult ajoute a sorting.
+    """
+    fd, run_path = tempfile.mkstemp( suffix=".fastq", dir=tmp_dir )
+    os.close( fd )
+    runs.append( run_path )
+    if pool is None :
+        _sort_run( run, run_path )
+    else :
+        # au plus processes paquets en memoire a la fois.
+        while len( [ result for result in sorting if not result.ready() ] ) >= processes :
+            sorting[ -1 ].wait( 0.1 )
+        sorting.append( pool.apply_async( _sort_run, ( run, run_path ) ) )
+
+
+def _sort_run( run, run_path ) :
+    """
+    trie run, une liste de ( cle, lecture ), par cle et l'ecrit dans
+    run_path, une lecture par groupe de 4 lignes.
+    """
+    run.sort( key=_get_name )
+    run_file = open( run_path, "w" )
+    for name, str_read in run :
+        run_file.write( str_read )
+        run_file.write( "\n" )
+    run_file.close()
+    return run_path
+
+
+def _iter_run( run_path, run_no, key=_get_read_name ) :
+    """
+    relit un paquet trie : ( cle, numero du paquet, rang, lecture ).
+    """
+    run_file = open( run_path, "r" )
+    for i, read in enumerate( Fastq_reader( run_file ) ) :
+        yield ( key( read ), run_no, i, str( read ) )
+    run_file.close()
+
+
+class Fastq_index( object ) :
+    """
+    Positions des lectures d'un fichier fastq, une lecture sur step.
+
+    Le fichier d'index (chemin du fastq suivi de '.fqi') contient une
+    entete puis les positions en entiers de 64 bits little-endian, celle
+    des lectures 0, step, 2 * step... puis la fin des lectures. Il est lu
+    par mmap. La taille et la date de modification du fastq sont gardees
+    dans l'entete, un index perime n'est pas charge.
+
+    Pour un fichier gzip, les positions sont celles du contenu decompresse.
+
+    index[ i ] retourne la position de la lecture i * step.
+    """
+    suffix = ".fqi"
+    magic = "FQI\x01"
+    # magic, step, nombre de lectures, taille et date (en us) du fastq
+    _header = struct.Struct( "<4sQQQQ" )
+    _entry = struct.Struct( "<Q" )
+
+    def __init__( self, data, step, nb_reads, file_size, mtime ) :
+        """
+        data - chaine ou mmap du fichier d'index
+        """
+        self._data = data
+        self.step = step
+        self.nb_reads = nb_reads
+        self.file_size = file_size
+        self.mtime = mtime
+        self._len = ( len( data ) - self._header.size ) // self._entry.size
+
+    @staticmethod
+    def _get_stat( path ) :
+        stat = os.stat( path )
+        return stat.st_size, int( stat.st_mtime * 1000000 )
+
+    @classmethod
+    def load( cls, path ) :
+        """
+        retourne l'index de path lu depuis path.fqi, None s'il n'existe pas
+        ou n'est plus a jour.
+        """
+        index_path = path + cls.suffix
+        if not os.path.exists( index_path ) :
+            return None
+        index_file = open( index_path, "rb" )
+        try :
+            if os.fstat( index_file.fileno() ).st_size < cls._header.size :
+                return None
+            data = mmap.mmap( index_file.fileno(), 0, access=mmap.ACCESS_READ )
+        finally :
+            index_file.close()
+        magic, step, nb_reads, file_size, mtime = cls._header.unpack_from( data )
+        if magic != cls.magic or ( file_size, mtime ) != cls._get_stat( path ) :
+            data.close()
+            return None
+        return cls( data, step, nb_reads, file_size, mtime )
+
+    @classmethod
+    def build( cls, path, step=1024 ) :
+        """
+        lit le fichier fastq path et retourne son index.
+        """
+        file_size, mtime = cls._get_stat( path )
+        fastq = Fastq_file( path, "r" )
+        reader = fastq.records()
+        offsets = [ 0 ]
+        nb_reads = 0
+        for read in reader :
+            nb_reads += 1
+            if nb_reads % step == 0 :
+                offsets.append( reader.tell() )
+        if nb_reads % step :
+            offsets.append( reader.tell() )
+        fastq.close()
+        data = cls._header.pack( cls.magic, step, nb_reads, file_size, mtime )
+        data += struct.pack( "<%dQ" % len( offsets ), *offsets )
+        return cls( data, step, nb_reads, file_size, mtime )
+
+    def write( self, index_path ) :
+        """
+        ecrit l'index dans index_path, le fichier est remplace d'un coup.
+        """
+        tmp_path = "%s.%d.tmp" % ( index_path, os.getpid() )
+        try :
+            index_file = open( tmp_path, "wb" )
+            index_file.write( self._data[ : ] )
+            index_file.close()
+            os.rename( tmp_path, index_path )
+        except :
+            if os.path.exists( tmp_path ) :
+                os.remove( tmp_path )
+            raise
+
+    def __len__( self ) :
+        return self._len
+
+    def __getitem__( self, i ) :
+        if i < 0 :
+            i += self._len
+        if not 0 <= i < self._len :
+            raise IndexError( "fastq index entry %d out of range" % i )
+        return self._entry.unpack_from( self._data, self._header.size + i * self._entry.size )[ 0 ]
+
+    def locate( self, k ) :
+        """
+        retourne ( position, saut ) : la lecture k est la saut-ieme apres
+        la position. k peut valoir nb_reads pour la fin des lectures.
+        """
+        if not 0 <= k <= self.nb_reads :
+            raise IndexError( "read %d out of range, the file has %d reads" % ( k, self.nb_reads ) )
+        i = k // self.step
+        return self[ i ], k - i * self.step
+
+    def split_ranges( self, n ) :
+        """
+        decoupe les lectures en au plus n parties de tailles proches qui
+        commencent sur une lecture indexee.
+
+        return - liste de ( debut, fin, premiere lecture, nombre de lectures )
+                 debut et fin etant des positions dans le fichier
+        """
+        start = self[ 0 ]
+        end = self[ -1 ]
+        # premiere entree dont la position atteint chaque limite, la
+        # derniere entree est la fin des lectures.
+        limits = [ 0 ]
+        for j in xrange( 1, n ) :
+            i = bisect.bisect_left( self, start + ( end - start ) * j // n, limits[ -1 ], self._len - 1 )
+            if i > limits[ -1 ] :
+                limits.append( i )
+        limits.append( self._len - 1 )
+
+        ranges = []
+        for i, j in zip( limits, limits[ 1 : ] ) :
+            if i == j :
+                continue
+            first = i * self.step
+            last = min( j * self.step, self.nb_reads )
+            ranges.append( ( self[ i ], self[ j ], first, last - first ) )
+        return ranges
+
+    def close( self ) :
+        if isinstance( self._data, mmap.mmap ) :
+            self._data.close()
+
+
+class Buffered_fastq_file( object ) :
+    """
+    Fastq_file en ecriture dont les lectures sont gardees en memoire et
+    ecrites par les threads d'un Fastq_writer.
+
+    Le fichier n'est ouvert par le thread qu'a la premiere ecriture et peut
+    etre ferme puis rouvert en ajout si le Fastq_writer limite le nombre
+    de fichiers ouverts. Le contenu ecrit est identique a celui d'un
+    Fastq_file.
+    """
+    def __init__( self, writer, path, mode, threads, slot ) :
+        self._writer = writer
+        self._path = path
+        self._mode = mode
+        self._threads = threads
+        self._slot = slot
+        self._file = None
+        self._chunks = []
+        self._size = 0
+        self.closed = False
+        # ecrit dans un tube nomme par le thread des tubes du writer.
+        self.stream = False
+        self.seq_already_write = 'a' in mode and not is_empty_file( path )
+
+    @property
+    def name( self ) :
+        return self._path
+
+    def write_record( self, read ) :
+        """
+        comme Fastq_file.write_record
+        """
+        if self.seq_already_write :
+            data = "\n%s" % read
+        else :
+            data = str( read )
+            self.seq_already_write = True
+        self._chunks.append( data )
+        self._size += len( data )
+        if self._size >= self._writer.block_size :
+            self.flush()
+
+    def write( self, seq ) :
+        """
+        comme Fastq_file.write
+        """
+        if self.seq_already_write :
+            seq = "\n" + seq
+        elif seq == "" :
+            return
+        else :
+            self.seq_already_write = True
+        self._chunks.append( seq )
+        self._size += len( seq )
+        if self._size >= self._writer.block_size :
+            self.flush()
+
+    def flush( self ) :
+        """
+        donne le contenu du tampon au thread d'ecriture.
+        """
+        if self._chunks :
+            self._writer.submit( self, self._take() )
+
+    def _take( self ) :
+        """
+        vide le tampon et retourne son contenu.
+        """
+        data = "".join( self._chunks )
+        self._chunks = []
+        self._size = 0
+        return data
+
+    def close( self ) :
+        if not self.closed :
+            self.flush()
+            self._writer.submit( self, None )
+            self.closed = True
+
+
+class File_handle_pool( object ) :
+    """
+    Garde au plus max_open fichiers ouverts pour un thread de Fastq_writer.
+    Le fichier utilise le moins recemment est ferme pour en ouvrir un autre,
+    il sera rouvert en ajout.
+
+    Les fichiers ouverts sont dans une liste circulaire doublement chainee
+    de liens [ precedent, suivant, output ], le plus ancien suit la racine :
+    un acces comme une eviction coutent O(1).
+
+    hits - ecritures dans un fichier deja ouvert
+    misses - ecritures qui ont du ouvrir le fichier
+    evictions - fichiers fermes pour en ouvrir un autre
+    """
+    def __init__( self, max_open=None ) :
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._links = {}
+        self._root = root = []
+        root[ : ] = [ root, root, None ]
+
+    def _unlink( self, output ) :
+        """
+        retire output de la liste des fichiers ouverts.
+        """
+        link = self._links.pop( output )
+        link[ 0 ][ 1 ] = link[ 1 ]
+        link[ 1 ][ 0 ] = link[ 0 ]
+
+    def _append( self, output ) :
+        """
+        met output en fin de liste, comme le plus recemment utilise.
+        """
+        root = self._root
+        last = root[ 0 ]
+        link = [ last, root, output ]
+        last[ 1 ] = root[ 0 ] = link
+        self._links[ output ] = link
+
+    def get( self, output ) :
+        """
+        retourne le Fastq_file ouvert de output (un Buffered_fastq_file)
+        """
+        if output in self._links :
+            self.hits += 1
+            self._unlink( output )
+        else :
+            self.misses += 1
+            if self.max_open is not None and len( self._links ) >= self.max_open :
+                oldest = self._root[ 1 ][ 2 ]
+                oldest._file.close()
+                self._unlink( oldest )
+                self.evictions += 1
+            mode = output._mode
+            if output._file is not None :
+                mode = "a"
+            output._file = Fastq_file( output._path, mode, output._threads )
+        self._append( output )
+        return output._file
+
+    def close( self, output ) :
+        """
+        ferme output, le fichier est cree s'il n'a jamais ete ecrit.
+        """
+        if output._file is None :
+            output._file = Fastq_file( output._path, output._mode, output._threads )
+        elif output not in self._links :
+            return
+        output._file.close()
+        if output in self._links :
+            self._unlink( output )
+
+    def close_all( self ) :
+        """
+        ferme tous les fichiers ouverts, ils seront rouverts en ajout.
+        """
+        for output in self._links :
+            output._file.close()
+        self._links.clear()
+        root = self._root
+        root[ : ] = [ root, root, None ]
+
+
+class Fastq_writer( object ) :
+    """
+    Ecrit des fichiers fastq avec des tampons en memoire vides par threads
+    processus legers.
+
+    memory - memoire maximale (en octets) utilisee par les tampons des
+             fichiers et par les donnees en attente d'ecriture.
+    max_open - nombre maximal de fichiers ouverts en meme temps, None pour
+               ne pas limiter.
+
+    Les ecritures d'un fichier sont toujours faites par le meme thread,
+    dans l'ordre. Quand les donnees en attente depassent la moitie de
+    memory, l'appelant attend que les threads aient ecrit.
+
+    Les tubes nommes sont ecrits par un thread a part, sans bloquer : un
+    tube plein (lecteur lent ou qui attend un autre tube) n'empeche pas
+    d'ecrire dans les autres. Avant d'attendre, l'appelant donne a ce
+    thread le contenu des tampons de tous les tubes, pour qu'un lecteur
+    qui lit plusieurs tubes (les deux lectures d'une paire) ait toutes
+    les donnees deja produites. Un tube nomme n'est ouvert que quand il a
+    un lecteur et n'est jamais ferme avant la fin.
+    """
+    def __init__( self, memory=64 * 1024 * 1024, threads=1, max_open=None ) :
+        self.memory = memory
+        self.block_size = memory // 2
+        self._nb_files = 0
+        self._pending = 0
+        self._error = None
+        self._condition = threading.Condition()
+        self._queues = []
+        self._threads = []
+        self._outputs = []
+        self.pools = []
+        self._streams = []
+        self._stream_jobs = []
+        self._stream_thread = None
+        self._stop_streams = False
+        for i in range( threads ) :
+            queue = Queue.Queue()
+            pool = File_handle_pool()
+            if max_open is not None :
+                pool.max_open = max( 1, max_open // threads )
+            thread = threading.Thread( target=self._run, args=( queue, pool ) )
+            thread.daemon = True
+            thread.start()
+            self._queues.append( queue )
+            self.pools.append( pool )
+            self._threads.append( thread )
+
+    def open( self, path, mode="w", threads=1 ) :
+        """
+        retourne un Buffered_fastq_file pour path.
+        threads est le nombre de threads de compression d'un fichier .gz
+        """
+        output = Buffered_fastq_file( self, path, mode, threads, self._nb_files )
+        if is_fifo( path ) :
+            if path.endswith( ".gz" ) :
+                raise IOError( "named pipe '%s' can not be compressed, compress its content downstream" % path )
+            output.stream = True
+            self._start_streams()
+            self._streams.append( output )
+        self._outputs.append( output )
+        self._nb_files += 1
+        # la moitie de la memoire est partagee entre les tampons.
+        self.block_size = max( 4096, self.memory // ( 2 * self._nb_files ) )
+        return output
+
+    def submit( self, output, data ) :
+        """
+        ecrit data dans output (ou ferme output si data est None) dans un
+        thread.
+        """
+        size = 0
+        if data is not None :
+            size = len( data )
+        self._condition.acquire()
+        try :
+            if self._streams and self._pending > 0 and self._pending + size > self.memory // 2 :
+                self._flush_streams( output )
+            while self._pending > 0 and self._pending + size > self.memory // 2 and self._error is None :
+                self._condition.wait()
+            self._check_error()
+            self._pending += size
+            if output.stream :
+                self._stream_jobs.append( ( output, data ) )
+        finally :
+            self._condition.release()
+        if output.stream :
+            self._wake_streams()
+        else :
+            self._queues[ output._slot % len( self._queues ) ].put( ( output, data ) )
+
+    def _run( self, queue, pool ) :
+        while True :
+            job = queue.get()
+            if job is None :
+                break
+            output, data = job
+            if output is None :
+                # demande de sync, data est l'Event a signaler.
+                try :
+                    pool.close_all()
+                except Exception :
+                    if self._error is None :
+                        self._error = sys.exc_info()
+                data.set()
+                continue
+            try :
+                if data is None :
+                    pool.close( output )
+                else :
+                    pool.get( output )._file.write( data )
+            except Exception :
+                if self._error is None :
+                    self._error = sys.exc_info()
+            self._condition.acquire()
+            if data is not None :
+                self._pending -= len( data )
+            self._condition.notify_all()
+            self._condition.release()
+
+    def sync( self ) :
+        """
+        donne le contenu de tous les tampons aux threads et attend qu'ils
+        l'aient ecrit et qu'ils aient ferme leurs fichiers : la taille d'un
+        fichier sur le disque est celle de tout ce qui lui a ete ecrit, un
+        fichier .gz finit par un membre gzip complet. Les fichiers sont
+        rouverts en ajout a l'ecriture suivante.
+        """
+        if self._streams :
+            raise IOError( "named pipes can not be synchronized" )
+        for output in self._outputs :
+            if not output.closed :
+                output.flush()
+        events = []
+        for queue in self._queues :
+            event = threading.Event()
+            queue.put( ( None, event ) )
+            events.append( event )
+        for event in events :
+            event.wait()
+        self._check_error()
+
+    def _start_streams( self ) :
+        if self._stream_thread is None :
+            self._wake_read, self._wake_write = os.pipe()
+            fcntl.fcntl( self._wake_write, fcntl.F_SETFL, os.O_NONBLOCK )
+            self._stream_thread = threading.Thread( target=self._run_streams )
+            self._stream_thread.daemon = True
+            self._stream_thread.start()
+
+    def _wake_streams( self ) :
+        try :
+            os.write( self._wake_write, "x" )
+        except OSError, e :
+            # le tube de reveil est deja plein.
+            if e.errno != errno.EAGAIN :
+                raise
+
+    def _flush_streams( self, current ) :
+        """
+        donne au thread des tubes le contenu des tampons des tubes nommes
+        sauf current. Appele avec self._condition acquise.
+        """
+        for output in self._streams :
+            if output is not current and output._chunks :
+                data = output._take()
+                self._pending += len( data )
+                self._stream_jobs.append( ( output, data ) )
+        self._wake_streams()
+
+    def _run_streams( self ) :
+        waiting = {}   # output -> deque des donnees a ecrire
+        written = {}   # output -> octets deja ecrits de la premiere donnee
+        fds = {}
+        closing = set()
+        dropped = set()
+        while True :
+            self._condition.acquire()
+            jobs = self._stream_jobs
+            self._stream_jobs = []
+            stop = self._stop_streams
+            self._condition.release()
+
+            nb_written = 0
+            for output, data in jobs :
+                if output in dropped :
+                    if data is not None :
+                        nb_written += len( data )
+                elif data is None :
+                    waiting.setdefault( output, deque() )
+                    closing.add( output )
+                else :
+                    waiting.setdefault( output, deque() ).append( data )
+                    written.setdefault( output, 0 )
+
+            for output in waiting.keys() :
+                if output not in fds :
+                    try :
+                        fds[ output ] = os.open( output._path, os.O_WRONLY | os.O_NONBLOCK )
+                    except OSError, e :
+                        # ENXIO : le tube n'a pas encore de lecteur.
+                        if e.errno != errno.ENXIO :
+                            nb_written += self._drop_stream( output, waiting, written, fds, closing, dropped )
+
+            for output in list( closing ) :
+                if output in fds and not waiting[ output ] :
+                    os.close( fds.pop( output ) )
+                    closing.remove( output )
+                    del waiting[ output ]
+
+            if not stop or waiting :
+                timeout = None
+                if len( fds ) < len( waiting ) :
+                    timeout = 0.1
+                ready = select.select( [ self._wake_read ],
+                                       [ fds[ output ] for output in waiting if output in fds and waiting[ output ] ],
+                                       [], timeout )
+                if ready[ 0 ] :
+                    os.read( self._wake_read, 4096 )
+
+                for output in waiting.keys() :
+                    if output not in fds or fds[ output ] not in ready[ 1 ] :
+                        continue
+                    chunks = waiting[ output ]
+                    try :
+                        while chunks :
+                            n = os.write( fds[ output ], buffer( chunks[ 0 ], written[ output ] ) )
+                            nb_written += n
+                            written[ output ] += n
+                            if written[ output ] < len( chunks[ 0 ] ) :
+                                break
+                            chunks.popleft()
+                            written[ output ] = 0
+                    except OSError, e :
+                        if e.errno != errno.EAGAIN :
+                            nb_written += self._drop_stream( output, waiting, written, fds, closing, dropped )
+
+            if nb_written or stop :
+                self._condition.acquire()
+                self._pending -= nb_written
+                self._condition.notify_all()
+                self._condition.release()
+            if stop and not waiting :
+                break
+
+    def _drop_stream( self, output, waiting, written, fds, closing, dropped ) :
+        """
+        abandonne un tube qui ne peut plus etre ecrit : l'erreur sera
+        levee dans le thread appelant. Retourne le nombre d'octets
+        abandonnes.
+        """
+        if self._error is None :
+            self._error = sys.exc_info()
+        size = sum( [ len( data ) for data in waiting.pop( output ) ] ) - written.pop( output, 0 )
+        if output in fds :
+            os.close( fds.pop( output ) )
+        closing.discard( output )
+        dropped.add( output )
+        return size
+
+    def _check_error( self ) :
+        if self._error is not None :
+            raise self._error[0], self._error[1], self._error[2]
+
+    def get_handle_stats( self ) :
+        """
+        return ( hits, misses, evictions ) of the file handle pools.
+        """
+        return ( sum( [ pool.hits for pool in self.pools ] ),
+                 sum( [ pool.misses for pool in self.pools ] ),
+                 sum( [ pool.evictions for pool in self.pools ] ) )
+
+    def close( self ) :
+        """
+        attend la fin des ecritures. Les fichiers doivent deja etre fermes.
+        """
+        for queue in self._queues :
+            queue.put( None )
+        for thread in self._threads :
+            thread.join()
+        if self._stream_thread is not None :
+            self._condition.acquire()
+            self._stop_streams = True
+            self._condition.release()
+            self._wake_streams()
+            self._stream_thread.join()
+            os.close( self._wake_read )
+            os.close( self._wake_write )
+            self._stream_thread = None
+        self._check_error()
+
+
 def clean_seq_name( seq_name ) :
     """
     retourne le nom de la séquence sans le prefixe '@'
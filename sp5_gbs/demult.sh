@@ -25,6 +25,9 @@
 
 
 
+manifest="demult_manifest.tsv"
+rm -f $manifest
+
 for i in `ls *R1_001.fastq`;do
 ref=${i%R1_001.fastq}
 numIndex=`echo $i | cut -d_ -f2`
@@ -33,10 +36,12 @@ reverse="/home/mroques/DATA/Miseq5/data_dezip/"$ref"R2_001.fastq"
 #prefix=`echo $i | cut -d_ -f1-2`
 fileIndex="/home/mroques/DATA/Miseq5/data_dezip/"$numIndex
 
-
-qsub -q bioinfo.q -b yes -V -cwd -N "demult"$numIndex python26 /home/sarah1/Scripts/Vincent/demultadapt/demultadapt.py -f $forward -F $reverse -p $numIndex $fileIndex
+printf "%s\t%s\t%s\t%s\n" $forward $reverse $fileIndex $numIndex >> $manifest
 
 done;
 
-echo "DONE.";
+# one job demultiplexes every lane, 4 at the same time. It can be submitted
+# again if it is killed, finished lanes are skipped and the others resume.
+qsub -q bioinfo.q -b yes -V -cwd -N "demult" python26 /home/sarah1/Scripts/Vincent/demultadapt/demultadapt.py --manifest $manifest --jobs 4 --checkpoint 600 --resume
 
+echo "DONE.";
@@ -30,11 +30,13 @@ COPYRIGHT
   
 """
 
-import sys, os
+import sys, os, time, copy
 sys.path.append("")
-from davem_fastq import Fastq_read, Fastq_file
+from davem_fastq import Fastq_read, Fastq_file, Fastq_reader, Fastq_writer
+from davem_distance import get_distance_backend, DISTANCES, Distance_matrix
+from cStringIO import StringIO
 import argparse
-from itertools import izip
+from itertools import izip, islice, combinations, product
 from bisect import bisect_left
  
 if sys.version_info[0] == 2:
@@ -54,6 +56,93 @@ class FastqFileType( object ) :
         return Fastq_file( path_name, self.mode )
 
 
+def get_rate( value ) :
+    """
+    Return the float of a --levenshtein option, or "auto".
+    """
+    if value == "auto" :
+        return value
+    try :
+        return float( value )
+    except ValueError :
+        raise argparse.ArgumentTypeError( "'%s' is not a ratio or auto" % value )
+
+
+def get_shard( value ) :
+    """
+    Return the ( shard, number of shards ) of an I/N option.
+    """
+    try :
+        shard, nb_shards = [ int( number ) for number in value.split( "/" ) ]
+    except ValueError :
+        raise argparse.ArgumentTypeError( "'%s' is not I/N" % value )
+    if not 1 <= shard <= nb_shards :
+        raise argparse.ArgumentTypeError( "shard %d is not between 1 and %d" % ( shard, nb_shards ) )
+    return shard, nb_shards
+
+
+_missing = object()
+
+class Lru_cache( object ) :
+    """
+    Mapping of at most max_size keys, the least recently used key is
+    forgotten first.
+
+    Keys are kept in a circular doubly linked list of
+    [ previous, next, key, value ] links, the oldest key follows the root.
+    """
+    def __init__( self, max_size ) :
+        if max_size < 1 :
+            raise ValueError( "max_size argument must be a positive int not %r" % max_size )
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._links = {}
+        self._root = []
+        self._root[ : ] = [ self._root, self._root, None, None ]
+
+    def __len__( self ) :
+        return len( self._links )
+
+    def get( self, key, default=None ) :
+        """
+        Return the value of key and mark it as the most recently used,
+        default if key is unknown.
+        """
+        link = self._links.get( key )
+        if link is None :
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        root = self._root
+        if link[ 1 ] is not root :
+            previous, next_link = link[ 0 ], link[ 1 ]
+            previous[ 1 ] = next_link
+            next_link[ 0 ] = previous
+            last = root[ 0 ]
+            last[ 1 ] = root[ 0 ] = link
+            link[ 0 ] = last
+            link[ 1 ] = root
+        return link[ 3 ]
+
+    def put( self, key, value ) :
+        """
+        Add a key which is not in the cache.
+        """
+        root = self._root
+        if len( self._links ) >= self.max_size :
+            oldest = root[ 1 ]
+            root[ 1 ] = oldest[ 1 ]
+            oldest[ 1 ][ 0 ] = root
+            del self._links[ oldest[ 2 ] ]
+
+        last = root[ 0 ]
+        link = [ last, root, key, value ]
+        last[ 1 ] = root[ 0 ] = link
+        self._links[ key ] = link
+
+
 class Selector( object ) :
     """
     Abstract class to look for a line in a table_adaptator.
@@ -95,25 +184,156 @@ class Selector( object ) :
         """
         raise NotImplementedError
 
+    def select_batch( self, sequences_1, sequences_2=None ) :
+        """
+        Return the list of lines selected for each sequence of
+        sequences_1 (and its mate in sequences_2 in paired-end).
+
+        Selectors which can work on a whole batch override this method.
+        """
+        if sequences_2 is None :
+            return map( self.select, sequences_1 )
+        return map( self.select, sequences_1, sequences_2 )
+
+    def cut( self, line, *reads ) :
+        """
+        Remove the adaptator of line from the start of reads.
+        """
+        for read in reads :
+            read.cut_start( len( line[ 0 ] ) )
+
+    def is_exact( self, line, *sequences ) :
+        """
+        Return True if one of the sequences selected for line starts
+        exactly with its adaptator.
+        """
+        for sequence in sequences :
+            if sequence.startswith( line[ 0 ] ) :
+                return True
+        return False
+
+    def is_ambiguous( self, *sequences ) :
+        """
+        For sequences which selected nothing, return True if at least
+        one adaptator was acceptable for one of them, so they were
+        rejected because several adaptators were possible.
+        """
+        for sequence in sequences :
+            if self._has_candidate( sequence ) :
+                return True
+        return False
+
+    def _has_candidate( self, sequence ) :
+        """
+        Return True if at least one adaptator is acceptable for sequence.
+        """
+        return False
+
+    def get_cache_stats( self ) :
+        """
+        Return ( hits, misses ) of the selection cache, None if the
+        selector has no cache.
+        """
+        return None
+
+    def get_tier_stats( self ) :
+        """
+        Return ( exact, fuzzy, fuzzy selected ) numbers of reads of a
+        Tiered_selector, None for other selectors.
+        """
+        return None
+
+    def pop_stats( self ) :
+        """
+        Return the counters updated since the last call and reset them,
+        None if the selector has no counter. Worker processes send them
+        to the selector of the main process which calls add_stats.
+        """
+        return None
+
+    def add_stats( self, stats ) :
+        """
+        Add counters returned by pop_stats of another selector.
+        """
+        pass
+
 
 class Levenshtein_selector( Selector ) :
+    """
+    Select the adaptator with the best Levenshtein ratio.
+
+    distance is a Distance_backend, by default the one returned by
+    get_distance_backend( "levenshtein" ).
+
+    If cache_size is not 0, the selections are kept in a Lru_cache of
+    cache_size starts of sequence (or pairs of starts in paired-end), as
+    long as the longest adaptator.
+    """
     table_adaptator = None
     single_end = False
     rate = 0
-    def __init__( self, table_adaptator, single_end, rate ) :
+    cache = None
+    def __init__( self, table_adaptator, single_end, rate, cache_size=0, distance=None ) :
         if not isinstance( rate, float ) :
             raise ValueError( "rate argument must be a float not %s" % type( rate ) )
         Selector.__init__( self, table_adaptator, single_end)
         self.rate = rate
+        if distance is None :
+            distance = get_distance_backend()
+        self.distance = distance
+        self.ratios = [ ( len( line[ 0 ] ), distance.compile( line[ 0 ] ) ) for line in table_adaptator ]
+        if cache_size :
+            self.cache = Lru_cache( cache_size )
+            self.key_length = max( [ len( line[ 0 ] ) for line in table_adaptator ] or [ 0 ] )
+            self._uncached_select = self.select
+            if single_end :
+                self.select = self._cached_single_select
+            else :
+                self.select = self._cached_paired_select
+
+    def _cached_single_select( self, sequence ) :
+        key = sequence[ : self.key_length ]
+        line = self.cache.get( key, _missing )
+        if line is _missing :
+            line = self._uncached_select( key )
+            self.cache.put( key, line )
+        return line
+
+    def _cached_paired_select( self, sequence_1, sequence_2 ) :
+        key = ( sequence_1[ : self.key_length ], sequence_2[ : self.key_length ] )
+        line = self.cache.get( key, _missing )
+        if line is _missing :
+            line = self._uncached_select( *key )
+            self.cache.put( key, line )
+        return line
+
+    def get_cache_stats( self ) :
+        if self.cache is None :
+            return None
+        return ( self.cache.hits, self.cache.misses )
+
+    def _has_candidate( self, sequence ) :
+        for length, ratio in self.ratios :
+            if ratio( sequence[ : length ] ) >= self.rate :
+                return True
+        return False
+
+    def pop_stats( self ) :
+        stats = self.get_cache_stats()
+        if stats is not None :
+            self.cache.hits = self.cache.misses = 0
+        return stats
+
+    def add_stats( self, stats ) :
+        self.cache.hits += stats[ 0 ]
+        self.cache.misses += stats[ 1 ]
 
     def _single_select( self, sequence) :
-        from Levenshtein import ratio
-        
         distances = []
-        for (adaptator, output_file) in self.table_adaptator :
-            dist = ratio( adaptator, sequence[ : len( adaptator ) ] )
+        for line, (length, ratio) in izip( self.table_adaptator, self.ratios ) :
+            dist = ratio( sequence[ : length ] )
             if dist == 1.0 :
-                return (adaptator, output_file)
+                return line
         
             distances.append( dist )
         
@@ -124,16 +344,12 @@ class Levenshtein_selector( Selector ) :
         return None
 
     def _paired_select( self, sequence_1, sequence_2) :
-        from Levenshtein import ratio
         distances_1 = []
         distances_2 = []
 
-        for line in self.table_adaptator :
-            adaptator = line[ 0 ]
-            dist_1 = ratio( adaptator, sequence_1[ : len( adaptator ) ] )
-            dist_2 = ratio( adaptator, sequence_2[ : len( adaptator ) ] )        
-            distances_1.append( dist_1 )
-            distances_2.append( dist_2 )
+        for length, ratio in self.ratios :
+            distances_1.append( ratio( sequence_1[ : length ] ) )
+            distances_2.append( ratio( sequence_2[ : length ] ) )
 
         max_dist_1 = max( distances_1 )
         max_dist_2 = max( distances_2 )
@@ -171,16 +387,12 @@ class LevenshteinAllSelector( Levenshtein_selector ) :
     """
 
     def _paired_select( self, sequence_1, sequence_2) :
-        from Levenshtein import ratio
         distances_1 = []
         distances_2 = []
 
-        for line in self.table_adaptator :
-            adaptator = line[ 0 ]
-            dist_1 = ratio( adaptator, sequence_1[ : len( adaptator ) ] )
-            dist_2 = ratio( adaptator, sequence_2[ : len( adaptator ) ] )        
-            distances_1.append( dist_1 )
-            distances_2.append( dist_2 )
+        for length, ratio in self.ratios :
+            distances_1.append( ratio( sequence_1[ : length ] ) )
+            distances_2.append( ratio( sequence_2[ : length ] ) )
 
         max_dist_1 = max( distances_1 )
         max_dist_2 = max( distances_2 )
@@ -194,6 +406,232 @@ class LevenshteinAllSelector( Levenshtein_selector ) :
         else :
             return None
 
+class Numpy_hamming_selector( Selector ) :
+    """
+    Same rules as Levenshtein_selector (or LevenshteinAllSelector if
+    all_members is True) but the ratio is the proportion of identical
+    bases between the adaptator and the start of the sequence.
+
+    All adaptators must have the same length. The ratios of a batch of
+    sequences against all adaptators are computed at once with numpy.
+    """
+    def __init__( self, table_adaptator, single_end, rate, all_members=False ) :
+        import numpy
+        if not isinstance( rate, float ) :
+            raise ValueError( "rate argument must be a float not %s" % type( rate ) )
+        lengths = set( [ len( line[ 0 ] ) for line in table_adaptator ] )
+        if len( lengths ) > 1 :
+            raise ValueError( "adaptators must have the same length, found lengths %s" % ", ".join( map( str, sorted( lengths ) ) ) )
+        Selector.__init__( self, table_adaptator, single_end )
+        self.numpy = numpy
+        self.rate = rate
+        self.all_members = all_members
+        self.length = lengths.pop() if lengths else 0
+        self.adaptators = numpy.fromstring( "".join( [ line[ 0 ] for line in table_adaptator ] ),
+                                            dtype=numpy.uint8 ).reshape( len( table_adaptator ), self.length )
+
+    def _single_select( self, sequence ) :
+        return self.select_batch( [ sequence ] )[ 0 ]
+
+    def _paired_select( self, sequence_1, sequence_2 ) :
+        return self.select_batch( [ sequence_1 ], [ sequence_2 ] )[ 0 ]
+
+    def _has_candidate( self, sequence ) :
+        if not len( self.adaptators ) :
+            return False
+        return self.get_best( [ sequence ] )[ 0 ][ 0 ] >= self.rate
+
+    def get_identities( self, sequences ) :
+        """
+        Return a matrix with the number of identical bases between each
+        sequence (row) and each adaptator (column). Missing bases of
+        short sequences are mismatches.
+        """
+        numpy = self.numpy
+        starts = "".join( [ sequence[ : self.length ].ljust( self.length, "\0" ) for sequence in sequences ] )
+        starts = numpy.fromstring( starts, dtype=numpy.uint8 ).reshape( len( sequences ), self.length )
+        identities = numpy.zeros( ( len( sequences ), len( self.adaptators ) ), dtype=numpy.int16 )
+        for pos in xrange( self.length ) :
+            identities += starts[ :, pos, None ] == self.adaptators[ None, :, pos ]
+        return identities
+
+    def get_best( self, sequences ) :
+        """
+        Return the best ratio of each sequence, the number of adaptators
+        with this ratio and the index of the first of them.
+        """
+        identities = self.get_identities( sequences )
+        best = identities.max( axis=1 )
+        nb_best = ( identities == best[ :, None ] ).sum( axis=1 )
+        return best / float( self.length ), nb_best, identities.argmax( axis=1 )
+
+    def select_batch( self, sequences_1, sequences_2=None ) :
+        numpy = self.numpy
+        if not sequences_1 or not len( self.adaptators ) :
+            return [ None ] * len( sequences_1 )
+
+        ratio_1, nb_best_1, index_1 = self.get_best( sequences_1 )
+        if sequences_2 is None :
+            selected = ( ratio_1 == 1.0 ) | ( ( ratio_1 >= self.rate ) & ( nb_best_1 == 1 ) )
+            index = index_1
+
+        else :
+            ratio_2, nb_best_2, index_2 = self.get_best( sequences_2 )
+            if self.all_members :
+                selected = ( ( ratio_1 >= self.rate ) & ( ratio_2 >= self.rate )
+                             & ( nb_best_1 == 1 ) & ( nb_best_2 == 1 ) & ( index_1 == index_2 ) )
+                index = index_1
+            else :
+                selected = ( ( ( ratio_1 > ratio_2 ) & ( ratio_1 >= self.rate ) & ( nb_best_1 == 1 ) )
+                             | ( ( ratio_1 < ratio_2 ) & ( ratio_2 >= self.rate ) & ( nb_best_2 == 1 ) )
+                             | ( ( ratio_1 == ratio_2 ) & ( ratio_1 >= self.rate )
+                                 & ( ( nb_best_1 == 1 ) | ( nb_best_2 == 1 ) ) & ( index_1 == index_2 ) ) )
+                index = numpy.where( ratio_1 < ratio_2, index_2, index_1 )
+
+        table = self.table_adaptator
+        return [ table[ i ] if ok else None for ok, i in izip( selected.tolist(), index.tolist() ) ]
+
+
+class Tiered_selector( Selector ) :
+    """
+    Look first for adaptators which start exactly the sequences, with a
+    hash table as fast as Std_selector, and ask fuzzy (a
+    Levenshtein_selector, LevenshteinAllSelector or Numpy_hamming_selector
+    of the same table_adaptator) only when no adaptator is exact.
+
+    An exact adaptator has the best ratio, 1.0, so selections are the
+    ones of fuzzy alone. all_members must be True if fuzzy checks both
+    members of the pairs, then a pair with only one exact member is
+    given to fuzzy.
+
+    The counters tell how many reads the exact tier decided, how many
+    were given to fuzzy and how many of these fuzzy selected.
+    """
+    def __init__( self, fuzzy, single_end, all_members=False ) :
+        Selector.__init__( self, fuzzy.table_adaptator, single_end )
+        self.fuzzy = fuzzy
+        self.rate = fuzzy.rate
+        self.all_members = all_members
+        self.nb_exact = self.nb_fuzzy = self.nb_fuzzy_selected = 0
+        self.index = {}
+        for i, line in enumerate( self.table_adaptator ) :
+            self.index.setdefault( line[ 0 ], [] ).append( i )
+        self.lengths = sorted( set( [ len( adaptator ) for adaptator in self.index ] ) )
+
+    def get_exact( self, sequence ) :
+        """
+        Return the sorted indexes in table_adaptator of the adaptators
+        which start sequence.
+        """
+        hits = []
+        for length in self.lengths :
+            if length > len( sequence ) :
+                # the start of a short sequence would be found again.
+                break
+            indexes = self.index.get( sequence[ : length ] )
+            if indexes is not None :
+                hits.extend( indexes )
+        hits.sort()
+        return hits
+
+    def _exact_single_select( self, sequence ) :
+        """
+        Return the line of the exact adaptator, _missing if there is none.
+        """
+        hits = self.get_exact( sequence )
+        if not hits :
+            return _missing
+        return self.table_adaptator[ hits[ 0 ] ]
+
+    def _exact_paired_select( self, sequence_1, sequence_2 ) :
+        """
+        Same rules as the _paired_select of fuzzy when at least one
+        member is exact, _missing if the pair needs fuzzy.
+        """
+        hits_1 = self.get_exact( sequence_1 )
+        hits_2 = self.get_exact( sequence_2 )
+        if hits_1 and hits_2 :
+            if self.all_members :
+                unique = len( hits_1 ) == len( hits_2 ) == 1
+            else :
+                unique = len( hits_1 ) == 1 or len( hits_2 ) == 1
+            if unique and hits_1[ 0 ] == hits_2[ 0 ] :
+                return self.table_adaptator[ hits_1[ 0 ] ]
+            return None
+
+        hits = hits_1 or hits_2
+        if not hits or self.all_members :
+            return _missing
+        if len( hits ) == 1 :
+            return self.table_adaptator[ hits[ 0 ] ]
+        return None
+
+    def _count( self, nb_exact, lines ) :
+        self.nb_exact += nb_exact
+        self.nb_fuzzy += len( lines )
+        for line in lines :
+            if line is not None :
+                self.nb_fuzzy_selected += 1
+
+    def _single_select( self, sequence ) :
+        line = self._exact_single_select( sequence )
+        if line is _missing :
+            line = self.fuzzy.select( sequence )
+            self._count( 0, [ line ] )
+        else :
+            self.nb_exact += 1
+        return line
+
+    def _paired_select( self, sequence_1, sequence_2 ) :
+        line = self._exact_paired_select( sequence_1, sequence_2 )
+        if line is _missing :
+            line = self.fuzzy.select( sequence_1, sequence_2 )
+            self._count( 0, [ line ] )
+        else :
+            self.nb_exact += 1
+        return line
+
+    def select_batch( self, sequences_1, sequences_2=None ) :
+        if sequences_2 is None :
+            lines = map( self._exact_single_select, sequences_1 )
+        else :
+            lines = map( self._exact_paired_select, sequences_1, sequences_2 )
+        misses = [ i for i, line in enumerate( lines ) if line is _missing ]
+        fuzzy_lines = []
+        if misses :
+            if sequences_2 is None :
+                fuzzy_lines = self.fuzzy.select_batch( [ sequences_1[ i ] for i in misses ] )
+            else :
+                fuzzy_lines = self.fuzzy.select_batch( [ sequences_1[ i ] for i in misses ],
+                                                       [ sequences_2[ i ] for i in misses ] )
+            for i, line in izip( misses, fuzzy_lines ) :
+                lines[ i ] = line
+        self._count( len( lines ) - len( misses ), fuzzy_lines )
+        return lines
+
+    def _has_candidate( self, sequence ) :
+        return self.fuzzy._has_candidate( sequence )
+
+    def get_cache_stats( self ) :
+        return self.fuzzy.get_cache_stats()
+
+    def get_tier_stats( self ) :
+        return ( self.nb_exact, self.nb_fuzzy, self.nb_fuzzy_selected )
+
+    def pop_stats( self ) :
+        stats = ( self.get_tier_stats(), self.fuzzy.pop_stats() )
+        self.nb_exact = self.nb_fuzzy = self.nb_fuzzy_selected = 0
+        return stats
+
+    def add_stats( self, stats ) :
+        tier_stats, fuzzy_stats = stats
+        self.nb_exact += tier_stats[ 0 ]
+        self.nb_fuzzy += tier_stats[ 1 ]
+        self.nb_fuzzy_selected += tier_stats[ 2 ]
+        if fuzzy_stats is not None :
+            self.fuzzy.add_stats( fuzzy_stats )
+
+
 class Std_selector( Selector ):
     """
     Dichotomic search in list_adaptator
@@ -238,53 +676,683 @@ class Std_selector( Selector ):
             return self.table_adaptator[ m ]
         return None
 
+    def _has_candidate( self, sequence ) :
+        return self._single_select( sequence ) is not None
+
+
+class Hamming_selector( Std_selector ) :
+    """
+    Look for the start of the sequence in a hash table which contains
+    every sequence with at most max_mismatch substitutions from an
+    adaptator.
+
+    The neighbourhoods are computed once. A neighbour is assigned to the
+    closest adaptator, when two adaptators are as close as each other the
+    neighbour is ambiguous and select nothing.
+
+    In paired-end, members are combined as in Std_selector.
+    """
+    alphabet = "ACGTN"
+
+    def __init__( self, table_adaptator, single_end, max_mismatch=1 ) :
+        if not isinstance( max_mismatch, int ) or max_mismatch < 0 :
+            raise ValueError( "max_mismatch argument must be a positive int not %r" % max_mismatch )
+        Std_selector.__init__( self, table_adaptator, single_end )
+        self.max_mismatch = max_mismatch
+        self.index = {}
+        lengths = set()
+        for line in table_adaptator :
+            adaptator = line[ 0 ]
+            lengths.add( len( adaptator ) )
+            for neighbour, nb_mismatch in self.get_neighbours( adaptator ) :
+                known = self.index.get( neighbour )
+                if known is None or nb_mismatch < known[ 0 ] :
+                    self.index[ neighbour ] = ( nb_mismatch, line )
+                elif nb_mismatch == known[ 0 ] and ( known[ 1 ] is None or known[ 1 ][ 0 ] != adaptator ) :
+                    self.index[ neighbour ] = ( nb_mismatch, None )
+        self.lengths = sorted( lengths, reverse=True )
+
+    def get_neighbours( self, adaptator ) :
+        """
+        Yield ( neighbour, nb_mismatch ) for all sequences with at most
+        max_mismatch substitutions from adaptator.
+        """
+        for nb_mismatch in range( self.max_mismatch + 1 ) :
+            for positions in combinations( range( len( adaptator ) ), nb_mismatch ) :
+                choices = [ [ base for base in self.alphabet if base != adaptator[ pos ] ]
+                            for pos in positions ]
+                for bases in product( *choices ) :
+                    neighbour = list( adaptator )
+                    for pos, base in izip( positions, bases ) :
+                        neighbour[ pos ] = base
+                    yield "".join( neighbour ), nb_mismatch
+
+    def _single_select( self, sequence ) :
+        found = None
+        for length in self.lengths :
+            if length > len( sequence ) :
+                # the start of a short sequence would be found again.
+                continue
+            hit = self.index.get( sequence[ : length ] )
+            if hit is not None :
+                if found is None or hit[ 0 ] < found[ 0 ] :
+                    found = hit
+                elif hit[ 0 ] == found[ 0 ] :
+                    found = ( hit[ 0 ], None )
+
+        if found is None :
+            return None
+        return found[ 1 ]
+
+    def _has_candidate( self, sequence ) :
+        for length in self.lengths :
+            if sequence[ : length ] in self.index :
+                return True
+        return False
+
+
+class Offset_selector( Hamming_selector ) :
+    """
+    Same as Hamming_selector but the adaptator can start after a spacer
+    of 0 to max_offset bases, as in phased libraries. Each start of the
+    window is looked up in the hash table of the neighbourhoods, so the
+    cost by read depends on max_offset and on the number of lengths of
+    adaptators, not on the number of adaptators.
+
+    The adaptator with the fewest substitutions wins, at the smallest
+    offset. Different adaptators with the fewest substitutions are
+    ambiguous and select nothing, even at different offsets.
+
+    cut removes the spacer with the adaptator. The results of find are
+    kept for the sequences of the last batch, so is_exact and cut do not
+    search the window again.
+    """
+    def __init__( self, table_adaptator, single_end, max_mismatch=0, max_offset=0 ) :
+        if not isinstance( max_offset, int ) or max_offset < 0 :
+            raise ValueError( "max_offset argument must be a positive int not %r" % max_offset )
+        Hamming_selector.__init__( self, table_adaptator, single_end, max_mismatch )
+        self.offsets = range( max_offset + 1 )
+        self.window = max_offset + max( self.lengths or [ 0 ] )
+        self.max_found = 65536
+        self._found = {}
+
+    def find( self, sequence ) :
+        """
+        Return ( nb_mismatch, offset, line ) of the best adaptator in the
+        window of sequence, line is None if it is ambiguous. Return None
+        if there is no adaptator.
+        """
+        key = sequence[ : self.window ]
+        found = self._found.get( key, _missing )
+        if found is not _missing :
+            return found
+        found = None
+        index = self.index
+        for offset in self.offsets :
+            for length in self.lengths :
+                hit = index.get( key[ offset : offset + length ] )
+                if hit is not None :
+                    if found is None or hit[ 0 ] < found[ 0 ] :
+                        found = ( hit[ 0 ], offset, hit[ 1 ] )
+                    elif hit[ 0 ] == found[ 0 ] and hit[ 1 ] is not found[ 2 ] :
+                        found = ( found[ 0 ], found[ 1 ], None )
+        if len( self._found ) >= self.max_found :
+            self._found.clear()
+        self._found[ key ] = found
+        return found
+
+    def select_batch( self, sequences_1, sequences_2=None ) :
+        # only the windows of this batch are kept for is_exact and cut.
+        self._found.clear()
+        return Hamming_selector.select_batch( self, sequences_1, sequences_2 )
+
+    def _single_select( self, sequence ) :
+        found = self.find( sequence )
+        if found is None :
+            return None
+        return found[ 2 ]
+
+    def _has_candidate( self, sequence ) :
+        return self.find( sequence ) is not None
+
+    def is_exact( self, line, *sequences ) :
+        for sequence in sequences :
+            found = self.find( sequence )
+            if found is not None and found[ 0 ] == 0 and found[ 2 ] is line :
+                return True
+        return False
+
+    def cut( self, line, *reads ) :
+        """
+        Remove the spacer and the adaptator of line from the start of
+        reads. A member of a pair where line is not found has no spacer.
+        """
+        for read in reads :
+            offset = 0
+            found = self.find( read.seq )
+            if found is not None and found[ 2 ] is line :
+                offset = found[ 1 ]
+            read.cut_start( offset + len( line[ 0 ] ) )
+
+
+class Trie_selector( Std_selector ) :
+    """
+    Walk a prefix tree of the adaptators along the start of the sequence
+    and select the longest adaptator found, so adaptators which are a
+    prefix of another one are not a problem.
+
+    With max_mismatch > 0, the tree is searched for adaptators with at
+    most max_mismatch substitutions, a branch is left as soon as it has
+    too many substitutions. The adaptator with the fewest substitutions
+    wins, then the longest. Two adaptators with the same length and
+    number of substitutions are ambiguous and select nothing.
+
+    In paired-end, members are combined as in Std_selector.
+    """
+    def __init__( self, table_adaptator, single_end, max_mismatch=0 ) :
+        if not isinstance( max_mismatch, int ) or max_mismatch < 0 :
+            raise ValueError( "max_mismatch argument must be a positive int not %r" % max_mismatch )
+        Std_selector.__init__( self, table_adaptator, single_end )
+        self.max_mismatch = max_mismatch
+        # A node is [ { base : child_node }, line or None ]
+        self.root = [ {}, None ]
+        for line in table_adaptator :
+            node = self.root
+            for base in line[ 0 ] :
+                node = node[ 0 ].setdefault( base, [ {}, None ] )
+            if node[ 1 ] is None :
+                node[ 1 ] = line
+        if max_mismatch :
+            self._single_select = self._approximate_select
+            if single_end :
+                self.select = self._approximate_select
+
+    def _single_select( self, sequence ) :
+        found = None
+        node = self.root
+        for base in sequence :
+            node = node[ 0 ].get( base )
+            if node is None :
+                break
+            if node[ 1 ] is not None :
+                found = node[ 1 ]
+        return found
+
+    def _approximate_select( self, sequence ) :
+        # An exact match has the fewest substitutions
+        found = Trie_selector._single_select( self, sequence )
+        if found is not None :
+            return found
+
+        found, ambiguous = self._approximate_search( sequence )
+        if ambiguous :
+            return None
+        return found
+
+    def _has_candidate( self, sequence ) :
+        if Trie_selector._single_select( self, sequence ) is not None :
+            return True
+        if self.max_mismatch :
+            return self._approximate_search( sequence )[ 0 ] is not None
+        return False
+
+    def _approximate_search( self, sequence ) :
+        """
+        Return ( line, ambiguous ) for the adaptator with the fewest
+        substitutions then the longest, line is None if there is no
+        adaptator with at most max_mismatch substitutions.
+        """
+        found = None
+        best = ( self.max_mismatch, 1 )
+        ambiguous = False
+        stack = [ ( self.root, 0, 0 ) ]
+        while stack :
+            node, depth, nb_mismatch = stack.pop()
+            if node[ 1 ] is not None :
+                score = ( nb_mismatch, -depth )
+                if score < best :
+                    best = score
+                    found = node[ 1 ]
+                    ambiguous = False
+                elif score == best :
+                    ambiguous = True
+
+            if depth < len( sequence ) :
+                base = sequence[ depth ]
+                for child_base, child in node[ 0 ].iteritems() :
+                    cost = nb_mismatch
+                    if child_base != base :
+                        cost += 1
+                    if cost <= best[ 0 ] :
+                        stack.append( ( child, depth + 1, cost ) )
+
+        return found, ambiguous
+
+
+class Dual_selector( Selector ) :
+    """
+    Paired-end selector for dual barcodes, table_adaptator is like :
+       [ ( (barcode-1, barcode-2), output-file-A1, output-file-B1 ),
+                ...
+        ]
+
+    The first sequence is looked for among the barcode-1 and the second
+    among the barcode-2, each with a Hamming_selector allowing
+    max_mismatch substitutions. The line is then found in a table
+    indexed by both barcodes.
+
+    Pairs of barcodes which are not in table_adaptator select nothing
+    and are counted in unexpected.
+    """
+    def __init__( self, table_adaptator, single_end, max_mismatch=0 ) :
+        if single_end :
+            raise ValueError( "dual barcodes need paired-end sequences" )
+        Selector.__init__( self, table_adaptator, single_end )
+        self.lines = {}
+        for line in table_adaptator :
+            self.lines.setdefault( line[ 0 ], line )
+        self.selector_1 = Hamming_selector( [ ( barcode, ) for barcode in sorted( set( [ pair[ 0 ] for pair in self.lines ] ) ) ],
+                                            True, max_mismatch )
+        self.selector_2 = Hamming_selector( [ ( barcode, ) for barcode in sorted( set( [ pair[ 1 ] for pair in self.lines ] ) ) ],
+                                            True, max_mismatch )
+        self.unexpected = {}
+
+    def _paired_select( self, sequence_1, sequence_2 ) :
+        barcode_1 = self.selector_1.select( sequence_1 )
+        if barcode_1 is None :
+            return None
+        barcode_2 = self.selector_2.select( sequence_2 )
+        if barcode_2 is None :
+            return None
+
+        pair = ( barcode_1[ 0 ], barcode_2[ 0 ] )
+        line = self.lines.get( pair )
+        if line is None :
+            self.unexpected[ pair ] = self.unexpected.get( pair, 0 ) + 1
+        return line
+
+    def cut( self, line, read_1, read_2 ) :
+        barcode_1, barcode_2 = line[ 0 ]
+        read_1.cut_start( len( barcode_1 ) )
+        read_2.cut_start( len( barcode_2 ) )
+
+    def is_exact( self, line, sequence_1, sequence_2 ) :
+        barcode_1, barcode_2 = line[ 0 ]
+        return sequence_1.startswith( barcode_1 ) and sequence_2.startswith( barcode_2 )
+
+    def is_ambiguous( self, sequence_1, sequence_2 ) :
+        for selector, sequence in ( ( self.selector_1, sequence_1 ), ( self.selector_2, sequence_2 ) ) :
+            if selector.select( sequence ) is None and selector.is_ambiguous( sequence ) :
+                return True
+        return False
+
+    def pop_stats( self ) :
+        stats = self.unexpected
+        self.unexpected = {}
+        return stats
+
+    def add_stats( self, stats ) :
+        for pair, nb_reads in stats.iteritems() :
+            self.unexpected[ pair ] = self.unexpected.get( pair, 0 ) + nb_reads
+
+
+class Adapter_3_finder( object ) :
+    """
+    Look for a 3' adapter in sequences, as cutadapt -a does but with
+    substitutions only: the adapter can be anywhere in the sequence or
+    be cut by the end of the sequence if at least overlap bases remain.
+    An alignment of n bases accepts int( error_rate * n ) substitutions.
+
+    The whole adapter is looked for with seeds: with at most k
+    substitutions, one of k + 1 segments of the adapter is found exactly.
+    """
+    def __init__( self, adapter, overlap=7, error_rate=0.1 ) :
+        if not adapter :
+            raise ValueError( "adapter can not be empty" )
+        self.adapter = adapter
+        self.overlap = max( 1, min( overlap, len( adapter ) ) )
+        self.error_rate = error_rate
+        self.max_errors = int( error_rate * len( adapter ) )
+        nb_seeds = min( self.max_errors + 1, len( adapter ) )
+        size = len( adapter ) // nb_seeds
+        self.seeds = []
+        for i in xrange( nb_seeds ) :
+            end = ( i + 1 ) * size
+            if i == nb_seeds - 1 :
+                end = len( adapter )
+            self.seeds.append( ( adapter[ i * size : end ], i * size ) )
+
+    def get_errors( self, sequence, start, length ) :
+        """
+        Return the number of substitutions between the length first
+        bases of the adapter and sequence from start.
+        """
+        errors = 0
+        for a, b in izip( self.adapter[ : length ], sequence[ start : start + length ] ) :
+            if a != b :
+                errors += 1
+        return errors
+
+    def find( self, sequence ) :
+        """
+        Return the leftmost start of the adapter in sequence or None.
+        """
+        adapter = self.adapter
+        best = sequence.find( adapter )
+        if best < 0 :
+            best = None
+        last_start = len( sequence ) - len( adapter )
+
+        if self.max_errors :
+            for seed, offset in self.seeds :
+                position = sequence.find( seed )
+                while position >= 0 :
+                    start = position - offset
+                    if best is not None and start >= best :
+                        break
+                    if 0 <= start <= last_start and self.get_errors( sequence, start, len( adapter ) ) <= self.max_errors :
+                        best = start
+                        break
+                    position = sequence.find( seed, position + 1 )
+
+        if best is not None :
+            return best
+
+        for start in xrange( max( 0, last_start + 1 ), len( sequence ) - self.overlap + 1 ) :
+            length = len( sequence ) - start
+            max_errors = int( self.error_rate * length )
+            if not max_errors :
+                if adapter.startswith( sequence[ start : ] ) :
+                    return start
+                continue
+
+            # one of max_errors + 1 parts is exact if there are at most max_errors substitutions
+            size = length // ( max_errors + 1 )
+            for part in xrange( 0, size * ( max_errors + 1 ), size ) :
+                if adapter[ part : part + size ] == sequence[ start + part : start + part + size ] :
+                    if self.get_errors( sequence, start, length ) <= max_errors :
+                        return start
+                    break
+        return None
+
+
+class Read_stage( object ) :
+    """
+    Abstract stage applied to demultiplexed reads before they are
+    written.
+
+    A call to stage( reads ), where reads are the members of a pair or
+    a single read, returns None if the stage did nothing, otherwise
+    ( event, keep ). event is counted by sample and the reads are not
+    written if keep is False.
+    """
+    def __call__( self, reads ) :
+        raise NotImplementedError
+
+
+class Adapter_3_trimmer( Read_stage ) :
+    """
+    Remove a 3' adapter and what follows, adapters[ i ] is used for
+    the member i of the pair, the last one for next members.
+    Reads which are only an adapter are dropped.
+    """
+    def __init__( self, adapters, overlap=7, error_rate=0.1 ) :
+        self.finders = [ Adapter_3_finder( adapter, overlap, error_rate ) for adapter in adapters ]
+
+    def __call__( self, reads ) :
+        event = None
+        for i, read in enumerate( reads ) :
+            start = self.finders[ min( i, len( self.finders ) - 1 ) ].find( read.seq )
+            if start is not None :
+                if start == 0 :
+                    return ( "adapter-3-only", False )
+                read.cut_end( len( read ) - start )
+                event = ( "adapter-3-trimmed", True )
+        return event
+
+
+class Mean_quality_filter( Read_stage ) :
+    """
+    Drop reads with a mean quality lower than min_mean, qualities are
+    encoded from the ascii code ascii (33 for Sanger and Illumina 1.8+,
+    64 for Illumina 1.3 and 1.5).
+    """
+    def __init__( self, min_mean, ascii=33 ) :
+        self.min_mean = min_mean
+        self.ascii = ascii
+
+    def __call__( self, reads ) :
+        for read in reads :
+            qual = read.qual
+            if sum( bytearray( qual ) ) < ( self.min_mean + self.ascii ) * len( qual ) :
+                return ( "low-mean-quality", False )
+        return None
+
+
+class Min_length_filter( Read_stage ) :
+    """
+    Drop reads shorter than min_length.
+    """
+    def __init__( self, min_length ) :
+        self.min_length = min_length
+
+    def __call__( self, reads ) :
+        for read in reads :
+            if len( read ) < self.min_length :
+                return ( "too-short", False )
+        return None
+
 
-def get_adapt_counter( opened_adapt_file ) :
+def apply_stages( stages, reads ) :
     """
-    Return a hash where keys are the adaptators
+    Apply stages to reads until one drops them.
+    Return ( keep, events ).
+    """
+    events = []
+    for stage in stages :
+        result = stage( reads )
+        if result is not None :
+            event, keep = result
+            events.append( event )
+            if not keep :
+                return False, events
+    return True, events
+
+
+def get_stages( user_args ) :
+    """
+    Return the list of stages asked by the user, in the order they are
+    applied: adapter trimming, mean quality then length.
+    """
+    stages = []
+    if user_args.adapter_3 :
+        stages.append( Adapter_3_trimmer( user_args.adapter_3,
+                                          user_args.adapter_3_overlap,
+                                          user_args.adapter_3_error_rate ) )
+    if user_args.min_mean_quality is not None :
+        stages.append( Mean_quality_filter( user_args.min_mean_quality, user_args.quality_ascii ) )
+    if user_args.min_length is not None :
+        stages.append( Min_length_filter( user_args.min_length ) )
+    return stages
+
+
+def count_events( stage_counts, name_tag, events ) :
+    """
+    Add events of a read to stage_counts, a hash ( name_tag, event ) -> count
+    """
+    for event in events :
+        key = ( name_tag, event )
+        stage_counts[ key ] = stage_counts.get( key, 0 ) + 1
+
+
+def split_adapt_line( line, opened_adapt_file ) :
+    """
+    Return ( adaptator, name_tag ) of a line of the adaptator file.
+
+    Lines have two columns, adaptator and name_tag, or three columns
+    for dual barcodes, then adaptator is a ( barcode_1, barcode_2 ) tuple.
+    """
+    fields = line.split()
+    if len( fields ) == 2 :
+        return fields[ 0 ], fields[ 1 ]
+    if len( fields ) == 3 :
+        if fields[ 0 ] == '*' :
+            return '*', fields[ 2 ]
+        return ( fields[ 0 ], fields[ 1 ] ), fields[ 2 ]
+    print >> sys.stderr, "File '%s' is malformed." %  opened_adapt_file.name
+    exit( 1 )
+
+
+def get_adapt_counter( opened_adapt_file, order=None ) :
+    """
+    Return a hash where keys are the adaptators (or pairs of barcodes)
     and values are initialized with [ name_tag, 0 ]
+
+    If order is a list, adaptators are appended to it in the order of
+    the file.
     """
     d = {}
     opened_adapt_file.seek(0)
     for line in opened_adapt_file :
         if not line.isspace() :
-            try :    
-                adapt, name_tag = line.split()
-            except ValueError :
-                print >> sys.stderr, "File '%s' is malformed." %  opened_adapt_file.name
-                exit( 1 )
+            adapt, name_tag = split_adapt_line( line, opened_adapt_file )
+            if order is not None and adapt not in d :
+                order.append( adapt )
             d[ adapt ] = [ name_tag, 0 ]
     return d
 
 
-def get_maximal_annalogie( file_adapt ) :
+def get_barcode_sets( table_adaptator ) :
     """
-    Compute maximal levenshtein between all adaptators
+    Return the ( name, barcodes ) of the sets of barcodes which are
+    selected apart in table_adaptator: all adaptators with name None, or
+    the barcodes 1 and 2 of dual barcodes.
     """
-    from Levenshtein import ratio
-    adaptators = []
-    for line in file_adapt :
-        if line :
-            (adapt, name) = line.split()
-            if adapt != "*" :           
-                adaptators.append( adapt )
-   
-    ratio_max = 0.0
-    for i, adapt in enumerate( adaptators ) :
-        for adapt2 in adaptators[i+1:] :
-            ratio_max = max( ratio_max,ratio( adapt, adapt2 ) )
-
-    return ratio_max
+    adaptators = [ line[ 0 ] for line in table_adaptator ]
+    if adaptators and isinstance( adaptators[ 0 ], tuple ) :
+        return [ ( "barcode %d" % ( member + 1 ), sorted( set( [ pair[ member ] for pair in adaptators ] ) ) )
+                 for member in ( 0, 1 ) ]
+    return [ ( None, sorted( set( adaptators ) ) ) ]
 
 
+def analyse_barcodes( barcodes, distance ) :
+    """
+    Return the analysis of barcodes for distance, one of the distances
+    of Distance_matrix, as a hash:
+
+    min        - smallest distance between two barcodes
+    budget     - number of differences ( min - 1 ) // 2: a read with at
+                 most budget differences from a barcode is closer to it
+                 than to any other. -1 for mismatches if a barcode is the
+                 start of another one
+    collisions - [ barcode_1, barcode_2, distance ] pairs which are too
+                 close for budget + 1 differences
+    max_ratio  - highest ratio between two barcodes, None for mismatches
+    rate       - ratio of a read with budget differences from the
+                 longest barcode, the lowest ratio of --levenshtein which
+                 keeps every read unambiguous. None for mismatches
+
+    min, budget and rate are None if there are less than two barcodes.
+    """
+    matrix = Distance_matrix( barcodes, distance )
+    analysis = { "min" : matrix.get_min(), "budget" : None, "collisions" : [],
+                 "max_ratio" : matrix.get_max_ratio(), "rate" : None }
+    if analysis[ "min" ] is None :
+        return analysis
+    budget = ( analysis[ "min" ] - 1 ) // 2
+    analysis[ "budget" ] = budget
+    analysis[ "collisions" ] = [ list( pair ) for pair in matrix.get_pairs( 2 * ( budget + 1 ) ) ]
+    max_length = max( map( len, barcodes ) )
+    if distance == "hamming" :
+        analysis[ "rate" ] = ( max_length - budget ) / float( max_length )
+    elif distance == "levenshtein" :
+        analysis[ "rate" ] = ( 2 * max_length - budget ) / float( 2 * max_length )
+    return analysis
+
+
+def get_barcode_analysis( adapt_path, barcodes, distance ) :
+    """
+    Return analyse_barcodes( barcodes, distance ), cached in
+    adapt_path.barcodes.json by distance and checksum of the barcodes.
+    The cache is written when it is possible.
+    """
+    import json
+    import hashlib
+    key = "%s %s" % ( distance, hashlib.md5( "\n".join( barcodes ) ).hexdigest() )
+    cache_path = adapt_path + ".barcodes.json"
+    cache = {}
+    if os.path.exists( cache_path ) :
+        try :
+            input = open( cache_path )
+            cache = json.load( input )
+            input.close()
+        except ( IOError, ValueError ) :
+            cache = {}
+    if key not in cache :
+        cache[ key ] = analyse_barcodes( barcodes, distance )
+        try :
+            write_json( cache_path, cache )
+        except ( IOError, OSError ) :
+            pass
+    return cache[ key ]
+
+
+def get_auto_rate( adapt_path, table_adaptator, distance ) :
+    """
+    Return the ratio of --levenshtein auto for the adaptators of
+    table_adaptator (read from adapt_path), see analyse_barcodes.
+    """
+    name, barcodes = get_barcode_sets( table_adaptator )[ 0 ]
+    rate = get_barcode_analysis( adapt_path, barcodes, distance )[ "rate" ]
+    if rate is None :
+        print >> sys.stderr, "Option --levenshtein auto needs at least two adaptors in '%s'." % adapt_path
+        sys.exit( 1 )
+    return rate
 
 
-def get_output_files( opened_adapt_file, prefix, paired_end=True ) :
+def print_barcode_analysis( opened_adapt_file, distance ) :
+    """
+    Print the analysis of the adaptators of opened_adapt_file for
+    mismatches and distance (not for dual barcodes, which are only
+    selected with mismatches).
+    """
+    table = get_adapt_table( opened_adapt_file )
+    barcode_sets = get_barcode_sets( table )
+    distances = [ "mismatches" ]
+    if len( barcode_sets ) == 1 :
+        distances.append( distance )
+    for name, barcodes in barcode_sets :
+        if name is not None :
+            print "%s:" % name
+        lengths = map( len, barcodes ) or [ 0 ]
+        print "%d adaptors of %d to %d bases" % ( len( barcodes ), min( lengths ), max( lengths ) )
+        for distance in distances :
+            analysis = get_barcode_analysis( opened_adapt_file.name, barcodes, distance )
+            if analysis[ "max_ratio" ] is not None :
+                print "Maximal %s ratio between adaptors is %f" % ( distance.capitalize(), analysis[ "max_ratio" ] )
+            if analysis[ "min" ] is None :
+                continue
+            if analysis[ "budget" ] < 0 :
+                message = "%s: smallest distance %d, reads can be ambiguous without difference" % ( distance, analysis[ "min" ] )
+            else :
+                message = "%s: smallest distance %d, reads with at most %d difference(s) are unambiguous" % ( distance, analysis[ "min" ], analysis[ "budget" ] )
+            if analysis[ "rate" ] is not None :
+                message += ", --levenshtein auto is %f" % analysis[ "rate" ]
+            print message
+            if analysis[ "collisions" ] :
+                print "adaptors too close for %d difference(s): %d pair(s)" % ( analysis[ "budget" ] + 1, len( analysis[ "collisions" ] ) )
+                for barcode_1, barcode_2, pair_distance in analysis[ "collisions" ] :
+                    print "%s\t%s\t%d" % ( barcode_1, barcode_2, pair_distance )
+
+
+def get_output_files( opened_adapt_file, prefix, paired_end=True, compress_threads=None, writer=None,
+                      interleaved=False, mode="w" ) :
     """
     Create output files and put them in a list:
 	
 	if paired_end is True, twa files by adaptator are created
 		[ (adaptator, output_file_1, output_file_2 ), ...  ]
+	adaptator is a ( barcode_1, barcode_2 ) tuple for dual barcodes.
 		
 	otherwise only one
 		 [ (adaptator, output_file ), ...  ]
@@ -293,26 +1361,48 @@ def get_output_files( opened_adapt_file, prefix, paired_end=True ) :
     Two trash files for paired-end, one for single-end
         
         ( table, (trash-file, ) )
-        
+
+    If compress_threads is not None, output files are gzip files compressed
+    with compress_threads threads.
+
+    If writer (a Fastq_writer) is given, output files are buffered and
+    written by its threads.
+
+    If interleaved is True, both members of pairs go to the same file
+    PREFIX-TAG.fastq, output_file_1 and output_file_2 are the same object.
+
+    Files are opened in mode, "a" to resume a run.
     """ 
     
 
+    extension = "fastq"
+    if compress_threads is not None :
+        extension = "fastq.gz"
+
+    def open_output( name ) :
+        if writer is not None :
+            return writer.open( name, mode, compress_threads or 1 )
+        return Fastq_file( name, mode, compress_threads or 1 )
+
+    def open_pair( suffix_file ) :
+        if interleaved :
+            output_file = open_output( "%s-%s.%s" % (prefix, suffix_file, extension) )
+            return output_file, output_file
+        return ( open_output( "%s-%s_1.%s" % (prefix, suffix_file, extension) ),
+                 open_output( "%s-%s_2.%s" % (prefix, suffix_file, extension) ) )
+
     ada_files = []
     default = None
     cache_name_file_by_adapt = {}
 
+    opened_adapt_file.seek(0)
     for line in opened_adapt_file :
         if not line.isspace() :
-                try :    
-                    adapt, suffix_file = line.split()
-                except ValueError :
-                    print >> sys.stderr, "File '%s' is malformed." %  opened_adapt_file.name
-                    exit( 1 )
+                adapt, suffix_file = split_adapt_line( line, opened_adapt_file )
 
                 if paired_end :
                     if line[0] == '*' :
-                        default = ( Fastq_file( "%s-%s_1.fastq" % (prefix, suffix_file), "w" ),
-                                    Fastq_file( "%s-%s_2.fastq" % (prefix, suffix_file), "w" ), )
+                        default = open_pair( suffix_file )
 
                     else :
                         if suffix_file in cache_name_file_by_adapt :
@@ -320,8 +1410,7 @@ def get_output_files( opened_adapt_file, prefix, paired_end=True ) :
                             ada_files.append( ( adapt, f1, f2 ) )
 
                         else :
-                            f1 = Fastq_file( "%s-%s_1.fastq" % (prefix, suffix_file), "w" )
-                            f2 = Fastq_file( "%s-%s_2.fastq" % (prefix, suffix_file), "w" )
+                            f1, f2 = open_pair( suffix_file )
                             ada_files.append( (adapt, f1, f2) )
                             cache_name_file_by_adapt[ suffix_file ] = (f1, f2)
 
@@ -329,25 +1418,1094 @@ def get_output_files( opened_adapt_file, prefix, paired_end=True ) :
                 else :
                     # TODO Make cache system for single mode.
                     if line[0] == '*' :
-                        default = ( Fastq_file( "%s-%s.fastq" % (prefix, suffix_file), "w" ) , )
+                        default = ( open_output( "%s-%s.%s" % (prefix, suffix_file, extension) ) , )
 
                     else :
                         if suffix_file in cache_name_file_by_adapt :
                             f1 = cache_name_file_by_adapt[ suffix_file ]
                             ada_files.append(  ( adapt, f1 ) )
                         else:
-                            f1 = Fastq_file( "%s-%s.fastq" % (prefix, suffix_file), "w" )
+                            f1 = open_output( "%s-%s.%s" % (prefix, suffix_file, extension) )
                             ada_files.append( ( adapt, f1 ) )
                             cache_name_file_by_adapt[ suffix_file ] = ( f1 )
                             
     if default is None :
         print >> sys.stderr, "File '%s' doesn't have a line with the joker tag *.\nAdd a line '*    tag_name_for_trash'." %  opened_adapt_file.name
         sys.exit(1)
+
+    nb_dual = len( [ line for line in ada_files if isinstance( line[ 0 ], tuple ) ] )
+    if nb_dual and nb_dual != len( ada_files ) :
+        print >> sys.stderr, "File '%s' mixes lines with one and two barcodes." %  opened_adapt_file.name
+        sys.exit(1)
+    if nb_dual and not paired_end :
+        print >> sys.stderr, "File '%s' has dual barcodes, they need paired-end files." %  opened_adapt_file.name
+        sys.exit(1)
     
     ada_files.sort()
     return ada_files, default
 
 
+def get_selector( user_args, table_adaptator ) :
+    """
+    Return the selector asked by the user for table_adaptator
+    """
+    if table_adaptator and isinstance( table_adaptator[ 0 ][ 0 ], tuple ) :
+        if user_args.levenshtein is not None or user_args.trie or user_args.max_offset :
+            print >> sys.stderr, "Dual barcodes can only be used with option --mismatches."
+            sys.exit( 1 )
+        return Dual_selector( table_adaptator,
+                              user_args.single_end,
+                              user_args.mismatches or 0 )
+
+    rate = user_args.levenshtein
+    if rate == "auto" :
+        rate = get_auto_rate( user_args.file_adapt.name, table_adaptator, user_args.distance )
+
+    if user_args.levenshtein and user_args.numpy :
+        try :
+            fuzzy = Numpy_hamming_selector( table_adaptator,
+                                            user_args.single_end,
+                                            rate,
+                                            user_args.all )
+        except ImportError :
+            print >> sys.stderr, "Option --numpy needs the numpy module."
+            sys.exit( 1 )
+        except ValueError, e :
+            print >> sys.stderr, "Option --numpy can not be used: %s." % e
+            sys.exit( 1 )
+        return Tiered_selector( fuzzy, user_args.single_end, user_args.all )
+
+    if user_args.levenshtein :
+        if user_args.all :
+            fuzzy = LevenshteinAllSelector( table_adaptator,
+                                            user_args.single_end,
+                                            rate,
+                                            user_args.cache_size,
+                                            user_args.distance_backend )
+        else :
+            fuzzy = Levenshtein_selector( table_adaptator,
+                                          user_args.single_end,
+                                          rate,
+                                          user_args.cache_size,
+                                          user_args.distance_backend )
+        # most reads start with an exact adaptator, fuzzy only gets the others.
+        return Tiered_selector( fuzzy, user_args.single_end, user_args.all )
+
+    if user_args.trie :
+        return Trie_selector( table_adaptator,
+                              user_args.single_end,
+                              user_args.mismatches or 0 )
+
+    if user_args.max_offset :
+        return Offset_selector( table_adaptator,
+                                user_args.single_end,
+                                user_args.mismatches or 0,
+                                user_args.max_offset )
+
+    if user_args.mismatches is not None :
+        return Hamming_selector( table_adaptator,
+                                 user_args.single_end,
+                                 user_args.mismatches )
+
+    return Std_selector( table_adaptator,
+                         user_args.single_end )
+
+
+def get_index_selector( user_args, table_adaptator, selectors=None ) :
+    """
+    Return the selector of get_selector for a table where the output
+    files of each line are replaced by the index of the line in
+    table_adaptator, such as ( adaptator, index, index ) in paired-end.
+    Only the adaptators of table_adaptator are used.
+
+    If selectors is a hash, selectors already built for the same
+    adaptators are taken from it and new ones are added to it.
+    """
+    adaptators = tuple( [ line[ 0 ] for line in table_adaptator ] )
+    key = ( adaptators, user_args.single_end )
+    if selectors is not None and key in selectors :
+        return selectors[ key ]
+    width = 1
+    if not user_args.single_end :
+        width = 2
+    selector = get_selector( user_args, [ ( adapt, ) + ( i, ) * width for i, adapt in enumerate( adaptators ) ] )
+    if selectors is not None :
+        selectors[ key ] = selector
+    return selector
+
+
+def get_batches( iterable, batch_size=4096 ) :
+    """
+    Yield lists of batch_size items of iterable, the last one can be
+    shorter.
+    """
+    iterator = iter( iterable )
+    while True :
+        batch = list( islice( iterator, batch_size ) )
+        if not batch :
+            return
+        yield batch
+
+
+_worker_selector = None
+_worker_verbose = False
+_worker_stages = []
+_worker_detailed = False
+_worker_interleaved = False
+
+def _init_worker( selector, verbose, stages=(), detailed=False, interleaved=False ) :
+    """
+    Keep the selector and the stages of a worker process in global
+    variables.
+    """
+    global _worker_selector, _worker_verbose, _worker_stages, _worker_detailed, _worker_interleaved
+    # the counters of the main process, restored from a checkpoint, are
+    # not the ones of the worker.
+    selector.pop_stats()
+    _worker_selector = selector
+    _worker_verbose = verbose
+    _worker_stages = stages
+    _worker_detailed = detailed
+    _worker_interleaved = interleaved
+
+
+def _select_batch( batch ) :
+    """
+    Run in worker process. batch is a tuple with one string of reads by
+    member of the pair, or one string of interleaved pairs.
+
+    Return ( results, messages, stats ) where results is a list of
+    ( index_in_table_adaptator, match, events, str_read_1, ... ). The
+    index is -1 for reads which go to the trash. match is None unless
+    detailed counts are asked, then it tells if the match is exact or
+    if the rejected reads are ambiguous. events are the events of the
+    stages, there is no read if a stage dropped them. stats are the
+    counters of the selector for this batch, see Selector.pop_stats.
+    """
+    results = []
+    messages = []
+    members = [ list( Fastq_reader( StringIO( str_reads ), len( str_reads ) + 1 ) ) for str_reads in batch ]
+    if _worker_interleaved :
+        members = [ members[ 0 ][ 0 : : 2 ], members[ 0 ][ 1 : : 2 ] ]
+    lines = _worker_selector.select_batch( *[ [ read.seq for read in reads ] for reads in members ] )
+    match = None
+    for reads, line in izip( izip( *members ), lines ) :
+        if line is None :
+            if _worker_verbose and len( reads ) == 1 :
+                messages.append( "Read '%s' start with %s... and go to *" % (reads[0].name, reads[0].seq[ : 14 ]) )
+            if _worker_detailed :
+                match = _worker_selector.is_ambiguous( *[ read.seq for read in reads ] )
+            results.append( [ -1, match, () ] + [ str( read ) for read in reads ] )
+
+        else :
+            (adapt, index) = line[ : 2 ]
+            if _worker_verbose and len( reads ) == 1 :
+                messages.append( "Read '%s' start with %s... and go to %s" % (reads[0].name, reads[0].seq[ : len( adapt ) ], adapt) )
+            if _worker_detailed :
+                match = _worker_selector.is_exact( line, *[ read.seq for read in reads ] )
+            _worker_selector.cut( line, *reads )
+            keep, events = apply_stages( _worker_stages, reads )
+            if keep :
+                results.append( [ index, match, events ] + [ str( read ) for read in reads ] )
+            else :
+                results.append( [ index, match, events ] )
+
+    return results, messages, _worker_selector.pop_stats()
+
+
+def get_inputs( user_args ) :
+    """
+    Return the input Fastq_file: fastq_1, and fastq_2 in paired-end
+    unless pairs are interleaved.
+    """
+    inputs = [ user_args.fastq_1 ]
+    if not user_args.single_end and not user_args.interleaved :
+        inputs.append( user_args.fastq_2 )
+    return inputs
+
+
+def get_rescue_inputs( user_args, name_trash ) :
+    """
+    Move the trash files PREFIX-NAME_TRASH of a finished run to
+    PATH.rescue and make them the inputs of user_args, the rescue run
+    writes the reads it still rejects in new trash files. Return the
+    moved paths, which are removed when the rescue is done.
+
+    Trash files are PREFIX-NAME_TRASH_1 and _2 in paired-end, the
+    interleaved pairs of PREFIX-NAME_TRASH with option interleaved
+    output, PREFIX-NAME_TRASH in single-end otherwise.
+
+    Raise IOError if a trash file is missing or if a previous rescue
+    did not finish.
+    """
+    extension = "fastq"
+    if user_args.compress_threads is not None :
+        extension = "fastq.gz"
+    trash = "%s-%s" % ( user_args.output_prefix, name_trash )
+    paths = [ "%s.%s" % ( trash, extension ) ]
+    if not user_args.interleaved_output and os.path.exists( "%s_1.%s" % ( trash, extension ) ) :
+        paths = [ "%s_1.%s" % ( trash, extension ), "%s_2.%s" % ( trash, extension ) ]
+    for path in paths :
+        if os.path.exists( path + ".rescue" ) :
+            raise IOError( "'%s.rescue' is left by a rescue which did not finish, "
+                           "its rescued reads are already in the sample files" % path )
+        if not os.path.isfile( path ) :
+            raise IOError( "trash file '%s' not found" % path )
+
+    moved = []
+    for path in paths :
+        os.rename( path, path + ".rescue" )
+        moved.append( path + ".rescue" )
+    user_args.fastq_1 = Fastq_file( moved[ 0 ], "r" )
+    user_args.fastq_2 = None
+    if len( moved ) == 2 :
+        user_args.fastq_2 = Fastq_file( moved[ 1 ], "r" )
+    user_args.interleaved = user_args.interleaved_output
+    user_args.single_end = len( moved ) == 1 and not user_args.interleaved
+    return moved
+
+
+def get_shard_prefix( prefix, shard ) :
+    """
+    Return the prefix of the output files of shard.
+    """
+    return "%s-shard%d" % ( prefix, shard )
+
+
+def get_shard_ranges( inputs, shard, nb_shards, interleaved=False ) :
+    """
+    Return ( first read, end read, ranges ) of shard (from 1 to
+    nb_shards), ranges are the ( start, end ) offsets of its reads in
+    each input.
+
+    The reads of fastq_1 are cut in nb_shards parts of close sizes with
+    its index (see index_fastq.py), the same reads are taken in fastq_2
+    and interleaved pairs are not cut. Last shards are empty when there
+    are fewer indexed reads than shards.
+
+    Raise ValueError if an input is not a regular file or if the inputs
+    do not have the same number of reads.
+    """
+    for fastq in inputs :
+        if fastq.path == "-" or not os.path.isfile( fastq.path ) :
+            raise ValueError( "'%s' is not a regular file" % fastq.path )
+    index = inputs[ 0 ].get_index()
+    for fastq in inputs[ 1 : ] :
+        if fastq.count_reads() != index.nb_reads :
+            raise ValueError( "'%s' and '%s' do not have the same number of reads" % ( inputs[ 0 ].path, fastq.path ) )
+    limits = [ first for start, end, first, nb_reads in index.split_ranges( nb_shards ) ]
+    limits += [ index.nb_reads ] * ( nb_shards + 1 - len( limits ) )
+    if interleaved :
+        limits = [ limit - limit % 2 for limit in limits ]
+    first, last = limits[ shard - 1 ], limits[ shard ]
+    return first, last, [ ( fastq.get_read_offset( first ), fastq.get_read_offset( last ) ) for fastq in inputs ]
+
+
+def get_pairs( readers ) :
+    """
+    Return an iterator of the pairs of reads of the paired-end input, read
+    from the readers of fastq_1 and fastq_2 or interleaved in the reader
+    of fastq_1.
+    """
+    if len( readers ) == 1 :
+        records = iter( readers[ 0 ] )
+        return izip( records, records )
+    return izip( *readers )
+
+
+def demultiplex_serial( user_args, selector, table_adaptator, defaults_files, nb_reads_writen,
+                        stages=(), stage_counts=None, report=None, checkpoint=None, ranges=None ) :
+    """
+    Demultiplex in the main process.
+
+    selector is a selector of get_index_selector, the reads selected for
+    a line go to the output files of the same line of table_adaptator.
+    Events of stages are added to stage_counts, times and matches to
+    report. ranges are the ( offset, end ) of each input, which is read
+    from its current position offset to end (None for its end).
+    checkpoint is saved between batches when it is due.
+    """
+    if report is None :
+        report = Run_report()
+
+    inputs = get_inputs( user_args )
+    if ranges is None :
+        ranges = [ ( 0, None ) ] * len( inputs )
+    readers = []
+    for fastq, ( offset, end ) in izip( inputs, ranges ) :
+        size = None
+        if end is not None :
+            size = end - offset
+        readers.append( fastq.records( offset=offset, size=size ) )
+
+    if user_args.single_end :
+        default_file = defaults_files[0]
+        outputs = [ line[ 1 ] for line in table_adaptator ]
+        batches = get_batches( readers[ 0 ] )
+        while True :
+            start = time.time()
+            reads = next( batches, None )
+            selected = time.time()
+            report.add_time( "parse", selected - start )
+            if reads is None :
+                break
+            lines = selector.select_batch( [ read.seq for read in reads ] )
+            start, selected = selected, time.time()
+            report.add_time( "select", selected - start )
+
+            for read, line in izip( reads, lines ) :
+                if line is None :
+                    if user_args.verbose :
+                        print "Read '%s' start with %s... and go to *" % (read.name, read.seq[ : 14 ])
+                    if report.detailed :
+                        report.count_selection( '*', selector.is_ambiguous( read.seq ) )
+                    default_file.write_record( read )
+                    nb_reads_writen[ '*' ][ 1 ] += 1
+
+                else :
+                    (adapt, index) = line
+                    if user_args.verbose :
+                        print "Read '%s' start with %s... and go to %s" % (read.name, read.seq[ : len( adapt ) ], adapt)
+                    if report.detailed :
+                        report.count_selection( adapt, selector.is_exact( line, read.seq ) )
+                    selector.cut( line, read )
+                    if stages :
+                        keep, events = apply_stages( stages, ( read, ) )
+                        count_events( stage_counts, nb_reads_writen[ adapt ][ 0 ], events )
+                        if not keep :
+                            continue
+                    outputs[ index ].write_record( read )
+                    nb_reads_writen[ adapt ][ 1 ] += 1
+
+            report.add_time( "write", time.time() - selected )
+            report.add_reads( len( reads ) )
+            if checkpoint is not None and checkpoint.is_due() :
+                checkpoint.save( [ reader.tell() for reader in readers ], report.nb_reads )
+
+    else :
+        (default_file_1, default_file_2) = defaults_files
+        outputs = [ line[ 1 : ] for line in table_adaptator ]
+        batches = get_batches( get_pairs( readers ) )
+        while True :
+            start = time.time()
+            pairs = next( batches, None )
+            selected = time.time()
+            report.add_time( "parse", selected - start )
+            if pairs is None :
+                break
+            lines = selector.select_batch( [ read_1.seq for read_1, read_2 in pairs ],
+                                           [ read_2.seq for read_1, read_2 in pairs ] )
+            start, selected = selected, time.time()
+            report.add_time( "select", selected - start )
+
+            for (read_1, read_2), line in izip( pairs, lines ) :
+                if line is None :
+                    if report.detailed :
+                        report.count_selection( '*', selector.is_ambiguous( read_1.seq, read_2.seq ) )
+                    default_file_1.write_record( read_1 )
+                    default_file_2.write_record( read_2 )
+                    nb_reads_writen[ '*' ][1] += 1
+
+                else :
+                    (adapt, index) = line[ : 2 ]
+
+                    if report.detailed :
+                        report.count_selection( adapt, selector.is_exact( line, read_1.seq, read_2.seq ) )
+                    selector.cut( line, read_1, read_2 )
+                    if stages :
+                        keep, events = apply_stages( stages, ( read_1, read_2 ) )
+                        count_events( stage_counts, nb_reads_writen[ adapt ][ 0 ], events )
+                        if not keep :
+                            continue
+
+                    output_file_1, output_file_2 = outputs[ index ]
+                    output_file_1.write_record( read_1 )
+                    output_file_2.write_record( read_2 )
+                    nb_reads_writen[ adapt ][1] += 1
+
+            report.add_time( "write", time.time() - selected )
+            report.add_reads( len( pairs ) )
+            if checkpoint is not None and checkpoint.is_due() :
+                checkpoint.save( [ reader.tell() for reader in readers ], report.nb_reads )
+
+
+def demultiplex_parallel( user_args, selector, table_adaptator, defaults_files, nb_reads_writen,
+                          stages=(), stage_counts=None, report=None, checkpoint=None, ranges=None,
+                          batch_size=4096 ) :
+    """
+    Demultiplex with user_args.threads worker processes.
+
+    The main process reads batches of batch_size reads, the workers select
+    the adaptators and the main process writes the reads in the same order
+    as the serial mode.
+
+    selector is a selector of get_index_selector, the workers are forked
+    with it. Their counters are added to selector, events of stages to
+    stage_counts and times and matches to report. For report, select is
+    the time spent waiting for the workers. Inputs are read within ranges
+    as in demultiplex_serial, checkpoint is saved when it is due once the
+    batches read so far are written.
+    """
+    from multiprocessing import Pool
+    from collections import deque
+
+    inputs = get_inputs( user_args )
+    if user_args.interleaved :
+        batch_size *= 2
+    if ranges is None :
+        ranges = [ ( 0, None ) ] * len( inputs )
+    # offsets after the written reads and after the read ones.
+    offsets = [ offset for offset, end in ranges ]
+    positions = list( offsets )
+
+    if report is None :
+        report = Run_report()
+
+    def write_results( async_result ) :
+        start = time.time()
+        results, messages, stats = async_result.get()
+        got = time.time()
+        report.add_time( "select", got - start )
+        for message in messages :
+            print message
+        if stats is not None :
+            selector.add_stats( stats )
+        for result in results :
+            if result[ 0 ] < 0 :
+                adapt = '*'
+                output_files = defaults_files
+            else :
+                line = table_adaptator[ result[ 0 ] ]
+                adapt = line[ 0 ]
+                output_files = line[ 1 : ]
+            if result[ 1 ] is not None :
+                report.count_selection( adapt, result[ 1 ] )
+            if result[ 2 ] :
+                count_events( stage_counts, nb_reads_writen[ adapt ][ 0 ], result[ 2 ] )
+            if len( result ) == 3 :
+                continue
+            for output_file, str_read in izip( output_files, result[ 3 : ] ) :
+                output_file.write_record( str_read )
+            nb_reads_writen[ adapt ][ 1 ] += 1
+        report.add_time( "write", time.time() - got )
+        report.add_reads( len( results ) )
+
+    def write_pending() :
+        async_result, sizes = pending.popleft()
+        write_results( async_result )
+        for i, size in enumerate( sizes ) :
+            offsets[ i ] += size
+
+    pool = Pool( user_args.threads, _init_worker, ( selector, user_args.verbose, stages, report.detailed,
+                                                    user_args.interleaved ) )
+    try :
+        pending = deque()
+        while True :
+            start = time.time()
+            batch = []
+            for i, fastq in enumerate( inputs ) :
+                str_reads = fastq.next_batch( batch_size )
+                end = ranges[ i ][ 1 ]
+                if end is not None :
+                    # end is the start of a read, str_reads ends with a
+                    # complete read.
+                    str_reads = str_reads[ : end - positions[ i ] ]
+                    positions[ i ] += len( str_reads )
+                batch.append( str_reads )
+            batch = tuple( batch )
+            report.add_time( "parse", time.time() - start )
+            if not all( batch ) :
+                break
+            pending.append( ( pool.apply_async( _select_batch, ( batch, ) ),
+                              [ len( str_reads ) for str_reads in batch ] ) )
+            if len( pending ) > 2 * user_args.threads :
+                write_pending()
+                if checkpoint is not None and checkpoint.is_due() :
+                    while pending :
+                        write_pending()
+                    checkpoint.save( offsets, report.nb_reads )
+
+        while pending :
+            write_pending()
+        pool.close()
+
+    finally :
+        pool.terminate()
+        pool.join()
+
+
+class Run_report( object ) :
+    """
+    Instrumentation of a run.
+
+    add_time adds seconds to a phase (parse, select, write, close).
+    add_reads counts the processed reads, keeps the number of reads each
+    second in timeline and writes a progress line on stderr every
+    progress seconds.
+
+    If detailed is True, count_selection is called for each read (or
+    pair): selected reads are counted by adaptator as exact or fuzzy
+    matches, rejected reads as ambiguous or not matched.
+    """
+    def __init__( self, progress=0, detailed=False ) :
+        self.start = time.time()
+        self.progress = progress
+        self.detailed = detailed
+        self.phases = {}
+        self.nb_reads = 0
+        self.timeline = []
+        self.next_sample = self.start + 1
+        self.next_progress = self.start + progress
+        self.exact = {}
+        self.fuzzy = {}
+        self.ambiguous = 0
+        self.no_match = 0
+
+    def add_time( self, phase, seconds ) :
+        self.phases[ phase ] = self.phases.get( phase, 0.0 ) + seconds
+
+    def add_reads( self, nb_reads ) :
+        self.nb_reads += nb_reads
+        now = time.time()
+        if now >= self.next_sample :
+            self.timeline.append( ( round( now - self.start, 3 ), self.nb_reads ) )
+            self.next_sample = now + 1
+        if self.progress and now >= self.next_progress :
+            elapsed = now - self.start
+            print >> sys.stderr, "%d reads in %.0f s, %.0f reads/s" % ( self.nb_reads, elapsed, self.nb_reads / elapsed )
+            self.next_progress = now + self.progress
+
+    def count_selection( self, adapt, match ) :
+        """
+        For adapt '*', match is True if the rejected reads are
+        ambiguous, otherwise it is True for an exact match.
+        """
+        if adapt == '*' :
+            if match :
+                self.ambiguous += 1
+            else :
+                self.no_match += 1
+        elif match :
+            self.exact[ adapt ] = self.exact.get( adapt, 0 ) + 1
+        else :
+            self.fuzzy[ adapt ] = self.fuzzy.get( adapt, 0 ) + 1
+
+    def get_peak_rss( self ) :
+        """
+        Return the peak resident memory in kB of this process and of its
+        largest worker process.
+        """
+        import resource
+        return ( resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss,
+                 resource.getrusage( resource.RUSAGE_CHILDREN ).ru_maxrss )
+
+    def get_summary( self, nb_reads_writen, order, stage_counts, selector, writer ) :
+        """
+        Return the report as a hash.
+        """
+        elapsed = time.time() - self.start
+        peak_rss, peak_rss_workers = self.get_peak_rss()
+        summary = { "command" : " ".join( sys.argv ),
+                    "seconds" : round( elapsed, 3 ),
+                    "reads" : self.nb_reads,
+                    "reads_per_second" : round( self.nb_reads / max( elapsed, 1e-6 ), 1 ),
+                    "phases" : dict( [ ( phase, round( seconds, 3 ) ) for phase, seconds in self.phases.items() ] ),
+                    "peak_rss_kb" : peak_rss,
+                    "peak_rss_workers_kb" : peak_rss_workers,
+                    "timeline" : self.timeline,
+                    "adaptors" : [],
+                    "stages" : [],
+                  }
+        for adapt in order :
+            name_tag, nb_reads = nb_reads_writen[ adapt ]
+            if adapt == '*' :
+                summary[ "trash" ] = { "name" : name_tag, "reads" : nb_reads }
+                if self.detailed :
+                    summary[ "trash" ].update( ambiguous=self.ambiguous, no_match=self.no_match )
+                continue
+            counts = { "adaptor" : adapt, "name" : name_tag, "reads" : nb_reads }
+            if isinstance( adapt, tuple ) :
+                counts[ "adaptor" ] = "+".join( adapt )
+            if self.detailed :
+                counts.update( exact=self.exact.get( adapt, 0 ), fuzzy=self.fuzzy.get( adapt, 0 ) )
+            summary[ "adaptors" ].append( counts )
+        for (name_tag, event), nb_reads in sorted( stage_counts.items() ) :
+            summary[ "stages" ].append( { "name" : name_tag, "event" : event, "reads" : nb_reads } )
+        if isinstance( selector, Dual_selector ) :
+            summary[ "unexpected" ] = [ { "barcode_1" : pair[ 0 ], "barcode_2" : pair[ 1 ], "reads" : nb_reads }
+                                        for pair, nb_reads in sorted( selector.unexpected.items() ) ]
+        cache_stats = selector.get_cache_stats()
+        if cache_stats is not None :
+            summary[ "adaptor_cache" ] = { "hits" : cache_stats[ 0 ], "misses" : cache_stats[ 1 ] }
+        tier_stats = selector.get_tier_stats()
+        if tier_stats is not None :
+            summary[ "adaptor_tiers" ] = { "exact" : tier_stats[ 0 ], "fuzzy" : tier_stats[ 1 ],
+                                           "fuzzy_selected" : tier_stats[ 2 ] }
+        if writer is not None :
+            hits, misses, evictions = writer.get_handle_stats()
+            summary[ "output_file_handles" ] = { "hits" : hits, "misses" : misses, "evictions" : evictions }
+        return summary
+
+    def write( self, path, summary ) :
+        """
+        Write summary in path, as JSON if path ends with .json, otherwise
+        as TSV: '# key value' lines then a table of the adaptators.
+        """
+        output = open( path, "w" )
+        if path.endswith( ".json" ) :
+            import json
+            json.dump( summary, output, indent=1, sort_keys=True )
+            output.write( "\n" )
+        else :
+            for key in ( "command", "seconds", "reads", "reads_per_second", "peak_rss_kb", "peak_rss_workers_kb" ) :
+                output.write( "# %s\t%s\n" % ( key, summary[ key ] ) )
+            for phase, seconds in sorted( summary[ "phases" ].items() ) :
+                output.write( "# %s_seconds\t%s\n" % ( phase, seconds ) )
+            for section in ( "adaptor_cache", "adaptor_tiers", "output_file_handles" ) :
+                for key, value in sorted( summary.get( section, {} ).items() ) :
+                    output.write( "# %s_%s\t%s\n" % ( section, key, value ) )
+            columns = [ "adaptor", "name", "reads" ]
+            if self.detailed :
+                columns += [ "exact", "fuzzy", "ambiguous", "no_match" ]
+            output.write( "\t".join( columns ) + "\n" )
+            rows = list( summary[ "adaptors" ] )
+            if "trash" in summary :
+                rows.append( dict( summary[ "trash" ], adaptor="*" ) )
+            for row in rows :
+                output.write( "\t".join( [ str( row.get( column, 0 ) ) for column in columns ] ) + "\n" )
+        output.close()
+
+
+def write_json( path, data ) :
+    """
+    Write data in path as JSON, the file is replaced at once.
+    """
+    import json
+    tmp_path = "%s.%d.tmp" % ( path, os.getpid() )
+    output = open( tmp_path, "w" )
+    json.dump( data, output, indent=1, sort_keys=True )
+    output.write( "\n" )
+    output.close()
+    os.rename( tmp_path, path )
+
+
+class Checkpoint( object ) :
+    """
+    Checkpoints of a run in path, to resume it when it was killed.
+
+    save is called between two batches: the buffered output files are
+    written and closed, so their lengths match what was demultiplexed
+    (a .gz file ends with a complete gzip member), then the offsets of
+    inputs after the last demultiplexed read, the length of each output
+    file and the counters, those of the selector included, are written
+    in path as JSON. It is written
+    every interval seconds (never if interval is 0) and a last time with
+    done set when the run is finished.
+
+    The output files, their writer and the selector are given by attach
+    once they are opened. To resume, check tells if the checkpoint is
+    the one of this run, truncate_outputs cuts the output files back to
+    their length at the checkpoint, they are opened in append mode and
+    restore puts the counters back and moves the inputs to the offsets.
+
+    shard is [ shard, number of shards ] for a run with option --shard,
+    the checkpoint of a finished shard gives its counters to
+    merge_shards.
+    """
+    def __init__( self, path, interval, inputs, nb_reads_writen, adapt_order, stage_counts, shard=None ) :
+        self.path = path
+        self.shard = shard
+        self.interval = interval
+        self.inputs = inputs
+        self.nb_reads_writen = nb_reads_writen
+        self.adapt_order = adapt_order
+        self.stage_counts = stage_counts
+        self.writer = None
+        self.outputs = []
+        self.selector = None
+        self.offsets = [ 0 ] * len( inputs )
+        self.nb_reads = 0
+        self.next_save = time.time() + interval
+
+    @staticmethod
+    def load( path ) :
+        """
+        Return the checkpoint saved in path, None if there is none.
+        """
+        import json
+        if not os.path.exists( path ) :
+            return None
+        input = open( path )
+        state = json.load( input )
+        input.close()
+        return state
+
+    @staticmethod
+    def remove( path ) :
+        if os.path.exists( path ) :
+            os.remove( path )
+
+    @staticmethod
+    def truncate_outputs( state ) :
+        """
+        Cut the output files of state back to their length at the
+        checkpoint, raise IOError if one is shorter.
+        """
+        for path, size in sorted( state[ "outputs" ].items() ) :
+            if not os.path.exists( path ) :
+                if size :
+                    raise IOError( "output file '%s' is missing" % path )
+                continue
+            if os.path.getsize( path ) < size :
+                raise IOError( "output file '%s' is shorter than at the checkpoint" % path )
+            output = open( path, "r+b" )
+            output.truncate( size )
+            output.close()
+
+    def get_input_sizes( self ) :
+        """
+        Return the sizes of the inputs, None for pipes and the standard
+        input.
+        """
+        sizes = []
+        for fastq in self.inputs :
+            if fastq.path != "-" and os.path.isfile( fastq.path ) :
+                sizes.append( os.path.getsize( fastq.path ) )
+            else :
+                sizes.append( None )
+        return sizes
+
+    def get_adaptators( self ) :
+        """
+        Return [ adaptator, name_tag ] lists, pairs of barcodes are lists
+        as in JSON.
+        """
+        adaptators = []
+        for adapt in self.adapt_order :
+            name_tag = self.nb_reads_writen[ adapt ][ 0 ]
+            if isinstance( adapt, tuple ) :
+                adapt = list( adapt )
+            adaptators.append( [ adapt, name_tag ] )
+        return adaptators
+
+    def attach( self, writer, outputs, selector ) :
+        """
+        writer is the Fastq_writer of the output files outputs, it is
+        synchronized before each checkpoint.
+        """
+        self.writer = writer
+        self.outputs = outputs
+        self.selector = selector
+
+    def check( self, state ) :
+        """
+        Raise ValueError if the inputs or the adaptators of state are not
+        the ones of this run.
+        """
+        if [ fastq[ "path" ] for fastq in state[ "inputs" ] ] != [ fastq.path for fastq in self.inputs ] \
+           or [ fastq[ "size" ] for fastq in state[ "inputs" ] ] != self.get_input_sizes() :
+            raise ValueError( "input files are not the ones of the checkpoint" )
+        if state[ "adaptors" ] != self.get_adaptators() :
+            raise ValueError( "adaptators are not the ones of the checkpoint" )
+        if state.get( "shard" ) != self.shard :
+            raise ValueError( "the shard is not the one of the checkpoint" )
+
+    def restore( self, state ) :
+        """
+        Put back the counters of state and move the inputs to its
+        offsets.
+        """
+        for adapt, nb_reads in izip( self.adapt_order, state[ "counts" ] ) :
+            self.nb_reads_writen[ adapt ][ 1 ] = nb_reads
+        for name_tag, event, nb_reads in state[ "stages" ] :
+            self.stage_counts[ ( str( name_tag ), str( event ) ) ] = nb_reads
+        if isinstance( self.selector, Dual_selector ) :
+            self.selector.add_stats( dict( [ ( ( str( barcode_1 ), str( barcode_2 ) ), nb_reads )
+                                             for barcode_1, barcode_2, nb_reads in state[ "unexpected" ] ] ) )
+        elif state.get( "selector" ) is not None :
+            self.selector.add_stats( state[ "selector" ] )
+        for fastq, input_state in izip( self.inputs, state[ "inputs" ] ) :
+            fastq.skip( input_state[ "offset" ] )
+        self.offsets = [ input_state[ "offset" ] for input_state in state[ "inputs" ] ]
+        self.nb_reads = state[ "reads" ]
+
+    def is_due( self ) :
+        return self.interval > 0 and time.time() >= self.next_save
+
+    def save( self, offsets, nb_reads, done=False ) :
+        """
+        Write the checkpoint after nb_reads reads (or pairs) of this run,
+        offsets are the positions of the inputs after the last one. The
+        output files must be closed if done is True.
+        """
+        if not done :
+            self.writer.sync()
+        sizes = {}
+        for output in self.outputs :
+            sizes[ output.name ] = 0
+            if os.path.exists( output.name ) :
+                sizes[ output.name ] = os.path.getsize( output.name )
+        state = { "done" : done,
+                  "reads" : self.nb_reads + nb_reads,
+                  "inputs" : [ { "path" : fastq.path, "size" : size, "offset" : offset }
+                               for fastq, size, offset in izip( self.inputs, self.get_input_sizes(), offsets ) ],
+                  "adaptors" : self.get_adaptators(),
+                  "counts" : [ self.nb_reads_writen[ adapt ][ 1 ] for adapt in self.adapt_order ],
+                  "stages" : [ [ name_tag, event, nb_reads ]
+                               for (name_tag, event), nb_reads in sorted( self.stage_counts.items() ) ],
+                  "outputs" : sizes,
+                }
+        if isinstance( self.selector, Dual_selector ) :
+            state[ "unexpected" ] = [ [ barcode_1, barcode_2, nb_reads ]
+                                      for (barcode_1, barcode_2), nb_reads in sorted( self.selector.unexpected.items() ) ]
+        else :
+            # cache and tier counters, given back at once to the selector.
+            stats = self.selector.pop_stats()
+            if stats is not None :
+                self.selector.add_stats( stats )
+                state[ "selector" ] = stats
+        if self.shard is not None :
+            state[ "shard" ] = self.shard
+        write_json( self.path, state )
+        self.next_save = time.time() + self.interval
+
+
+def get_max_open_files( margin=64 ) :
+    """
+    Return the number of output files which can be kept open, keeping
+    margin descriptors for the inputs, pipes and worker processes.
+    None if there is no limit.
+    """
+    import resource
+    soft_limit = resource.getrlimit( resource.RLIMIT_NOFILE )[ 0 ]
+    if soft_limit == resource.RLIM_INFINITY :
+        return None
+    return max( 1, soft_limit - margin )
+
+
+def read_manifest( path ) :
+    """
+    Return the entries of a manifest, a file with one line by run:
+    fastq_1<tab>fastq_2<tab>file_adapt<tab>prefix, or
+    fastq_1<tab>file_adapt<tab>prefix in single-end.
+    Blank lines and lines starting with # are skipped.
+
+    Entries are ( fastq_1, fastq_2, file_adapt, prefix ) tuples, fastq_2
+    is None in single-end.
+    """
+    entries = []
+    prefixes = set()
+    manifest = open( path )
+    for nb_line, line in enumerate( manifest ) :
+        fields = line.split()
+        if not fields or fields[ 0 ].startswith( "#" ) :
+            continue
+        if len( fields ) == 3 :
+            fields.insert( 1, None )
+        if len( fields ) != 4 :
+            print >> sys.stderr, "Line %d of manifest '%s' is malformed." % ( nb_line + 1, path )
+            sys.exit( 1 )
+        for input_path in fields[ : 3 ] :
+            if input_path is not None and not os.path.exists( input_path ) :
+                print >> sys.stderr, "File '%s' of line %d of manifest '%s' does not exist." % ( input_path, nb_line + 1, path )
+                sys.exit( 1 )
+        if fields[ 3 ] in prefixes :
+            print >> sys.stderr, "Prefix '%s' is used twice in manifest '%s'." % ( fields[ 3 ], path )
+            sys.exit( 1 )
+        prefixes.add( fields[ 3 ] )
+        entries.append( tuple( fields ) )
+    manifest.close()
+    return entries
+
+
+def get_adapt_table( opened_adapt_file ) :
+    """
+    Return the table of get_output_files without output files, that is
+    the sorted list of ( adaptator, ) tuples.
+    """
+    table = []
+    opened_adapt_file.seek( 0 )
+    for line in opened_adapt_file :
+        if not line.isspace() and line[ 0 ] != '*' :
+            table.append( split_adapt_line( line, opened_adapt_file )[ : 1 ] )
+    table.sort()
+    return table
+
+
+def _run_manifest_entry( user_args, entry, selectors ) :
+    """
+    Run in a process for an entry of the manifest, the standard output
+    goes to PREFIX.log and a report to PREFIX-REPORT.
+    """
+    fastq_1, fastq_2, file_adapt, prefix = entry
+    entry_args = copy.copy( user_args )
+    entry_args.fastq_1 = Fastq_file( fastq_1, "r" )
+    entry_args.fastq_2 = None
+    if fastq_2 is not None :
+        entry_args.fastq_2 = Fastq_file( fastq_2, "r" )
+    entry_args.single_end = fastq_2 is None and not user_args.interleaved
+    entry_args.file_adapt = open( file_adapt )
+    entry_args.output_prefix = prefix
+    if user_args.report is not None :
+        entry_args.report = "%s-%s" % ( prefix, user_args.report )
+
+    sys.stdout = open( prefix + ".log", "w" )
+    try :
+        demultiplex( entry_args, selectors )
+    finally :
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+
+def run_manifest( user_args ) :
+    """
+    Demultiplex the entries of the manifest user_args.manifest with
+    user_args.jobs processes, the largest inputs first.
+
+    Selectors are built once by set of adaptators before the processes
+    are forked, entries which share adaptators share them.
+    Return the number of failed entries.
+    """
+    from multiprocessing import Process
+
+    entries = read_manifest( user_args.manifest )
+
+    selectors = {}
+    sizes = []
+    for entry_no, ( fastq_1, fastq_2, file_adapt, prefix ) in enumerate( entries ) :
+        entry_args = copy.copy( user_args )
+        entry_args.single_end = fastq_2 is None and not user_args.interleaved
+        opened_adapt_file = open( file_adapt )
+        table = get_adapt_table( opened_adapt_file )
+        opened_adapt_file.close()
+        entry_args.file_adapt = opened_adapt_file
+        if entry_args.single_end and table and isinstance( table[ 0 ][ 0 ], tuple ) :
+            print >> sys.stderr, "File '%s' has dual barcodes, they need paired-end files." % file_adapt
+            sys.exit( 1 )
+        get_index_selector( entry_args, table, selectors )
+        size = os.path.getsize( fastq_1 )
+        if fastq_2 is not None :
+            size += os.path.getsize( fastq_2 )
+        sizes.append( ( -size, entry_no ) )
+    pending = [ entry_no for size, entry_no in sorted( sizes ) ]
+
+    print "%d entries, %d selectors" % ( len( entries ), len( selectors ) )
+    sys.stdout.flush()
+
+    running = []
+    nb_failed = 0
+    while pending or running :
+        while pending and len( running ) < user_args.jobs :
+            entry_no = pending.pop( 0 )
+            process = Process( target=_run_manifest_entry, args=( user_args, entries[ entry_no ], selectors ) )
+            process.start()
+            running.append( ( process, entry_no, time.time() ) )
+
+        time.sleep( 0.1 )
+        for process, entry_no, start in running[ : ] :
+            if process.is_alive() :
+                continue
+            process.join()
+            running.remove( ( process, entry_no, start ) )
+            prefix = entries[ entry_no ][ 3 ]
+            if process.exitcode == 0 :
+                print "%s done in %.1f s, see %s.log" % ( prefix, time.time() - start, prefix )
+            else :
+                nb_failed += 1
+                print "%s failed with code %s, see %s.log" % ( prefix, process.exitcode, prefix )
+            sys.stdout.flush()
+
+    return nb_failed
+
+
+def merge_shards( prefix, nb_shards ) :
+    """
+    Merge the runs with option --shard I/nb_shards and prefix: output
+    files of the shards are concatenated in shard order and their
+    counters are summed, so that the output files are the ones of a run
+    without --shard (a .gz file has one gzip member by shard). The
+    merged counters are printed as by demultiplex and written in
+    PREFIX-checkpoint.json as for a finished run. Files of the shards
+    are kept.
+    """
+    import shutil
+
+    states = []
+    for shard in xrange( 1, nb_shards + 1 ) :
+        path = "%s-checkpoint.json" % get_shard_prefix( prefix, shard )
+        state = Checkpoint.load( path )
+        if state is None or not state[ "done" ] :
+            print >> sys.stderr, "Shard %d of %d is not finished, %s is missing or not done." % ( shard, nb_shards, path )
+            sys.exit( 1 )
+        if state.get( "shard" ) != [ shard, nb_shards ] :
+            print >> sys.stderr, "%s is not the checkpoint of shard %d of %d." % ( path, shard, nb_shards )
+            sys.exit( 1 )
+        if states and ( state[ "inputs" ] != states[ 0 ][ "inputs" ] or state[ "adaptors" ] != states[ 0 ][ "adaptors" ] ) :
+            print >> sys.stderr, "Shards 1 and %d do not have the same inputs and adaptators." % shard
+            sys.exit( 1 )
+        states.append( state )
+
+    # output files of the merged run by output file of each shard
+    merged = {}
+    for shard, state in enumerate( states ) :
+        shard_prefix = get_shard_prefix( prefix, shard + 1 )
+        for path, size in state[ "outputs" ].items() :
+            if not path.startswith( shard_prefix ) :
+                print >> sys.stderr, "Output file '%s' of shard %d does not start with %s." % ( path, shard + 1, shard_prefix )
+                sys.exit( 1 )
+            merged.setdefault( prefix + path[ len( shard_prefix ) : ], [] ).append( ( path, size ) )
+    for path, shard_outputs in sorted( merged.items() ) :
+        if len( shard_outputs ) != nb_shards :
+            print >> sys.stderr, "Output file '%s' is not written by every shard." % path
+            sys.exit( 1 )
+        for shard_path, size in shard_outputs :
+            if not os.path.exists( shard_path ) or os.path.getsize( shard_path ) != size :
+                print >> sys.stderr, "Output file '%s' is not the one of its checkpoint." % shard_path
+                sys.exit( 1 )
+
+    sizes = {}
+    for path, shard_outputs in sorted( merged.items() ) :
+        output = open( path, "wb" )
+        for shard_path, size in shard_outputs :
+            input = open( shard_path, "rb" )
+            shutil.copyfileobj( input, output, 4 * 1024 * 1024 )
+            input.close()
+        output.close()
+        sizes[ path ] = os.path.getsize( path )
+
+    counts = [ 0 ] * len( states[ 0 ][ "counts" ] )
+    stage_counts = {}
+    unexpected = {}
+    for state in states :
+        counts = [ nb_reads + shard_reads for nb_reads, shard_reads in izip( counts, state[ "counts" ] ) ]
+        for name_tag, event, nb_reads in state[ "stages" ] :
+            stage_counts[ ( name_tag, event ) ] = stage_counts.get( ( name_tag, event ), 0 ) + nb_reads
+        for barcode_1, barcode_2, nb_reads in state.get( "unexpected", () ) :
+            unexpected[ ( barcode_1, barcode_2 ) ] = unexpected.get( ( barcode_1, barcode_2 ), 0 ) + nb_reads
+
+    state = { "done" : True,
+              "reads" : sum( [ shard_state[ "reads" ] for shard_state in states ] ),
+              "inputs" : states[ 0 ][ "inputs" ],
+              "adaptors" : states[ 0 ][ "adaptors" ],
+              "counts" : counts,
+              "stages" : [ [ name_tag, event, nb_reads ]
+                           for (name_tag, event), nb_reads in sorted( stage_counts.items() ) ],
+              "outputs" : sizes,
+            }
+    if "unexpected" in states[ 0 ] :
+        state[ "unexpected" ] = [ [ barcode_1, barcode_2, nb_reads ]
+                                  for (barcode_1, barcode_2), nb_reads in sorted( unexpected.items() ) ]
+    write_json( "%s-checkpoint.json" % prefix, state )
+
+    print "%d shards merged, %d reads" % ( nb_shards, state[ "reads" ] )
+    for ( adapt, name_tag ), nb_reads in izip( state[ "adaptors" ], counts ) :
+        print "%s %d reads" % ( name_tag, nb_reads )
+    for (name_tag, event), nb_reads in sorted( stage_counts.items() ) :
+        print "%s %s %d reads" % ( name_tag, event, nb_reads )
+    for (barcode_1, barcode_2), nb_reads in sorted( unexpected.items(), key=lambda item : ( -item[ 1 ], item[ 0 ] ) ) :
+        print "unexpected %s %s %d reads" % ( barcode_1, barcode_2, nb_reads )
+
+
 def parse_user_argument() :
     """
     Recover user argument
@@ -360,136 +2518,400 @@ def parse_user_argument() :
     parser.add_argument( '-v', '--verbose', dest="verbose", action='store_true',
                             help="Be verbose" )
     
-    parser.add_argument( 'file_adapt', metavar="FILE_ADAPT", nargs=1, type=argparse.FileType('r'),
-                         help="Format is one line by adaptor, such as: adaptor_1<tab>id_sample_1, etc. Last line should be like *<tab>name_trash")
+    parser.add_argument( 'file_adapt', metavar="FILE_ADAPT", nargs='?', type=argparse.FileType('r'), default=None,
+                         help="Format is one line by adaptor, such as: adaptor_1<tab>id_sample_1, etc. Last line should be like *<tab>name_trash. For dual barcodes in paired-end, lines are barcode_read_1<tab>barcode_read_2<tab>id_sample_1")
 
     parser.add_argument( '-f', '--fastq_1', dest="fastq_1", type=FastqFileType( "r" ), action='store', 
-                            help="For a single-end file or the first paired-end file" )
+                            help="For a single-end file or the first paired-end file. '-' reads the standard input, which must not be compressed, as named pipes" )
 
     parser.add_argument( '-F', '--fastq_2', dest="fastq_2", type=FastqFileType( "r" ), action='store', default=None,
                             help="For the 2nd paired-end file" )
 
+    parser.add_argument( '--interleaved', dest="interleaved", action='store_true',
+                            help="FASTQ_1 is paired-end with both members of each pair, one after the other" )
+
+    parser.add_argument( '--interleaved-output', dest="interleaved_output", action='store_true',
+                            help="In paired-end, write both members of pairs in one file PREFIX-TAG.fastq. Output files which already exist as named pipes (mkfifo) are streamed to their reader, a reader of two pipes should read a pair at a time or use this option" )
+
     parser.add_argument( '-p', '--output_prefix', dest="output_prefix", default="", action='store',
                             help="Output files have name PREFIX-ADAPTOR.fastq"  )
 
-    parser.add_argument( '-l', '--levenshtein', dest="levenshtein", action='store', type=float, default=None,
-                            help="Use a Levenshtein distance to demultiplex" )
+    parser.add_argument( '-z', '--gzip', dest="gzip", action='store_true',
+                            help="Write gzip output files named PREFIX-ADAPTOR.fastq.gz. Input files are always uncompressed on the fly when they are gzip or bgzip files" )
+
+    parser.add_argument( '--compress-threads', dest="compress_threads", action='store', type=int, default=2,
+                            help="Number of threads used to compress each output file with pigz or bgzip, with option --gzip (default: %(default)s)" )
+
+    parser.add_argument( '-l', '--levenshtein', dest="levenshtein", action='store', type=get_rate, default=None,
+                            help="Use a Levenshtein distance to demultiplex, reads whose ratio with the closest adaptor is at least LEVENSHTEIN are kept. With auto, the lowest ratio which keeps every read closer to its adaptor than to any other (see option --analogy)" )
+
+    parser.add_argument( '--distance', dest="distance", action='store', choices=DISTANCES, default=None,
+                            help="Ratio used by options levenshtein and analogy: levenshtein (python-Levenshtein if it can be loaded, a builtin implementation otherwise) or hamming, the proportion of identical bases. Default is levenshtein, hamming with option numpy" )
+
+    parser.add_argument( '--numpy', dest="numpy", action='store_true',
+                            help="With option levenshtein, the ratio is the proportion of identical bases (no indel) computed with numpy for whole batches of reads. Adaptors must have the same length" )
+
+    parser.add_argument( '--cache-size', dest="cache_size", action='store', type=int, default=65536,
+                            help="With option levenshtein, number of read starts whose adaptor is remembered. 0 disables the cache (default: %(default)s)" )
+
+    parser.add_argument( '-m', '--mismatches', dest="mismatches", action='store', type=int, default=None,
+                            help="Accept up to MISMATCHES substitutions in the adaptor, using a precomputed index of neighbour sequences (1 or 2 is advised)" )
+
+    parser.add_argument( '--trie', dest="trie", action='store_true',
+                            help="Select the longest adaptor starting the read with a prefix tree, for adaptors of different lengths. With option mismatches, adaptors with up to MISMATCHES substitutions are searched in the tree, the fewest substitutions then the longest adaptor wins" )
+
+    parser.add_argument( '--max-offset', dest="max_offset", action='store', type=int, default=0,
+                            help="Adaptors can start after a spacer of up to MAX_OFFSET bases, as in phased libraries. The spacer is cut with the adaptor. Each start is looked up in a hash table of the adaptors (and of their neighbours with option mismatches), the fewest substitutions then the smallest spacer wins (default: %(default)s)" )
+
+    parser.add_argument( '--adapter-3', dest="adapter_3", action='store', nargs='+', default=None, metavar="ADAPTER",
+                            help="Remove this 3' adapter and what follows from demultiplexed reads, as cutadapt -a but without indels. A second adapter can be given for the second member of pairs. Reads which are only an adapter are dropped" )
+
+    parser.add_argument( '--adapter-3-overlap', dest="adapter_3_overlap", action='store', type=int, default=7,
+                            help="Minimal length of an adapter cut by the end of the read (default: %(default)s)" )
+
+    parser.add_argument( '--adapter-3-error-rate', dest="adapter_3_error_rate", action='store', type=float, default=0.1,
+                            help="Substitutions allowed by base of the adapter (default: %(default)s)" )
+
+    parser.add_argument( '--min-mean-quality', dest="min_mean_quality", action='store', type=float, default=None,
+                            help="Drop demultiplexed reads with a lower mean quality, after adapter trimming. In paired-end, both members are dropped" )
+
+    parser.add_argument( '--quality-ascii', dest="quality_ascii", action='store', type=int, default=33,
+                            help="ascii code of quality 0, 33 for Sanger and Illumina 1.8+, 64 for Illumina 1.3 and 1.5 (default: %(default)s)" )
+
+    parser.add_argument( '--min-length', dest="min_length", action='store', type=int, default=None,
+                            help="Drop demultiplexed reads shorter than MIN_LENGTH, after adapter trimming. In paired-end, both members are dropped" )
+
+    parser.add_argument( '--buffer-size', dest="buffer_size", action='store', type=int, default=64,
+                            help="Memory in MB used to buffer output files, which are written by background threads. 0 writes each read directly (default: %(default)s)" )
+
+    parser.add_argument( '--writer-threads', dest="writer_threads", action='store', type=int, default=1,
+                            help="Number of threads writing the buffered output files (default: %(default)s)" )
+
+    parser.add_argument( '--max-open-files', dest="max_open_files", action='store', type=int, default=None,
+                            help="Maximal number of output files open at the same time. Least recently used files are closed and reopened in append mode. Default is the open files limit (ulimit -n) minus 64. Not used with --buffer-size 0" )
+
+    parser.add_argument( '-t', '--threads', dest="threads", action='store', type=int, default=1,
+                            help="Number of processes used to select the adaptors. Output is identical to the one process mode" )
+
+    parser.add_argument( '--report', dest="report", action='store', default=None,
+                            help="Write a report of the run: time by phase, reads/s, peak memory, and by adaptor exact and fuzzy matches and ambiguous rejected reads. JSON if REPORT ends with .json (with the number of reads each second), TSV otherwise" )
+
+    parser.add_argument( '--progress', dest="progress", action='store', type=float, default=0,
+                            help="Write the number of processed reads and reads/s on stderr every PROGRESS seconds" )
+
+    parser.add_argument( '--checkpoint', dest="checkpoint", action='store', type=float, default=0,
+                            help="Every CHECKPOINT seconds, write in PREFIX-checkpoint.json the offsets of the inputs, the length of the output files and the counters, so that a killed run can go on with option --resume. Not used with --buffer-size 0 or named pipe outputs" )
+
+    parser.add_argument( '--resume', dest="resume", action='store_true',
+                            help="Go on from PREFIX-checkpoint.json: output files are cut back to their length at the checkpoint and appended, inputs are read from there. A finished run is not done again, a run without checkpoint starts from the beginning. Inputs, FILE_ADAPT and options must be the ones of the checkpointed run" )
+
+    parser.add_argument( '--manifest', dest="manifest", action='store', default=None,
+                            help="Demultiplex several runs in one job. MANIFEST has one line by run: fastq_1<tab>fastq_2<tab>file_adapt<tab>prefix, or fastq_1<tab>file_adapt<tab>prefix in single-end. Other options apply to every run, the output of a run is written in PREFIX.log and its report in PREFIX-REPORT" )
+
+    parser.add_argument( '-j', '--jobs', dest="jobs", action='store', type=int, default=1,
+                            help="With option manifest, number of runs demultiplexed at the same time, the largest inputs first. Each run uses THREADS processes (default: %(default)s)" )
+
+    parser.add_argument( '--shard', dest="shard", action='store', type=get_shard, default=None, metavar="I/N",
+                            help="Demultiplex only the I-th of N parts of close sizes of the inputs (from 1 to N, the SGE task id of an array job), the inputs must be regular files which are indexed first if they have no index (see index_fastq.py). Output files, report and counters go to PREFIX-shardI files, the shards are merged with --merge-shards N" )
+
+    parser.add_argument( '--merge-shards', dest="merge_shards", action='store', type=int, default=None, metavar="N",
+                            help="Merge the N shards of PREFIX: output files are concatenated in shard order, identical to the ones of a run without shards, and counters are summed. FILE_ADAPT and fastq files are not given" )
+
+    parser.add_argument( '--rescue', dest="rescue", action='store_true',
+                            help="Demultiplex with option levenshtein only the trash files PREFIX-TAG of a finished run of PREFIX, an exact one for example: rescued reads are appended to the sample files and the others replace the trash files. Fastq files are not given, PREFIX-TAG_1 and _2 are paired-end, PREFIX-TAG single-end unless option interleaved-output is given" )
 
     parser.add_argument( '-a', '--analogy', dest="analogy", action='store_true',
-                            help="Compute the maximal Levenshtein ratio between adaptors" )
+                            help="Analyse the adaptors: maximal ratio between them, number of mismatches (and differences of the distance of option --levenshtein) which keeps reads unambiguous, with the value of --levenshtein auto, and pairs of adaptors which are too close for one more. The analysis is kept in FILE_ADAPT.barcodes.json" )
 
     parser.add_argument( '--all', dest="all", action='store_true',
                          help="If this option is used with option levenshtein in paired-end, both members should be higher than the ratio and each should be close to one adaptor. If option levenshtein is not used, this option is not used either." )
 
     user_args = parser.parse_args()
-    user_args.file_adapt = user_args.file_adapt[0]
-    user_args.single_end = user_args.fastq_2 is None 
+    if user_args.manifest is not None :
+        if user_args.file_adapt is not None or user_args.fastq_1 is not None or user_args.fastq_2 is not None :
+            parser.error( "with option --manifest, FILE_ADAPT and fastq files are given by the manifest" )
+        if user_args.analogy :
+            parser.error( "options --manifest and --analogy are not compatible" )
+        if user_args.merge_shards is not None :
+            parser.error( "options --manifest and --merge-shards are not compatible" )
+        if user_args.jobs < 1 :
+            parser.error( "option --jobs must be at least 1" )
+    elif user_args.merge_shards is not None :
+        if user_args.file_adapt is not None or user_args.fastq_1 is not None or user_args.fastq_2 is not None :
+            parser.error( "with option --merge-shards, FILE_ADAPT and fastq files are given by the shards" )
+        if user_args.shard is not None or user_args.analogy :
+            parser.error( "option --merge-shards is not compatible with options --shard and --analogy" )
+        if user_args.merge_shards < 1 :
+            parser.error( "option --merge-shards must be at least 1" )
+    elif user_args.file_adapt is None :
+        parser.error( "FILE_ADAPT is required" )
+    if user_args.rescue :
+        if user_args.fastq_1 is not None or user_args.fastq_2 is not None or user_args.interleaved :
+            parser.error( "with option --rescue, the inputs are the trash files of PREFIX" )
+        if user_args.levenshtein is None :
+            parser.error( "option --rescue needs option --levenshtein" )
+        if ( user_args.manifest is not None or user_args.merge_shards is not None or user_args.shard is not None
+             or user_args.resume or user_args.checkpoint ) :
+            parser.error( "option --rescue is not compatible with options --manifest, --merge-shards, --shard, --resume and --checkpoint" )
+    if user_args.interleaved and user_args.fastq_2 is not None :
+        parser.error( "option --interleaved takes the pairs from --fastq_1 only" )
+    if user_args.fastq_1 is not None and user_args.fastq_2 is not None and user_args.fastq_1.path == user_args.fastq_2.path == "-" :
+        parser.error( "the standard input can only be read once" )
+    if user_args.levenshtein is not None and user_args.mismatches is not None :
+        parser.error( "options --levenshtein and --mismatches are not compatible" )
+    if user_args.trie and user_args.levenshtein is not None :
+        parser.error( "options --trie and --levenshtein are not compatible" )
+    if user_args.max_offset < 0 :
+        parser.error( "option --max-offset must be positive or 0" )
+    if user_args.max_offset and ( user_args.levenshtein is not None or user_args.trie ) :
+        parser.error( "option --max-offset is not compatible with options --levenshtein and --trie" )
+    if user_args.numpy :
+        if user_args.levenshtein is None :
+            parser.error( "option --numpy needs option --levenshtein" )
+        if user_args.distance == "levenshtein" :
+            parser.error( "option --numpy only computes hamming ratios" )
+        user_args.distance = "hamming"
+    elif user_args.distance is None :
+        user_args.distance = "levenshtein"
+    user_args.distance_backend = None
+    if user_args.levenshtein is not None or user_args.analogy :
+        user_args.distance_backend = get_distance_backend( user_args.distance )
+    if user_args.adapter_3 is not None and len( user_args.adapter_3 ) > 2 :
+        parser.error( "option --adapter-3 takes one or two adapters" )
+    if user_args.cache_size < 0 :
+        parser.error( "option --cache-size must be positive or 0" )
+    if user_args.checkpoint < 0 :
+        parser.error( "option --checkpoint must be positive or 0" )
+    if user_args.checkpoint and user_args.buffer_size <= 0 :
+        parser.error( "option --checkpoint needs buffered output files, --buffer-size must be positive" )
+    user_args.single_end = user_args.fastq_2 is None and not user_args.interleaved
+    if user_args.interleaved_output and user_args.single_end and user_args.manifest is None and not user_args.rescue :
+        parser.error( "option --interleaved-output needs paired-end reads" )
+    if not user_args.gzip :
+        user_args.compress_threads = None
     return user_args
 
-def main() :
-    user_args = parse_user_argument()
+def demultiplex( user_args, selectors=None ) :
+    """
+    Demultiplex user_args.fastq_1 (and user_args.fastq_2) with the
+    adaptators of user_args.file_adapt and print the statistics.
 
-    if user_args.analogy :
-        print "Maximal Levenshtein ratio between adaptors is %f" % get_maximal_annalogie( user_args.file_adapt )
-        sys.exit(0)        
-            
-    output_files_by_adapt, defaults_files = get_output_files( user_args.file_adapt,
-                                                              user_args.output_prefix,
-                                                              not user_args.single_end )
+    selectors is given to get_index_selector to share selectors between
+    runs.
 
-    nb_reads_writen = get_adapt_counter( user_args.file_adapt )
+    With user_args.checkpoint or user_args.resume, the run is recorded in
+    PREFIX-checkpoint.json, see Checkpoint. With user_args.resume, it goes
+    on from there unless it was finished.
 
-    user_args.file_adapt.close()
+    With user_args.shard, only the reads of the shard are demultiplexed,
+    the prefix of the output files, checkpoint and report is
+    PREFIX-shardI and the counters are always written in the checkpoint
+    for merge_shards.
+    """
+    adapt_order = []
+    nb_reads_writen = get_adapt_counter( user_args.file_adapt, adapt_order )
+    stage_counts = {}
+
+    rescued_paths = []
+    if user_args.rescue :
+        try :
+            rescued_paths = get_rescue_inputs( user_args, nb_reads_writen[ '*' ][ 0 ] )
+        except ( IOError, OSError ), e :
+            print >> sys.stderr, "Can not rescue the trash reads: %s" % e
+            sys.exit( 1 )
+        print "rescue the reads of %s" % ", ".join( rescued_paths )
+
+    inputs = get_inputs( user_args )
+    ranges = [ ( 0, None ) ] * len( inputs )
+    prefix = user_args.output_prefix
+    report_path = user_args.report
+    shard = None
+    if user_args.shard is not None :
+        shard = list( user_args.shard )
+        prefix = get_shard_prefix( prefix, shard[ 0 ] )
+        if report_path is not None :
+            root, extension = os.path.splitext( report_path )
+            report_path = get_shard_prefix( root, shard[ 0 ] ) + extension
+
+    checkpoint = None
+    checkpoint_path = "%s-checkpoint.json" % prefix
+    state = None
+    if user_args.checkpoint or user_args.resume or shard is not None :
+        checkpoint = Checkpoint( checkpoint_path, user_args.checkpoint, inputs,
+                                 nb_reads_writen, adapt_order, stage_counts, shard )
+    if user_args.resume :
+        state = Checkpoint.load( checkpoint_path )
+        if state is None :
+            print "no checkpoint %s, start from the beginning" % checkpoint_path
+        else :
+            try :
+                checkpoint.check( state )
+                if not state[ "done" ] :
+                    Checkpoint.truncate_outputs( state )
+            except ( IOError, ValueError ), e :
+                print >> sys.stderr, "Can not resume from %s: %s" % ( checkpoint_path, e )
+                sys.exit( 1 )
+            if state[ "done" ] :
+                print "%s is done, nothing to resume" % checkpoint_path
+                return
+    else :
+        Checkpoint.remove( checkpoint_path )
+
+    if shard is not None :
+        try :
+            first, last, ranges = get_shard_ranges( inputs, shard[ 0 ], shard[ 1 ], user_args.interleaved )
+        except ( IOError, ValueError ), e :
+            print >> sys.stderr, "Can not cut the inputs in %d shards: %s" % ( shard[ 1 ], e )
+            sys.exit( 1 )
+        print "shard %d of %d: %d reads from read %d" % ( shard[ 0 ], shard[ 1 ], last - first, first )
+
+    writer = None
+    if user_args.buffer_size > 0 :
+        max_open = user_args.max_open_files
+        if max_open is None :
+            max_open = get_max_open_files()
+        writer = Fastq_writer( user_args.buffer_size * 1024 * 1024, user_args.writer_threads, max_open )
+
+    # a resumed run appends to the truncated output files, a rescue
+    # to the sample files.
+    mode = "w"
+    if state is not None or user_args.rescue :
+        mode = "a"
+    output_files_by_adapt, defaults_files = get_output_files( user_args.file_adapt,
+                                                              prefix,
+                                                              not user_args.single_end,
+                                                              user_args.compress_threads,
+                                                              writer,
+                                                              user_args.interleaved_output,
+                                                              mode )
 
-    if user_args.levenshtein : 
-        if user_args.all :
-            select_output_file = LevenshteinAllSelector( output_files_by_adapt, 
-                                                       user_args.single_end,
-                                                       user_args.levenshtein )
+    user_args.file_adapt.close()
 
-        else :
-            select_output_file = Levenshtein_selector( output_files_by_adapt, 
-                                                       user_args.single_end,
-                                                       user_args.levenshtein )
+    if user_args.rescue :
+        # sample files of a finished run end with a newline, the rescued
+        # reads follow it.
+        for line in output_files_by_adapt :
+            for output_file in line[ 1 : ] :
+                output_file.seq_already_write = False
+
+    selector = get_index_selector( user_args, output_files_by_adapt, selectors )
+    if user_args.levenshtein == "auto" :
+        print "%s ratio: %f (auto)" % ( user_args.distance, selector.rate )
+    if user_args.verbose and user_args.distance_backend is not None :
+        print "distance: %s" % user_args.distance_backend.name
+
+    stages = get_stages( user_args )
+    report = Run_report( user_args.progress, report_path is not None )
+
+    if checkpoint is not None :
+        outputs = []
+        for line in output_files_by_adapt + [ ( '*', ) + tuple( defaults_files ) ] :
+            for output_file in line[ 1 : ] :
+                if output_file not in outputs :
+                    outputs.append( output_file )
+        if user_args.checkpoint and [ output_file for output_file in outputs if output_file.stream ] :
+            print >> sys.stderr, "Output files which are named pipes can not be checkpointed."
+            sys.exit( 1 )
+        checkpoint.attach( writer, outputs, selector )
+        if state is not None :
+            try :
+                checkpoint.restore( state )
+            except IOError, e :
+                print >> sys.stderr, "Can not resume from %s: %s" % ( checkpoint_path, e )
+                sys.exit( 1 )
+            print "resume after %d reads" % checkpoint.nb_reads
+
+    if state is not None :
+        ranges = [ ( offset, end ) for offset, ( start, end ) in izip( checkpoint.offsets, ranges ) ]
     else :
-        select_output_file = Std_selector( output_files_by_adapt, 
-                                           user_args.single_end )
+        for fastq, ( start, end ) in izip( inputs, ranges ) :
+            if start :
+                fastq.skip( start )
 
     if user_args.single_end :
         print "single end"
-        default_file = defaults_files[0]
-        for str_read in user_args.fastq_1 :
-            read = Fastq_read( str_read )
-            adapt_and_line = select_output_file.select( read.seq )
-            if adapt_and_line is None :
-                if user_args.verbose :
-                    print "Read '%s' start with %s... and go to *" % (read.name, read.seq[ : 14 ])
-                default_file.write( "%s" % str( read ) )
-                nb_reads_writen[ '*' ][ 1 ] += 1
+    else :
+        print "paired-end"
 
-            else :
-                (adapt, output_file) = adapt_and_line
-                if user_args.verbose :
-                    print "Read '%s' start with %s... and go to %s" % (read.name, read.seq[ : len( adapt ) ], adapt)
-                read.cut_start( len( adapt ) )
-                output_file.write( "%s" % str( read ) )
-                nb_reads_writen[ adapt ][ 1 ] += 1
+    if user_args.threads > 1 :
+        demultiplex_parallel( user_args, selector, output_files_by_adapt, defaults_files, nb_reads_writen,
+                              stages, stage_counts, report, checkpoint, ranges )
+    else :
+        demultiplex_serial( user_args, selector, output_files_by_adapt, defaults_files, nb_reads_writen,
+                            stages, stage_counts, report, checkpoint, ranges )
 
-        user_args.fastq_1.close()
+    start = time.time()
+    user_args.fastq_1.close()
+    if user_args.fastq_2 is not None :
+        user_args.fastq_2.close()
 
-        for adapt, output_file in output_files_by_adapt :
+    for line in output_files_by_adapt + [ ( '*', ) + tuple( defaults_files ) ] :
+        for output_file in line[ 1 : ] :
             if not output_file.closed:
                 output_file.write("")
             output_file.close()
-        if not default_file.closed:
-            default_file.write("")
-        default_file.close()
+    report.add_time( "close", time.time() - start )
 
-    else :
-        print "paired-end"
-        (default_file_1, default_file_2) = defaults_files
+    if writer is not None :
+        start = time.time()
+        writer.close()
+        report.add_time( "close", time.time() - start )
 
-        for str_read_1, str_read_2 in izip( user_args.fastq_1, user_args.fastq_2 ) :
-            read_1 = Fastq_read( str_read_1 )
-            read_2 = Fastq_read( str_read_2 )
+    if checkpoint is not None :
+        checkpoint.save( [ None ] * len( checkpoint.inputs ), report.nb_reads, True )
 
-            adapt_and_line = select_output_file.select( read_1.seq, read_2.seq )
-            
-            if adapt_and_line is None :
-                default_file_1.write( "%s" % str( read_1 ) )
-                default_file_2.write( "%s" % str( read_2 ) )
-                nb_reads_writen[ '*' ][1] += 1
+    # the reads which are not rescued are in the new trash files.
+    for path in rescued_paths :
+        os.remove( path )
 
-            else :
-                (adapt, output_file_1, output_file_2 ) = adapt_and_line
+    # show stat.
+    for adapt in adapt_order :
+        print "%s %d reads" % tuple( nb_reads_writen[ adapt ] )
 
-                read_1.cut_start( len( adapt ) )
-                read_2.cut_start( len( adapt ) )
+    for (name_tag, event), nb_reads in sorted( stage_counts.items() ) :
+        print "%s %s %d reads" % ( name_tag, event, nb_reads )
 
-                output_file_1.write( "%s" % str( read_1 ) )
-                output_file_2.write( "%s" % str( read_2 ) )
-                nb_reads_writen[ adapt ][1] += 1
+    if isinstance( selector, Dual_selector ) :
+        unexpected = sorted( selector.unexpected.items(), key=lambda item : ( -item[ 1 ], item[ 0 ] ) )
+        for (barcode_1, barcode_2), nb_reads in unexpected :
+            print "unexpected %s %s %d reads" % ( barcode_1, barcode_2, nb_reads )
 
-        user_args.fastq_1.close()
-        user_args.fastq_2.close()
+    cache_stats = selector.get_cache_stats()
+    if cache_stats is not None :
+        hits, misses = cache_stats
+        print "adaptor cache: %d hits, %d misses (%.1f%% hit rate)" % ( hits, misses, 100.0 * hits / max( 1, hits + misses ) )
 
-        for adapt, file_1, file_2 in output_files_by_adapt :
-            if not file_1.closed:
-                file_1.write("")
-            file_1.close()
-            if not file_2.closed:
-                file_2.write("")
-            file_2.close()
-        if not default_file_1.closed:
-            default_file_1.write("")
-        default_file_1.close()
-        if not default_file_2.closed:
-            default_file_2.write("")
-        default_file_2.close()
+    tier_stats = selector.get_tier_stats()
+    if tier_stats is not None :
+        nb_exact, nb_fuzzy, nb_fuzzy_selected = tier_stats
+        print "adaptor tiers: %d exact, %d fuzzy (%d selected, %.1f%% of the reads needed fuzzy matching)" % (
+            nb_exact, nb_fuzzy, nb_fuzzy_selected, 100.0 * nb_fuzzy / max( 1, nb_exact + nb_fuzzy ) )
 
-    # show stat.
-    for nb_reads_by_name in nb_reads_writen.values() :
-        print "%s %d reads" % tuple( nb_reads_by_name )
+    if writer is not None :
+        hits, misses, evictions = writer.get_handle_stats()
+        if evictions or user_args.verbose :
+            print "output file handles: %d hits, %d misses, %d evictions" % ( hits, misses, evictions )
+
+    if report_path is not None :
+        report.write( report_path, report.get_summary( nb_reads_writen, adapt_order, stage_counts,
+                                                       selector, writer ) )
+
+
+def main() :
+    user_args = parse_user_argument()
+
+    if user_args.analogy :
+        print_barcode_analysis( user_args.file_adapt, user_args.distance )
+        sys.exit(0)        
+
+    if user_args.manifest is not None :
+        sys.exit( run_manifest( user_args ) )
+
+    if user_args.merge_shards is not None :
+        merge_shards( user_args.output_prefix, user_args.merge_shards )
+        sys.exit( 0 )
+
+    demultiplex( user_args )
 
 
 if __name__ == '__main__':
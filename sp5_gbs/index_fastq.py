@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+AUTHOR
+       Written by Vincent MAILLOL (modified by Gautier Sarah)
+
+BUGS
+       sarah@supagro.inra.fr
+
+COPYRIGHT
+       Copyright © 2011 DAVEM, 2014 AGAP.  Licence  GPLv3+ :  GNU
+       GPL version 3 ou supérieures <http://gnu.org/licenses/gpl.html>
+       This program is free software; you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation; either version 3 of the License, or
+       (at your option) any later version.
+
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+       You should have received a copy of the GNU General Public License
+       along with this program; if not, see <http://www.gnu.org/licenses/> or
+       write to the Free Software Foundation, Inc.,
+       51 Franklin Street, Fifth Floor, Boston,
+       MA 02110-1301, USA.
+
+
+"""
+
+import sys
+sys.path.append("")
+from davem_fastq import Fastq_file, Fastq_index
+import argparse
+import os
+
+
+def parse_user_argument() :
+    """
+    Recover user argument
+    """
+    parser = argparse.ArgumentParser( description="index the reads of fastq files and print their number of reads" )
+
+    parser.add_argument( '-V', '--version', action='version', help="Print the version and license",
+                         version="%(prog)s 1.0\nCopyright (C) 2011 DAVEM, 2014 AGAP\nGPL3+\nWritten by Vincent Maillol" )
+
+    parser.add_argument( 'inputs', metavar="FASTQ", nargs='+', action='store',
+                         help="Fastq files to index, the index of FASTQ is written in FASTQ.fqi" )
+
+    parser.add_argument( '-s', '--step', dest="step", action='store', type=int, default=1024,
+                         help="Index one read every STEP reads (default: %(default)s)" )
+
+    parser.add_argument( '-f', '--force', dest="force", action='store_true',
+                         help="Rebuild indexes which are up to date" )
+
+    parser.add_argument( '-n', '--split', dest="split", action='store', type=int, default=0,
+                         help="Print the byte ranges of SPLIT parts of each file, "
+                              "as 'file start end first_read nb_reads' lines" )
+
+    user_args = parser.parse_args()
+    if user_args.step < 1 :
+        parser.error( "--step must be at least 1" )
+    return user_args
+
+
+def main() :
+    user_args = parse_user_argument()
+    for path in user_args.inputs :
+        if user_args.force and os.path.exists( path + Fastq_index.suffix ) :
+            os.remove( path + Fastq_index.suffix )
+        fastq = Fastq_file( path, "r" )
+        print "%s\t%d" % ( path, fastq.get_index( user_args.step ).nb_reads )
+        if user_args.split :
+            for start, end, first, nb_reads in fastq.split_ranges( user_args.split ) :
+                print "%s\t%d\t%d\t%d\t%d" % ( path, start, end, first, nb_reads )
+        fastq.close()
+
+
+if __name__ == '__main__':
+    main()
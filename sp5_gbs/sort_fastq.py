@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+AUTHOR
+       Written by Vincent MAILLOL (modified by Gautier Sarah)
+
+BUGS
+       sarah@supagro.inra.fr
+
+COPYRIGHT
+       Copyright © 2011 DAVEM, 2014 AGAP.  Licence  GPLv3+ :  GNU
+       GPL version 3 ou supérieures <http://gnu.org/licenses/gpl.html>
+       This program is free software; you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation; either version 3 of the License, or
+       (at your option) any later version.
+
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+       You should have received a copy of the GNU General Public License
+       along with this program; if not, see <http://www.gnu.org/licenses/> or
+       write to the Free Software Foundation, Inc.,
+       51 Franklin Street, Fifth Floor, Boston,
+       MA 02110-1301, USA.
+
+
+"""
+
+import sys
+sys.path.append("")
+from davem_fastq import Fastq_file
+import argparse
+
+
+def parse_user_argument() :
+    """
+    Recover user argument
+    """
+    parser = argparse.ArgumentParser( description="sort a fastq file on read names with a bounded memory" )
+
+    parser.add_argument( '-V', '--version', action='version', help="Print the version and license",
+                         version="%(prog)s 1.0\nCopyright (C) 2011 DAVEM, 2014 AGAP\nGPL3+\nWritten by Vincent Maillol" )
+
+    parser.add_argument( 'input', metavar="INPUT", action='store',
+                         help="Fastq file to sort, can be gzip compressed" )
+
+    parser.add_argument( 'output', metavar="OUTPUT", action='store',
+                         help="Sorted fastq file, gzip compressed if it ends with .gz" )
+
+    parser.add_argument( '-m', '--max-memory', dest="max_memory", action='store', type=int, default=512,
+                         help="Memory in MB used to sort runs of reads before merging them (default: %(default)s)" )
+
+    parser.add_argument( '-t', '--threads', dest="threads", action='store', type=int, default=1,
+                         help="Number of processes sorting runs in parallel, they share MAX_MEMORY (default: %(default)s)" )
+
+    parser.add_argument( '-T', '--tmp-dir', dest="tmp_dir", action='store', default=None,
+                         help="Directory of the temporary sorted runs (default: system temporary directory)" )
+
+    return parser.parse_args()
+
+
+def main() :
+    user_args = parse_user_argument()
+    fastq = Fastq_file( user_args.input, "r" )
+    fastq.sort( user_args.output, user_args.max_memory * 1024 * 1024,
+                user_args.threads, user_args.tmp_dir )
+    fastq.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+AUTHOR
+       Written by Vincent MAILLOL (modified by Gautier Sarah)
+
+BUGS
+       sarah@supagro.inra.fr
+
+COPYRIGHT
+       Copyright © 2011 DAVEM, 2014 AGAP.  Licence  GPLv3+ :  GNU
+       GPL version 3 ou supérieures <http://gnu.org/licenses/gpl.html>
+       This program is free software; you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation; either version 3 of the License, or
+       (at your option) any later version.
+
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+       You should have received a copy of the GNU General Public License
+       along with this program; if not, see <http://www.gnu.org/licenses/> or
+       write to the Free Software Foundation, Inc.,
+       51 Franklin Street, Fifth Floor, Boston,
+       MA 02110-1301, USA.
+
+
+"""
+
+import sys
+sys.path.append("")
+from davem_fastq import Fastq_file, Fastq_read, Fastq_writer, sort_reads
+import argparse
+import os
+import time
+import tempfile
+from collections import deque
+from itertools import chain
+from operator import methodcaller
+
+
+class Pending_reads( object ) :
+    """
+    Reads of one file waiting for their mate.
+
+    reads gives ( number of the read in the file, read ) by pair name,
+    order keeps ( number, pair name ) in the order of the file. A read
+    which found its mate stays in order until it comes first.
+    """
+    def __init__( self ) :
+        self.reads = {}
+        self.order = deque()
+        self.size = 0
+
+    def __len__( self ) :
+        return len( self.reads )
+
+    def __contains__( self, key ) :
+        return key in self.reads
+
+    def add( self, key, number, str_read ) :
+        """
+        Add a read, return the read which had the same name or None.
+        """
+        replaced = self.reads.get( key )
+        if replaced is not None :
+            self.size -= len( replaced[ 1 ] )
+            replaced = replaced[ 1 ]
+        self.reads[ key ] = ( number, str_read )
+        self.order.append( ( number, key ) )
+        self.size += len( str_read )
+        return replaced
+
+    def pop( self, key ) :
+        """
+        Remove the read of key.
+        return - ( number, read )
+        """
+        number, str_read = self.reads.pop( key )
+        self.size -= len( str_read )
+        return number, str_read
+
+    def pop_before( self, number ) :
+        """
+        Remove the reads whose number is lower than number and return
+        them in the order of the file as ( number, key, read ).
+        """
+        reads = []
+        order = self.order
+        while order and order[ 0 ][ 0 ] < number :
+            read_number, key = order.popleft()
+            read = self.reads.get( key )
+            if read is not None and read[ 0 ] == read_number :
+                reads.append( ( read_number, key, self.pop( key )[ 1 ] ) )
+        return reads
+
+    def update( self, other ) :
+        """
+        Move the reads of other in this one, return the reads which had
+        the same name.
+        """
+        replaced = []
+        for read_number, key, str_read in other.pop_before( float( "inf" ) ) :
+            read = self.add( key, read_number, str_read )
+            if read is not None :
+                replaced.append( read )
+        return replaced
+
+    def pop_all( self ) :
+        """
+        Remove all the reads and return them.
+        """
+        reads = [ str_read for number, str_read in sorted( self.reads.values() ) ]
+        self.reads.clear()
+        self.order.clear()
+        self.size = 0
+        return reads
+
+
+def guess_format( path ) :
+    """
+    Return "Casava1.8" if the first read of path has a member in its meta
+    data ('@name 1:N:0:ACGT'), "Illumina" otherwise ('@name/1').
+    """
+    fastq = Fastq_file( path, "r" )
+    read = next( iter( fastq.records( 64 * 1024 ) ), None )
+    fastq.close()
+    if read is not None and read.get_name_meta_data() and read.get_member( "Casava1.8" ) is not None :
+        return "Casava1.8"
+    return "Illumina"
+
+
+def synchronize( records_1, records_2, key, outputs, stats, window ) :
+    """
+    Write the pairs of the iterators of reads records_1 and records_2 in
+    outputs[ 0 ] and outputs[ 1 ], the reads without mate in outputs[ 2 ]
+    and outputs[ 3 ].
+
+    Both files must keep the order of the sequencer, some reads being
+    removed. The current reads of both files are written if they are a
+    pair. Otherwise, if the mate of one of them waits in the
+    Pending_reads of the other file, they are written and only this
+    file goes on, else both reads wait and both files go on, so that
+    the files are in step again after a read without mate.
+
+    Once a later read of its file found a mate, a waiting read has no
+    mate if the order is kept: it is flushed when window more reads of
+    its file are read. If it finds a mate before, the files are not in
+    the same order. A flushed read is only written as single when
+    2 * window more reads of its file are read, if its mate comes
+    before, the files are not in the same order either and no pair is
+    lost. The number of waiting and flushed reads and their size are
+    kept in the high-water marks of stats.
+
+    Return None when both files are read. When the files are not in the
+    same order or more than 2 * window reads wait, return the
+    Pending_reads of both files at once with the flushed and current
+    reads in them, merge_sorted must go on from there.
+    """
+    pair_1, pair_2, single_1, single_2 = outputs
+    pending = ( Pending_reads(), Pending_reads() )
+    flushed = ( Pending_reads(), Pending_reads() )
+    singles = ( single_1, single_2 )
+    records = ( records_1, records_2 )
+    # number of the current read and of the last read of each file which
+    # found its mate. Pairs read in step are only counted in in_step until
+    # a read has no mate.
+    numbers = [ 0, 0 ]
+    matched = [ -1, -1 ]
+    in_step = 0
+    read_1 = next( records_1, None )
+    read_2 = next( records_2, None )
+    key_1 = read_1 is not None and key( read_1 )
+    key_2 = read_2 is not None and key( read_2 )
+    while read_1 is not None or read_2 is not None :
+        if key_1 == key_2 :
+            pair_1.write_record( read_1 )
+            pair_2.write_record( read_2 )
+            in_step += 1
+            read_1 = next( records_1, None )
+            key_1 = read_1 is not None and key( read_1 )
+            read_2 = next( records_2, None )
+            key_2 = read_2 is not None and key( read_2 )
+            continue
+
+        if in_step :
+            stats[ "pairs" ] += in_step
+            numbers[ 0 ] += in_step
+            numbers[ 1 ] += in_step
+            matched[ 0 ] = numbers[ 0 ] - 1
+            matched[ 1 ] = numbers[ 1 ] - 1
+            in_step = 0
+
+        reads = ( read_1, read_2 )
+        keys = ( key_1, key_2 )
+        for side in ( 0, 1 ) :
+            if reads[ side ] is not None and keys[ side ] in pending[ 1 - side ] :
+                break
+        else :
+            side = None
+
+        if side is None and ( ( read_1 is not None and key_1 in flushed[ 1 ] )
+                              or ( read_2 is not None and key_2 in flushed[ 0 ] ) ) :
+            # the mate of a read flushed as single comes after it.
+            stats[ "unordered" ] = True
+            advance = ()
+
+        elif side is None :
+            for side in ( 0, 1 ) :
+                if reads[ side ] is None :
+                    continue
+                if reads[ 1 - side ] is None :
+                    # the other file is read, no mate can come.
+                    singles[ side ].write_record( reads[ side ] )
+                    stats[ "singles" ][ side ] += 1
+                    continue
+                replaced = pending[ side ].add( keys[ side ], numbers[ side ], str( reads[ side ] ) )
+                if replaced is not None :
+                    singles[ side ].write_record( replaced )
+                    stats[ "singles" ][ side ] += 1
+            advance = ( 0, 1 )
+
+        else :
+            other = pending[ 1 - side ]
+            mate_number, mate = other.pop( keys[ side ] )
+            if mate_number < matched[ 1 - side ] :
+                other.add( keys[ side ], mate_number, mate )
+                stats[ "unordered" ] = True
+                advance = ()
+            else :
+                if side == 0 :
+                    pair_1.write_record( read_1 )
+                    pair_2.write_record( mate )
+                else :
+                    pair_1.write_record( mate )
+                    pair_2.write_record( read_2 )
+                stats[ "pairs" ] += 1
+                matched[ side ] = numbers[ side ]
+                matched[ 1 - side ] = mate_number
+                advance = ( side, )
+
+        for side in ( 0, 1 ) :
+            if stats[ "unordered" ] :
+                # the waiting and flushed reads are all sorted.
+                break
+            for number, read_key, str_read in pending[ side ].pop_before( min( matched[ side ], numbers[ side ] - window ) ) :
+                flushed[ side ].add( read_key, number, str_read )
+            for number, read_key, str_read in flushed[ side ].pop_before( numbers[ side ] - 2 * window ) :
+                singles[ side ].write_record( str_read )
+                stats[ "singles" ][ side ] += 1
+        nb_pending = len( pending[ 0 ] ) + len( pending[ 1 ] )
+        nb_waiting = nb_pending + len( flushed[ 0 ] ) + len( flushed[ 1 ] )
+        if nb_waiting > stats[ "max_pending" ] :
+            stats[ "max_pending" ] = nb_waiting
+        stats[ "max_pending_bytes" ] = max( stats[ "max_pending_bytes" ], pending[ 0 ].size + pending[ 1 ].size
+                                                                          + flushed[ 0 ].size + flushed[ 1 ].size )
+
+        if 0 in advance :
+            numbers[ 0 ] += 1
+            read_1 = next( records_1, None )
+            key_1 = read_1 is not None and key( read_1 )
+        if 1 in advance :
+            numbers[ 1 ] += 1
+            read_2 = next( records_2, None )
+            key_2 = read_2 is not None and key( read_2 )
+
+        if stats[ "unordered" ] or nb_pending > 2 * window :
+            # the flushed and current reads wait with the others to be sorted.
+            for side, read, read_key in ( ( 0, read_1, key_1 ), ( 1, read_2, key_2 ) ) :
+                for str_read in pending[ side ].update( flushed[ side ] ) :
+                    singles[ side ].write_record( str_read )
+                    stats[ "singles" ][ side ] += 1
+                if read is not None :
+                    pending[ side ].add( read_key, numbers[ side ], str( read ) )
+            return pending
+
+    stats[ "pairs" ] += in_step
+    for side in ( 0, 1 ) :
+        for str_read in flushed[ side ].pop_all() + pending[ side ].pop_all() :
+            singles[ side ].write_record( str_read )
+            stats[ "singles" ][ side ] += 1
+    return None
+
+
+def merge_sorted( pending, records, key, outputs, stats, max_memory=512 * 1024 * 1024, processes=1, tmp_dir=None ) :
+    """
+    Synchronize the reads of pending (a Pending_reads by file) and the
+    rest of the iterators records in any order: both are sorted on the
+    pair name in temporary files with the bounded memory sort of
+    davem_fastq, which are then read together.
+    """
+    def count( reads ) :
+        for read in reads :
+            stats[ "sorted" ] += 1
+            yield read
+
+    paths = []
+    try :
+        for side in ( 0, 1 ) :
+            fd, path = tempfile.mkstemp( suffix=".fastq", dir=tmp_dir )
+            os.close( fd )
+            paths.append( path )
+            waiting = [ Fastq_read( str_read ) for str_read in pending[ side ].pop_all() ]
+            sort_reads( count( chain( waiting, records[ side ] ) ), path, max_memory, processes, tmp_dir, key )
+            del waiting
+
+        pair_1, pair_2, single_1, single_2 = outputs
+        sorted_files = [ Fastq_file( path, "r" ) for path in paths ]
+        records_1, records_2 = [ iter( sorted_file.records() ) for sorted_file in sorted_files ]
+        read_1 = next( records_1, None )
+        read_2 = next( records_2, None )
+        while read_1 is not None and read_2 is not None :
+            key_1 = key( read_1 )
+            key_2 = key( read_2 )
+            if key_1 == key_2 :
+                pair_1.write_record( read_1 )
+                pair_2.write_record( read_2 )
+                stats[ "pairs" ] += 1
+                read_1 = next( records_1, None )
+                read_2 = next( records_2, None )
+            elif key_1 < key_2 :
+                single_1.write_record( read_1 )
+                stats[ "singles" ][ 0 ] += 1
+                read_1 = next( records_1, None )
+            else :
+                single_2.write_record( read_2 )
+                stats[ "singles" ][ 1 ] += 1
+                read_2 = next( records_2, None )
+
+        for side, read, records, single in ( ( 0, read_1, records_1, single_1 ), ( 1, read_2, records_2, single_2 ) ) :
+            if read is not None :
+                for read in chain( [ read ], records ) :
+                    single.write_record( read )
+                    stats[ "singles" ][ side ] += 1
+
+        for sorted_file in sorted_files :
+            sorted_file.close()
+
+    finally :
+        for path in paths :
+            if os.path.exists( path ) :
+                os.remove( path )
+
+
+def get_output_name( path, suffix ) :
+    """
+    Return the name of an output file of path, in the current directory:
+    dir/sample_R1.fastq.gz gives sample_R1SUFFIX.fastq.gz
+    """
+    name = os.path.basename( path )
+    extension = ".fastq"
+    if name.endswith( ".gz" ) :
+        name = name[ : -3 ]
+        extension += ".gz"
+    return os.path.splitext( name )[ 0 ] + suffix + extension
+
+
+def get_peak_rss() :
+    """
+    Return the peak resident memory of the process in kB.
+    """
+    import resource
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+
+def parse_user_argument() :
+    """
+    Recover user argument
+    """
+    parser = argparse.ArgumentParser( description="synchronize paired fastq files whose reads were filtered: pairs are written in the same order in two files and reads without mate in singles files" )
+
+    parser.add_argument( '-V', '--version', action='version', help="Print the version and license",
+                         version="%(prog)s 1.0\nCopyright (C) 2011 DAVEM, 2014 AGAP\nGPL3+\nWritten by Vincent Maillol" )
+
+    parser.add_argument( '-f', '--forward', dest="forward", action='store', required=True,
+                         help="Fastq file of the first members of pairs, can be gzip compressed" )
+
+    parser.add_argument( '-r', '--reverse', dest="reverse", action='store', required=True,
+                         help="Fastq file of the second members of pairs, can be gzip compressed" )
+
+    parser.add_argument( '-of', '--output_forward', dest="output_forward", action='store', default=None,
+                         help="Paired reads of FORWARD, gzip compressed if it ends with .gz (default: FORWARD name with _paired, in the current directory)" )
+
+    parser.add_argument( '-or', '--output_reverse', dest="output_reverse", action='store', default=None,
+                         help="Paired reads of REVERSE (default: REVERSE name with _paired)" )
+
+    parser.add_argument( '-os', '--output_single', dest="output_single", action='store', default=None,
+                         help="Reads of FORWARD without mate (default: FORWARD name with _single)" )
+
+    parser.add_argument( '-ors', '--output_reverse_single', dest="output_reverse_single", action='store', default=None,
+                         help="Reads of REVERSE without mate (default: REVERSE name with _single)" )
+
+    parser.add_argument( '--format', dest="format", action='store', choices=( "auto", "Casava1.8", "Illumina" ), default="auto",
+                         help="Names of members of a pair: '@name 1:N:0:ACGT' for Casava1.8, '@name/1' for Illumina, auto looks at the first read (default: %(default)s)" )
+
+    parser.add_argument( '-w', '--window', dest="window", action='store', type=int, default=1000000,
+                         help="Files are expected in the order of the sequencer, with removed reads. A read is taken as without mate once WINDOW more reads of its file are read, and written as such 2 * WINDOW reads later. If a read finds its mate out of order, even a read taken as without mate, or more than 2 * WINDOW reads wait, the rest of the files is synchronized by sorting them on disk, so no pair is lost when reads are less than 2 * WINDOW reads out of order (default: %(default)s)" )
+
+    parser.add_argument( '--sort', dest="sort", action='store_true',
+                         help="Files are not in the same order, synchronize them by sorting from the start" )
+
+    parser.add_argument( '-m', '--max-memory', dest="max_memory", action='store', type=int, default=512,
+                         help="Memory in MB used to sort runs of reads (default: %(default)s)" )
+
+    parser.add_argument( '-t', '--threads', dest="threads", action='store', type=int, default=1,
+                         help="Number of processes sorting runs in parallel, they share MAX_MEMORY (default: %(default)s)" )
+
+    parser.add_argument( '-T', '--tmp-dir', dest="tmp_dir", action='store', default=None,
+                         help="Directory of the temporary sorted files (default: system temporary directory)" )
+
+    user_args = parser.parse_args()
+    if user_args.window < 1 :
+        parser.error( "--window must be at least 1" )
+    if user_args.output_forward is None :
+        user_args.output_forward = get_output_name( user_args.forward, "_paired" )
+    if user_args.output_reverse is None :
+        user_args.output_reverse = get_output_name( user_args.reverse, "_paired" )
+    if user_args.output_single is None :
+        user_args.output_single = get_output_name( user_args.forward, "_single" )
+    if user_args.output_reverse_single is None :
+        user_args.output_reverse_single = get_output_name( user_args.reverse, "_single" )
+    return user_args
+
+
+def main() :
+    user_args = parse_user_argument()
+    start = time.time()
+
+    format = user_args.format
+    if format == "auto" :
+        format = guess_format( user_args.forward )
+    key = methodcaller( "get_pair_name", format )
+
+    inputs = [ Fastq_file( user_args.forward, "r" ), Fastq_file( user_args.reverse, "r" ) ]
+    records = [ iter( fastq.records() ) for fastq in inputs ]
+    writer = Fastq_writer()
+    outputs = [ writer.open( path, "w" ) for path in ( user_args.output_forward, user_args.output_reverse,
+                                                      user_args.output_single, user_args.output_reverse_single ) ]
+    stats = { "pairs" : 0, "singles" : [ 0, 0 ], "max_pending" : 0, "max_pending_bytes" : 0, "sorted" : 0,
+              "unordered" : False }
+
+    if user_args.sort :
+        pending = ( Pending_reads(), Pending_reads() )
+    else :
+        pending = synchronize( records[ 0 ], records[ 1 ], key, outputs, stats, user_args.window )
+        if stats[ "unordered" ] :
+            print "files are not in the same order, sort the rest of them"
+        elif pending is not None :
+            print "more than %d reads wait for their mate, sort the rest of the files" % ( 2 * user_args.window )
+    if pending is not None :
+        merge_sorted( pending, records, key, outputs, stats, user_args.max_memory * 1024 * 1024,
+                      user_args.threads, user_args.tmp_dir )
+
+    for fastq in inputs :
+        fastq.close()
+    for output in outputs :
+        output.write( "" )
+        output.close()
+    writer.close()
+
+    print "format: %s" % format
+    print "%d pairs" % stats[ "pairs" ]
+    print "%d reads of %s without mate" % ( stats[ "singles" ][ 0 ], user_args.forward )
+    print "%d reads of %s without mate" % ( stats[ "singles" ][ 1 ], user_args.reverse )
+    print "at most %d reads (%d bytes) waited for their mate" % ( stats[ "max_pending" ], stats[ "max_pending_bytes" ] )
+    if stats[ "sorted" ] :
+        print "%d reads synchronized by sorting" % stats[ "sorted" ]
+    print "peak memory: %d kB" % get_peak_rss()
+    print "duration: %.1f s" % ( time.time() - start )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+Benchmark of the demultadapt selectors and of the davem_fastq parse and
+write paths on synthetic paired-end reads.
+
+The reads and barcodes are drawn from a seeded random generator, so two
+runs with the same options work on the same data. Each benchmark runs in
+a forked process: its peak resident memory is measured alone.
+
+COPYRIGHT
+       Copyright © 2014 AGAP.  Licence  GPLv3+ :  GNU
+       GPL version 3 ou supérieures <http://gnu.org/licenses/gpl.html>
+"""
+
+import sys, os
+ARCAD_HTS_DIR = os.path.abspath( os.path.join( os.path.dirname( __file__ ), "..", ".." ) )
+sys.path.insert( 0, os.path.join( ARCAD_HTS_DIR, "lib" ) )
+sys.path.insert( 0, os.path.join( ARCAD_HTS_DIR, "sp5_gbs" ) )
+
+import argparse
+import cPickle
+import random
+import shutil
+import tempfile
+import time
+from itertools import izip
+
+from davem_fastq import Fastq_file, Fastq_read, Fastq_writer
+import demultadapt
+
+ENZYME_OVERHANG = "TGCAG"
+SELECTORS = ( "std", "hamming", "trie", "levenshtein", "levenshtein-all", "numpy" )
+
+
+def generate_barcodes( rng, nb_barcodes, min_length, max_length ) :
+    """
+    Return nb_barcodes distinct barcodes with lengths between min_length
+    and max_length. No barcode is a prefix of another one.
+    """
+    barcodes = set()
+    failures = 0
+    while len( barcodes ) < nb_barcodes :
+        barcode = "".join( [ rng.choice( "ACGT" ) for i in xrange( rng.randint( min_length, max_length ) ) ] )
+        if barcode in barcodes or [ other for other in barcodes
+                                    if other.startswith( barcode ) or barcode.startswith( other ) ] :
+            failures += 1
+            if failures > 10000 :
+                raise ValueError( "can not draw %d barcodes of %d to %d bases, none being a prefix of another"
+                                  % ( nb_barcodes, min_length, max_length ) )
+            continue
+        barcodes.add( barcode )
+    return sorted( barcodes )
+
+
+def generate_reads( rng, path_1, path_2, barcodes, nb_reads, read_length, error_rate, trash_rate ) :
+    """
+    Write nb_reads pairs in path_1 and path_2.
+
+    The first read starts with a barcode, each of its bases substituted
+    with probability error_rate, then with ENZYME_OVERHANG. A proportion
+    trash_rate of the pairs has no barcode. The second read is random.
+    """
+    qualities = [ "".join( [ chr( 33 + rng.randint( 20, 40 ) ) for i in xrange( read_length ) ] )
+                  for j in xrange( 64 ) ]
+    random_bases = "".join( [ rng.choice( "ACGT" ) for i in xrange( 1 << 16 ) ] )
+
+    def random_sequence( length ) :
+        start = rng.randint( 0, len( random_bases ) - length )
+        return random_bases[ start : start + length ]
+
+    file_1 = open( path_1, "w" )
+    file_2 = open( path_2, "w" )
+    for i in xrange( nb_reads ) :
+        if rng.random() < trash_rate :
+            sequence_1 = random_sequence( read_length )
+        else :
+            barcode = list( rng.choice( barcodes ) )
+            for pos in xrange( len( barcode ) ) :
+                if rng.random() < error_rate :
+                    barcode[ pos ] = rng.choice( [ base for base in "ACGTN" if base != barcode[ pos ] ] )
+            sequence_1 = "".join( barcode ) + ENZYME_OVERHANG
+            sequence_1 += random_sequence( read_length - len( sequence_1 ) )
+        sequence_2 = random_sequence( read_length )
+        file_1.write( "@bench:%d 1:N:0:1\n%s\n+\n%s\n" % ( i, sequence_1, rng.choice( qualities ) ) )
+        file_2.write( "@bench:%d 2:N:0:1\n%s\n+\n%s\n" % ( i, sequence_2, rng.choice( qualities ) ) )
+    file_1.close()
+    file_2.close()
+
+
+def run_isolated( function, *args ) :
+    """
+    Run function( *args ) in a forked process.
+    Return ( result, peak_rss_kb ) where peak_rss_kb is the peak resident
+    memory of the forked process.
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0 :
+        os.close( read_end )
+        status = 0
+        try :
+            try :
+                message = ( True, function( *args ) )
+            except Exception, e :
+                message = ( False, "%s: %s" % ( type( e ).__name__, e ) )
+                status = 1
+            output = os.fdopen( write_end, "w" )
+            cPickle.dump( message, output, cPickle.HIGHEST_PROTOCOL )
+            output.close()
+        finally :
+            os._exit( status )
+
+    os.close( write_end )
+    input = os.fdopen( read_end )
+    data = input.read()
+    input.close()
+    rusage = os.wait4( pid, 0 )[ 2 ]
+    if not data :
+        raise RuntimeError( "benchmark process died" )
+    ok, result = cPickle.loads( data )
+    if not ok :
+        raise RuntimeError( result )
+    return result, rusage.ru_maxrss
+
+
+def read_pairs( path_1, path_2, baseline=False ) :
+    """
+    Yield the pairs of reads of both files, with Fastq_file.records or,
+    if baseline is True, with a Fastq_read by string of Fastq_file.next
+    as demultadapt did before the records.
+    """
+    fastq_1 = Fastq_file( path_1, "r" )
+    fastq_2 = Fastq_file( path_2, "r" )
+    try :
+        if baseline :
+            for str_read_1, str_read_2 in izip( fastq_1, fastq_2 ) :
+                yield Fastq_read( str_read_1 ), Fastq_read( str_read_2 )
+        else :
+            for pair in izip( fastq_1.records(), fastq_2.records() ) :
+                yield pair
+    finally :
+        fastq_1.close()
+        fastq_2.close()
+
+
+def bench_parse( path_1, path_2, baseline=False ) :
+    """
+    Iterate over the pairs of reads of both files, see read_pairs.
+    """
+    start = time.time()
+    nb_reads = 0
+    for read_1, read_2 in read_pairs( path_1, path_2, baseline ) :
+        nb_reads += 1
+    return nb_reads, time.time() - start
+
+
+def bench_write( path_1, path_2, tmp_dir, nb_outputs, method, stream=False ) :
+    """
+    Cut 8 bases of each read and write the pairs in nb_outputs pairs of
+    files. method is:
+        baseline - reads of Fastq_file.next written with Fastq_file.write( str( read ) )
+        direct   - records written with Fastq_file.write_record
+        buffered - records written through a Fastq_writer
+    The reads are parsed before the timing, or while they are written if
+    stream is True, as demultadapt does.
+    """
+    reads = read_pairs( path_1, path_2, method == "baseline" )
+    if not stream :
+        reads = list( reads )
+
+    start = time.time()
+    writer = None
+    if method == "buffered" :
+        writer = Fastq_writer()
+    outputs = []
+    for i in xrange( nb_outputs ) :
+        pair = []
+        for member in ( 1, 2 ) :
+            path = os.path.join( tmp_dir, "out-%d_%d.fastq" % ( i, member ) )
+            if writer is None :
+                pair.append( Fastq_file( path, "w" ) )
+            else :
+                pair.append( writer.open( path, "w" ) )
+        outputs.append( pair )
+
+    nb_reads = 0
+    for i, ( read_1, read_2 ) in enumerate( reads ) :
+        nb_reads += 1
+        output_1, output_2 = outputs[ i % nb_outputs ]
+        read_1.cut_start( 8 )
+        read_2.cut_start( 8 )
+        if method == "baseline" :
+            output_1.write( str( read_1 ) )
+            output_2.write( str( read_2 ) )
+        else :
+            output_1.write_record( read_1 )
+            output_2.write_record( read_2 )
+
+    for pair in outputs :
+        for output in pair :
+            if not output.closed :
+                output.write( "" )
+            output.close()
+    if writer is not None :
+        writer.close()
+    return nb_reads, time.time() - start
+
+
+def get_selector( name, barcodes, rate, mismatches, cache_size ) :
+    """
+    Return the paired-end selector name for barcodes.
+    """
+    table = [ ( barcode, i, i ) for i, barcode in enumerate( barcodes ) ]
+    if name == "std" :
+        return demultadapt.Std_selector( table, False )
+    if name == "hamming" :
+        return demultadapt.Hamming_selector( table, False, mismatches )
+    if name == "trie" :
+        return demultadapt.Trie_selector( table, False, mismatches )
+    if name == "levenshtein" :
+        return demultadapt.Levenshtein_selector( table, False, rate, cache_size )
+    if name == "levenshtein-all" :
+        return demultadapt.LevenshteinAllSelector( table, False, rate, cache_size )
+    if name == "numpy" :
+        return demultadapt.Numpy_hamming_selector( table, False, rate )
+    raise ValueError( "unknown selector %s" % name )
+
+
+def bench_selector( path_1, path_2, name, barcodes, rate, mismatches, cache_size, batch_size=4096 ) :
+    """
+    Select the adaptator of every pair, by batches as demultadapt does.
+    The time to build the selector is included.
+    """
+    sequences_1 = []
+    sequences_2 = []
+    for read_1, read_2 in read_pairs( path_1, path_2 ) :
+        sequences_1.append( read_1.seq )
+        sequences_2.append( read_2.seq )
+
+    start = time.time()
+    selector = get_selector( name, barcodes, rate, mismatches, cache_size )
+    nb_selected = 0
+    for i in xrange( 0, len( sequences_1 ), batch_size ) :
+        lines = selector.select_batch( sequences_1[ i : i + batch_size ], sequences_2[ i : i + batch_size ] )
+        nb_selected += len( lines ) - lines.count( None )
+    return len( sequences_1 ), time.time() - start, nb_selected
+
+
+def parse_user_argument() :
+    """
+    Recover user argument
+    """
+    parser = argparse.ArgumentParser( description="benchmark demultadapt selectors and fastq parse and write paths" )
+
+    parser.add_argument( '-b', '--barcodes', dest="barcodes", action='store', default="12,96,384",
+                         help="Comma separated numbers of barcodes, each one is a benchmark (default: %(default)s)" )
+
+    parser.add_argument( '--min-length', dest="min_length", action='store', type=int, default=6,
+                         help="Minimal length of barcodes (default: %(default)s)" )
+
+    parser.add_argument( '--max-length', dest="max_length", action='store', type=int, default=9,
+                         help="Maximal length of barcodes. The numpy selector needs barcodes of the same length, it is run on other reads whose barcodes all have MAX_LENGTH bases (default: %(default)s)" )
+
+    parser.add_argument( '-n', '--reads', dest="reads", action='store', type=int, default=20000,
+                         help="Number of read pairs (default: %(default)s)" )
+
+    parser.add_argument( '--read-length', dest="read_length", action='store', type=int, default=100,
+                         help="Length of reads (default: %(default)s)" )
+
+    parser.add_argument( '-e', '--error-rate', dest="error_rate", action='store', type=float, default=0.01,
+                         help="Probability of a substitution in each base of barcodes (default: %(default)s)" )
+
+    parser.add_argument( '--trash-rate', dest="trash_rate", action='store', type=float, default=0.02,
+                         help="Proportion of pairs without barcode (default: %(default)s)" )
+
+    parser.add_argument( '-s', '--selectors', dest="selectors", action='store', default=",".join( SELECTORS ),
+                         help="Comma separated selectors among %s (default: all)" % ", ".join( SELECTORS ) )
+
+    parser.add_argument( '-l', '--rate', dest="rate", action='store', type=float, default=0.8,
+                         help="Ratio of the levenshtein and numpy selectors (default: %(default)s)" )
+
+    parser.add_argument( '-m', '--mismatches', dest="mismatches", action='store', type=int, default=1,
+                         help="Substitutions allowed by the hamming and trie selectors (default: %(default)s)" )
+
+    parser.add_argument( '--cache-size', dest="cache_size", action='store', type=int, default=0,
+                         help="Cache size of the levenshtein selectors, 0 measures the distance computation (default: %(default)s)" )
+
+    parser.add_argument( '--outputs', dest="outputs", action='store', type=int, default=96,
+                         help="Number of output pairs of files of the write benchmarks (default: %(default)s)" )
+
+    parser.add_argument( '--seed', dest="seed", action='store', type=int, default=1,
+                         help="Seed of the random generator (default: %(default)s)" )
+
+    parser.add_argument( '-T', '--tmp-dir', dest="tmp_dir", action='store', default=None,
+                         help="Directory of the generated files (default: system temporary directory)" )
+
+    parser.add_argument( '-k', '--keep', dest="keep", action='store_true',
+                         help="Keep the generated files" )
+
+    user_args = parser.parse_args()
+    user_args.barcodes = [ int( nb ) for nb in user_args.barcodes.split( "," ) ]
+    user_args.selectors = user_args.selectors.split( "," )
+    for name in user_args.selectors :
+        if name not in SELECTORS :
+            parser.error( "unknown selector %s" % name )
+    return user_args
+
+
+def main() :
+    user_args = parse_user_argument()
+    rng = random.Random( user_args.seed )
+    tmp_dir = tempfile.mkdtemp( prefix="demultadapt_bench_", dir=user_args.tmp_dir )
+
+    print "# seed %d, %d pairs of %d bp, barcode error rate %g, trash rate %g" % (
+        user_args.seed, user_args.reads, user_args.read_length, user_args.error_rate, user_args.trash_rate )
+    print "# levenshtein backend: %s" % demultadapt.get_distance_backend().name
+    print "\t".join( [ "benchmark", "barcodes", "reads", "seconds", "reads_per_s", "selected", "peak_rss_kb" ] )
+
+    def show( benchmark, nb_barcodes, function, *args ) :
+        try :
+            result, peak_rss = run_isolated( function, *args )
+        except RuntimeError, e :
+            print "\t".join( [ benchmark, str( nb_barcodes ), "-", "-", "-", "-", "-" ] ) + "\t# %s" % e
+        else :
+            nb_reads, seconds = result[ : 2 ]
+            selected = "-"
+            if len( result ) > 2 :
+                selected = str( result[ 2 ] )
+            print "\t".join( [ benchmark, str( nb_barcodes ), str( nb_reads ), "%.3f" % seconds,
+                               "%.0f" % ( nb_reads / max( seconds, 1e-6 ) ), selected, str( peak_rss ) ] )
+        sys.stdout.flush()
+
+    try :
+        for nb_barcodes in user_args.barcodes :
+            barcodes = generate_barcodes( rng, nb_barcodes, user_args.min_length, user_args.max_length )
+            path_1 = os.path.join( tmp_dir, "bench_%d_1.fastq" % nb_barcodes )
+            path_2 = os.path.join( tmp_dir, "bench_%d_2.fastq" % nb_barcodes )
+            generate_reads( rng, path_1, path_2, barcodes, user_args.reads, user_args.read_length,
+                            user_args.error_rate, user_args.trash_rate )
+
+            if nb_barcodes == user_args.barcodes[ 0 ] :
+                show( "parse-next", "-", bench_parse, path_1, path_2, True )
+                show( "parse", "-", bench_parse, path_1, path_2 )
+                for method, benchmark in ( ( "baseline", "write-next" ), ( "direct", "write" ),
+                                           ( "buffered", "write-buffered" ) ) :
+                    show( benchmark, user_args.outputs, bench_write, path_1, path_2, tmp_dir,
+                          user_args.outputs, method )
+                for method, benchmark in ( ( "baseline", "parse-write-next" ), ( "direct", "parse-write" ) ) :
+                    show( benchmark, user_args.outputs, bench_write, path_1, path_2, tmp_dir,
+                          user_args.outputs, method, True )
+
+            fixed = None
+            for name in user_args.selectors :
+                if name == "numpy" and user_args.min_length != user_args.max_length :
+                    # numpy needs barcodes of the same length, they get their own reads.
+                    if fixed is None :
+                        fixed = generate_barcodes( rng, nb_barcodes, user_args.max_length, user_args.max_length )
+                        fixed_path_1 = os.path.join( tmp_dir, "bench_%d_fixed_1.fastq" % nb_barcodes )
+                        fixed_path_2 = os.path.join( tmp_dir, "bench_%d_fixed_2.fastq" % nb_barcodes )
+                        generate_reads( rng, fixed_path_1, fixed_path_2, fixed, user_args.reads,
+                                        user_args.read_length, user_args.error_rate, user_args.trash_rate )
+                    show( "numpy-%dbp" % user_args.max_length, nb_barcodes, bench_selector, fixed_path_1,
+                          fixed_path_2, name, fixed, user_args.rate, user_args.mismatches, user_args.cache_size )
+                    continue
+                show( name, nb_barcodes, bench_selector, path_1, path_2, name, barcodes,
+                      user_args.rate, user_args.mismatches, user_args.cache_size )
+    finally :
+        if user_args.keep :
+            print "# generated files are in %s" % tmp_dir
+        else :
+            shutil.rmtree( tmp_dir )
+
+
+if __name__ == '__main__':
+    main()
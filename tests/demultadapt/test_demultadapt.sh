@@ -202,7 +202,157 @@ function run () {
     cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-rebut.fastq \
         returned-rebut.fastq
     echo "all tests passed successfully!"
+
+    if [ $verbose -gt "0" ]; then
+        echo -e "launch demultadapt paired with several processes..."
+    fi
+    
+    cmd="python"
+    cmd+=" ${pathToArcadHtsDir}/sp5_gbs/demultadapt.py"
+    cmd+=" -l 1.0"
+    cmd+=" -t 2"
+    cmd+=" -f ${pathToArcadHtsDir}/tests/demultadapt/indi_A_1.fastq"
+    cmd+=" -F ${pathToArcadHtsDir}/tests/demultadapt/indi_A_2.fastq"
+    cmd+=" -p returned"
+    cmd+=" ${pathToArcadHtsDir}/tests/demultadapt/adaptator.txt"
+    if [ $verbose -le "1" ]; then
+      cmd+=" > /dev/null"
+    fi
+    eval $cmd
     
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-indiv_1_1.fastq \
+        returned-indiv_1_1.fastq 
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-indiv_1_2.fastq \
+        returned-indiv_1_2.fastq
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-indiv_2_1.fastq \
+        returned-indiv_2_1.fastq
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-indiv_2_2.fastq \
+        returned-indiv_2_2.fastq 
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-rebut_1.fastq \
+        returned-rebut_1.fastq
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-rebut_2.fastq \
+        returned-rebut_2.fastq 
+    echo "all tests passed successfully!"
+    
+    if [ $verbose -gt "0" ]; then
+        echo -e "launch demultadapt paired in 3 shards..."
+    fi
+
+    # the shards run as separate processes, like the tasks of an array job.
+    # inputs are copied to index them one read in two.
+    cp ${pathToArcadHtsDir}/tests/demultadapt/indi_A_1.fastq \
+        ${pathToArcadHtsDir}/tests/demultadapt/indi_A_2.fastq .
+    python ${pathToArcadHtsDir}/sp5_gbs/index_fastq.py -s 2 \
+        indi_A_1.fastq indi_A_2.fastq > /dev/null
+
+    pids=""
+    for shard in 1 2 3; do
+        cmd="python"
+        cmd+=" ${pathToArcadHtsDir}/sp5_gbs/demultadapt.py"
+        cmd+=" -l 1.0"
+        cmd+=" --shard ${shard}/3"
+        cmd+=" -f indi_A_1.fastq"
+        cmd+=" -F indi_A_2.fastq"
+        cmd+=" -p returned"
+        cmd+=" ${pathToArcadHtsDir}/tests/demultadapt/adaptator.txt"
+        if [ $verbose -le "1" ]; then
+          cmd+=" > /dev/null"
+        fi
+        eval $cmd &
+        pids+=" $!"
+    done
+    for pid in ${pids}; do
+        wait ${pid} || exit 1
+    done
+
+    cmd="python"
+    cmd+=" ${pathToArcadHtsDir}/sp5_gbs/demultadapt.py"
+    cmd+=" --merge-shards 3"
+    cmd+=" -p returned"
+    if [ $verbose -le "1" ]; then
+      cmd+=" > /dev/null"
+    fi
+    eval $cmd || exit 1
+
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-indiv_1_1.fastq \
+        returned-indiv_1_1.fastq
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-indiv_1_2.fastq \
+        returned-indiv_1_2.fastq
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-indiv_2_1.fastq \
+        returned-indiv_2_1.fastq
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-indiv_2_2.fastq \
+        returned-indiv_2_2.fastq
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-rebut_1.fastq \
+        returned-rebut_1.fastq
+    cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-rebut_2.fastq \
+        returned-rebut_2.fastq
+    echo "all tests passed successfully!"
+
+    if [ $verbose -gt "0" ]; then
+        echo -e "launch demultadapt paired with mismatches on short reads..."
+    fi
+
+    # s1 is no longer than GTGT, s2 starts with both GTGT and GTGTCA.
+    for options in "-m 1" "-m 1 -t 2"; do
+        cmd="python"
+        cmd+=" ${pathToArcadHtsDir}/sp5_gbs/demultadapt.py"
+        cmd+=" ${options}"
+        cmd+=" -f ${pathToArcadHtsDir}/tests/demultadapt/short_1.fastq"
+        cmd+=" -F ${pathToArcadHtsDir}/tests/demultadapt/short_2.fastq"
+        cmd+=" -p short"
+        cmd+=" ${pathToArcadHtsDir}/tests/demultadapt/short_adaptator.txt"
+        if [ $verbose -le "1" ]; then
+          cmd+=" > /dev/null"
+        fi
+        eval $cmd || exit 1
+
+        cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-short-short_1.fastq \
+            short-short_1.fastq
+        cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-short-short_2.fastq \
+            short-short_2.fastq
+        cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-short-rebut_1.fastq \
+            short-rebut_1.fastq
+        cmp_or_quit ${pathToArcadHtsDir}/tests/demultadapt/expected-short-rebut_2.fastq \
+            short-rebut_2.fastq
+    done
+    echo "all tests passed successfully!"
+
+    if [ $verbose -gt "0" ]; then
+        echo -e "compare tiered and fuzzy selectors on short reads..."
+    fi
+
+    # the exact tier must not change what the fuzzy selector alone selects.
+    python - ${pathToArcadHtsDir}/tests/demultadapt/short_adaptator.txt <<EOF || exit 1
+import sys
+sys.path.insert( 0, "${pathToArcadHtsDir}/sp5_gbs" )
+import demultadapt
+
+table = demultadapt.get_adapt_table( open( sys.argv[ 1 ] ) )
+sequences = [ "CCCCCCCCC" ]
+for line in table :
+    for length in range( 1, len( line[ 0 ] ) + 1 ) :
+        sequences.append( line[ 0 ][ : length ] )
+    sequences.append( line[ 0 ] + "AC" )
+
+for all_members in False, True :
+    for single_end in True, False :
+        if all_members :
+            fuzzy = demultadapt.LevenshteinAllSelector( table, single_end, 0.9 )
+        else :
+            fuzzy = demultadapt.Levenshtein_selector( table, single_end, 0.9 )
+        tiered = demultadapt.Tiered_selector( fuzzy, single_end, all_members )
+        for sequence_1 in sequences :
+            for sequence_2 in single_end and [ None ] or sequences :
+                if single_end :
+                    args = ( sequence_1, )
+                else :
+                    args = ( sequence_1, sequence_2 )
+                if tiered.select( *args ) != fuzzy.select( *args ) :
+                    print >> sys.stderr, "tiered and fuzzy differ on", args
+                    sys.exit( 1 )
+EOF
+    echo "all tests passed successfully!"
+
     # step 4 ------------------------------------------------------------------
     cd ${cwd}
     if $clean; then rm -rf "${pathToArcadHtsDir}/tests/${testDir}"; fi